@@ -1,15 +1,52 @@
 import os
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+import csv
+import io
+import json
+import uuid
+from flask import (Flask, render_template, request, redirect, url_for, flash, session, jsonify,
+                   Response, stream_with_context)
+from flask.json.provider import DefaultJSONProvider
 from functools import wraps
-from datetime import datetime
+from datetime import datetime, timedelta
+from decimal import Decimal
 
+import auditoria
+import eventos
+import metricas
+import database
 from database import get_db_cursor
+from filas import Fila
 from models_auth import Usuario, Sesion
-from models_inventario import Medicamento, LoteMedicamento, Transaccion
+from models_inventario import Medicamento, LoteMedicamento, AlertaCaducidad, Transaccion, OCUPADO
 from models_ensayos import EnsayoClinico
+from models_reportes import ReporteVentas
+from models_stock import MovimientoStock, EventoInventario
+from models_valoracion import Valoracion
+from models_interacciones import Interaccion
+from models_compuestos import CompuestoQuimico, NIVELES_RIESGO
+
+class ProveedorJSON(DefaultJSONProvider):
+    """JSON de Flask que además serializa los registros de filas.py como objetos"""
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, Fila):
+            return dict(o)
+        return DefaultJSONProvider.default(o)
 
 app = Flask(__name__)
+app.json = ProveedorJSON(app)
 app.secret_key = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production')
+metricas.init_app(app)
+
+@app.before_request
+def _actor_auditoria():
+    """Los cambios hechos durante la petición se auditan a nombre del usuario de la sesión"""
+    auditoria.establecer_actor(session.get('user_id'))
+
+@app.teardown_request
+def _limpiar_actor_auditoria(error=None):
+    auditoria.establecer_actor(None)
 
 # Decorador para requerir autenticación
 def login_required(f):
@@ -30,8 +67,7 @@ def role_required(*roles):
                 flash('Debe iniciar sesión', 'warning')
                 return redirect(url_for('login'))
 
-            user = Usuario.obtener_por_id(session['user_id'])
-            if not user or user['rol'] not in roles:
+            if Usuario.rol_vigente(session['user_id']) not in roles:
                 flash('No tiene permisos para acceder a esta página', 'danger')
                 return redirect(url_for('dashboard'))
 
@@ -92,15 +128,11 @@ def dashboard():
         cursor.execute("SELECT COUNT(*) FROM lotes_medicamentos WHERE cantidad_actual > 0")
         lotes_activos = cursor.fetchone()[0]
 
-        cursor.execute("SELECT COUNT(*) FROM transacciones WHERE tipo = 'venta' AND DATE(fecha_transaccion) = CURRENT_DATE")
-        ventas_hoy = cursor.fetchone()[0]
+    # Leído del resumen diario en lugar de recorrer las transacciones del día
+    ventas_hoy = Transaccion.contar_ventas_hoy()
 
-        cursor.execute("""
-            SELECT COUNT(*) FROM lotes_medicamentos 
-            WHERE fecha_caducidad < CURRENT_DATE + INTERVAL '3 months' 
-            AND cantidad_actual > 0
-        """)
-        lotes_por_caducar = cursor.fetchone()[0]
+    # Conteo servido por los índices parciales de estado_caducidad
+    lotes_por_caducar = LoteMedicamento.contar_por_estado('proximo_a_caducar', 'caducado')
 
     stats = {
         'total_medicamentos': total_medicamentos,
@@ -115,14 +147,28 @@ def dashboard():
 @app.route('/inventario')
 @login_required
 def inventario():
-    inventario = LoteMedicamento.listar_inventario()
-    return render_template('inventario.html', inventario=inventario)
+    estado = request.args.get('estado')
+    # Secuencia previa a la consulta: la página recibe en vivo los cambios posteriores
+    secuencia_eventos = EventoInventario.limites()[1] or 0
+    if estado in LoteMedicamento.ESTADOS_CADUCIDAD:
+        inventario = LoteMedicamento.listar_por_estado(estado)
+    else:
+        estado = None
+        # Las filas se leen antes de renderizar: la conexión vuelve al pool aunque la plantilla falle
+        inventario = LoteMedicamento.listar_inventario()
+    return render_template('inventario.html', inventario=inventario, estado=estado,
+                           riesgo=CompuestoQuimico.riesgo_por_medicamento(),
+                           secuencia_eventos=secuencia_eventos)
 
 @app.route('/medicamentos')
 @login_required
 def medicamentos():
-    medicamentos = Medicamento.listar()
-    return render_template('medicamentos.html', medicamentos=medicamentos)
+    busqueda = request.args.get('q', '').strip()
+    if busqueda:
+        medicamentos = Medicamento.buscar(busqueda, limite=100)
+    else:
+        medicamentos = Medicamento.listar()
+    return render_template('medicamentos.html', medicamentos=medicamentos, busqueda=busqueda)
 
 @app.route('/medicamentos/nuevo', methods=['GET', 'POST'])
 @role_required('gerente', 'farmaceutico')
@@ -189,18 +235,18 @@ def nuevo_lote():
                 medicamento_id=int(request.form.get('medicamento_id')),
                 numero_lote=request.form.get('numero_lote'),
                 cantidad=int(request.form.get('cantidad')),
-                precio_unitario=float(request.form.get('precio_unitario')),
+                precio_unitario=Decimal(request.form.get('precio_unitario')),
                 fecha_fabricacion=request.form.get('fecha_fabricacion'),
                 fecha_caducidad=request.form.get('fecha_caducidad'),
-                proveedor=request.form.get('proveedor')
+                proveedor=request.form.get('proveedor'),
+                usuario_id=session['user_id']
             )
             flash('Lote creado exitosamente', 'success')
             return redirect(url_for('inventario'))
         except Exception as e:
             flash(f'Error al crear lote: {str(e)}', 'danger')
 
-    medicamentos = Medicamento.listar()
-    return render_template('nuevo_lote.html', medicamentos=medicamentos)
+    return render_template('nuevo_lote.html')
 
 @app.route('/lotes/<int:lote_id>/editar', methods=['GET', 'POST'])
 @role_required('gerente', 'farmaceutico')
@@ -216,10 +262,11 @@ def editar_lote(lote_id):
                 lote_id=lote_id,
                 numero_lote=request.form.get('numero_lote'),
                 cantidad_actual=int(request.form.get('cantidad_actual')),
-                precio_unitario=float(request.form.get('precio_unitario')),
+                precio_unitario=Decimal(request.form.get('precio_unitario')),
                 fecha_fabricacion=request.form.get('fecha_fabricacion'),
                 fecha_caducidad=request.form.get('fecha_caducidad'),
-                proveedor=request.form.get('proveedor')
+                proveedor=request.form.get('proveedor'),
+                usuario_id=session['user_id']
             )
             flash('Lote actualizado exitosamente', 'success')
             return redirect(url_for('inventario'))
@@ -233,7 +280,7 @@ def editar_lote(lote_id):
 @role_required('gerente')
 def eliminar_lote(lote_id):
     try:
-        if LoteMedicamento.eliminar(lote_id):
+        if LoteMedicamento.eliminar(lote_id, usuario_id=session['user_id']):
             flash('Lote eliminado exitosamente', 'success')
         else:
             flash('No se pudo eliminar el lote. Puede tener transacciones asociadas.', 'warning')
@@ -248,18 +295,39 @@ def transacciones():
     historial = Transaccion.listar_historial()
     return render_template('transacciones.html', transacciones=historial)
 
+def _clave_idempotencia():
+    """Clave de idempotencia del envío: cabecera Idempotency-Key o campo oculto del formulario"""
+    clave = request.headers.get('Idempotency-Key') or request.form.get('clave_idempotencia') or ''
+    return clave.strip()[:100] or None
+
 @app.route('/venta', methods=['GET', 'POST'])
 @role_required('gerente', 'farmaceutico')
 def registrar_venta():
+    interacciones = []
+    # Un doble envío o un reintento con la misma clave no duplica la venta
+    clave = _clave_idempotencia()
     if request.method == 'POST':
         try:
-            lote_id = int(request.form.get('lote_id'))
-            cantidad = int(request.form.get('cantidad'))
+            items = [
+                (int(lote_id), int(cantidad))
+                for lote_id, cantidad in zip(request.form.getlist('lote_id'), request.form.getlist('cantidad'))
+                if lote_id and cantidad
+            ]
             usar_optimista = request.form.get('metodo_concurrencia') == 'optimista'
 
-            exito, mensaje, transaccion_id = Transaccion.registrar_venta(
-                lote_id, session['user_id'], cantidad, usar_optimista
-            )
+            if len(items) == 1:
+                lote_id, cantidad = items[0]
+                exito, mensaje, transaccion_id = Transaccion.registrar_venta(
+                    lote_id, session['user_id'], cantidad, usar_optimista, clave=clave
+                )
+            else:
+                # Las interacciones severas requieren confirmación explícita
+                lotes = LoteMedicamento.medicamentos_de_lotes(lote_id for lote_id, _ in items)
+                interacciones = Interaccion.verificar(lotes.values())
+                if any(i['severidad'] == 'severa' for i in interacciones) and not request.form.get('confirmar_interacciones'):
+                    exito, mensaje = False, 'La venta incluye medicamentos con interacciones severas. Revise y confirme.'
+                else:
+                    exito, mensaje, _ = Transaccion.registrar_venta_multiple(items, session['user_id'], clave=clave)
 
             if exito:
                 flash(mensaje, 'success')
@@ -269,8 +337,60 @@ def registrar_venta():
         except Exception as e:
             flash(f'Error: {str(e)}', 'danger')
 
-    inventario = LoteMedicamento.listar_inventario()
-    return render_template('registrar_venta.html', inventario=inventario)
+    return render_template('registrar_venta.html', interacciones=interacciones,
+                           clave_idempotencia=clave or uuid.uuid4().hex,
+                           secuencia_eventos=EventoInventario.limites()[1] or 0)
+
+def _lineas_recepcion(lineas):
+    """
+    Convertir las líneas de una entrega [(lote, cantidad)], donde lote es el
+    id o el número de lote, en [(lote_id, cantidad)].
+    Lanza ValueError con las líneas que no se pueden interpretar.
+    """
+    items, por_numero, errores = [], {}, []
+    for n, (lote, cantidad) in enumerate(lineas, start=1):
+        try:
+            cantidad = int(cantidad)
+        except (TypeError, ValueError):
+            errores.append(f'línea {n}: cantidad no válida')
+            continue
+        if isinstance(lote, int):
+            items.append((lote, cantidad))
+        elif lote and str(lote).strip():
+            por_numero.setdefault(str(lote).strip(), []).append((n, cantidad))
+        else:
+            errores.append(f'línea {n}: falta el lote')
+    if por_numero:
+        ids = LoteMedicamento.ids_por_numero(por_numero)
+        for numero, lineas_numero in por_numero.items():
+            if numero not in ids:
+                errores.extend(f'línea {n}: lote {numero} no encontrado' for n, _ in lineas_numero)
+            else:
+                items.extend((ids[numero], cantidad) for _, cantidad in lineas_numero)
+    if errores:
+        raise ValueError('; '.join(errores[:10]) + ('…' if len(errores) > 10 else ''))
+    return items
+
+@app.route('/compras/recepcion', methods=['GET', 'POST'])
+@role_required('gerente', 'farmaceutico')
+def recepcion_compra():
+    """Recepción de una entrega: una línea 'numero_lote,cantidad' por producto"""
+    clave = _clave_idempotencia()
+    texto = request.form.get('lineas', '')
+    if request.method == 'POST':
+        try:
+            filas = [fila for fila in csv.reader(io.StringIO(texto)) if any(c.strip() for c in fila)]
+            items = _lineas_recepcion([(fila[0], fila[1] if len(fila) > 1 else None) for fila in filas])
+            exito, mensaje, _ = Transaccion.registrar_compra_multiple(items, session['user_id'], clave=clave)
+            if exito:
+                flash(mensaje, 'success')
+                return redirect(url_for('transacciones'))
+            flash(mensaje, 'danger')
+        except (ValueError, csv.Error) as e:
+            flash(f'Error: {str(e)}', 'danger')
+
+    return render_template('recepcion_compra.html', lineas=texto,
+                           clave_idempotencia=clave or uuid.uuid4().hex)
 
 # Rutas de Ensayos Clínicos (MongoDB)
 @app.route('/ensayos')
@@ -292,7 +412,8 @@ def ensayos_clinicos():
     for medicamento in Medicamento.listar():
         medicamentos_dict[medicamento['id']] = medicamento['nombre']
 
-    return render_template('ensayos_clinicos.html', ensayos=ensayos, medicamentos=medicamentos_dict)
+    return render_template('ensayos_clinicos.html', ensayos=ensayos, medicamentos=medicamentos_dict,
+                           riesgo=CompuestoQuimico.riesgo_por_medicamento())
 
 @app.route('/ensayos/nuevo', methods=['GET', 'POST'])
 @role_required('gerente', 'investigador')
@@ -336,7 +457,8 @@ def ver_ensayo(ensayo_id):
         return redirect(url_for('ensayos_clinicos'))
 
     medicamento = Medicamento.obtener_por_id(ensayo['medicamento_id'])
-    return render_template('ver_ensayo.html', ensayo=ensayo, medicamento=medicamento)
+    compuestos = CompuestoQuimico.listar_por_medicamento(ensayo['medicamento_id']) if medicamento else []
+    return render_template('ver_ensayo.html', ensayo=ensayo, medicamento=medicamento, compuestos=compuestos)
 
 @app.route('/ensayos/<ensayo_id>/agregar_efecto', methods=['POST'])
 @role_required('gerente', 'investigador')
@@ -358,12 +480,106 @@ def agregar_efecto_secundario(ensayo_id):
 
     return redirect(url_for('ver_ensayo', ensayo_id=ensayo_id))
 
+# Rutas de Compuestos Químicos
+@app.route('/compuestos')
+@login_required
+def compuestos():
+    busqueda = request.args.get('q', '').strip()
+    if busqueda:
+        lista = CompuestoQuimico.buscar(busqueda, limite=100)
+    else:
+        lista = CompuestoQuimico.listar()
+    return render_template('compuestos.html', compuestos=lista, busqueda=busqueda, niveles=NIVELES_RIESGO)
+
+@app.route('/compuestos/nuevo', methods=['POST'])
+@role_required('gerente', 'investigador')
+def nuevo_compuesto():
+    try:
+        compuesto_id = CompuestoQuimico.crear(
+            nombre=request.form.get('nombre'),
+            formula_quimica=request.form.get('formula_quimica') or None,
+            descripcion=request.form.get('descripcion') or None,
+            nivel_riesgo=request.form.get('nivel_riesgo') or None
+        )
+        flash('Compuesto creado exitosamente', 'success')
+        return redirect(url_for('ver_compuesto', compuesto_id=compuesto_id))
+    except Exception as e:
+        flash(f'Error al crear compuesto: {str(e)}', 'danger')
+    return redirect(url_for('compuestos'))
+
+@app.route('/compuestos/<int:compuesto_id>')
+@login_required
+def ver_compuesto(compuesto_id):
+    compuesto = CompuestoQuimico.obtener_por_id(compuesto_id)
+    if not compuesto:
+        flash('Compuesto no encontrado', 'danger')
+        return redirect(url_for('compuestos'))
+    return render_template('ver_compuesto.html',
+                           compuesto=compuesto,
+                           vinculados=CompuestoQuimico.medicamentos_del_compuesto(compuesto_id),
+                           medicamentos=Medicamento.listar())
+
+@app.route('/compuestos/<int:compuesto_id>/vincular', methods=['POST'])
+@role_required('gerente', 'investigador')
+def vincular_compuesto(compuesto_id):
+    try:
+        if CompuestoQuimico.vincular(int(request.form.get('medicamento_id')), compuesto_id):
+            flash('Medicamento vinculado', 'success')
+        else:
+            flash('El medicamento ya estaba vinculado', 'info')
+    except Exception as e:
+        flash(f'Error al vincular: {str(e)}', 'danger')
+    return redirect(url_for('ver_compuesto', compuesto_id=compuesto_id))
+
+@app.route('/compuestos/<int:compuesto_id>/desvincular/<int:medicamento_id>', methods=['POST'])
+@role_required('gerente', 'investigador')
+def desvincular_compuesto(compuesto_id, medicamento_id):
+    CompuestoQuimico.desvincular(medicamento_id, compuesto_id)
+    flash('Medicamento desvinculado', 'success')
+    return redirect(url_for('ver_compuesto', compuesto_id=compuesto_id))
+
+@app.route('/compuestos/<int:compuesto_id>/eliminar', methods=['POST'])
+@role_required('gerente')
+def eliminar_compuesto(compuesto_id):
+    try:
+        CompuestoQuimico.eliminar(compuesto_id)
+        flash('Compuesto eliminado', 'success')
+    except Exception as e:
+        flash(f'Error al eliminar compuesto: {str(e)}', 'danger')
+    return redirect(url_for('compuestos'))
+
 # Rutas de administración (solo gerentes)
 @app.route('/usuarios')
 @role_required('gerente')
 def usuarios():
-    usuarios = Usuario.listar_usuarios()
-    return render_template('usuarios.html', usuarios=usuarios)
+    filtros = {
+        'rol': request.args.get('rol') or None,
+        'activo': {'1': True, '0': False}.get(request.args.get('activo')),
+        'prefijo': request.args.get('q', '').strip() or None
+    }
+    limite = min(request.args.get('limite', 50, type=int), 200)
+    usuarios = Usuario.listar_usuarios(despues_de=request.args.get('despues_de', type=int),
+                                       limite=limite, **filtros)
+    siguiente = usuarios[-1]['id'] if len(usuarios) == limite else None
+    return render_template('usuarios.html', usuarios=usuarios, siguiente=siguiente,
+                           filtros=request.args)
+
+@app.route('/usuarios/estado', methods=['POST'])
+@role_required('gerente')
+def cambiar_estado_usuarios():
+    activo = request.form.get('accion') == 'activar'
+    ids = {int(i) for i in request.form.getlist('user_ids') if i.isdigit()}
+    # Un gerente no puede desactivarse a sí mismo
+    ids.discard(session['user_id'])
+    if not ids:
+        flash('No se seleccionó ningún usuario', 'warning')
+    else:
+        cambiados = Usuario.cambiar_estado(ids, activo)
+        flash(f"{len(cambiados)} usuarios {'activados' if activo else 'desactivados'}", 'success')
+    volver = request.form.get('volver', '')
+    if not volver.startswith('/') or volver.startswith('//'):
+        volver = url_for('usuarios')
+    return redirect(volver)
 
 @app.route('/usuarios/nuevo', methods=['GET', 'POST'])
 @role_required('gerente')
@@ -384,6 +600,27 @@ def nuevo_usuario():
 
     return render_template('nuevo_usuario.html')
 
+@app.route('/usuarios/importar', methods=['GET', 'POST'])
+@role_required('gerente')
+def importar_usuarios():
+    """Alta masiva desde CSV; el progreso se envía como NDJSON (un evento por línea)"""
+    if request.method == 'GET':
+        return render_template('importar_usuarios.html')
+    archivo = request.files.get('archivo')
+    if not archivo:
+        return jsonify({'error': 'Debe adjuntar un archivo CSV'}), 400
+    try:
+        filas = list(csv.DictReader(io.StringIO(archivo.read().decode('utf-8-sig'))))
+    except (UnicodeDecodeError, csv.Error) as e:
+        return jsonify({'error': f'No se pudo leer el CSV: {e}'}), 400
+
+    def eventos():
+        yield json.dumps({'evento': 'inicio', 'total': len(filas)}) + '\n'
+        for evento in Usuario.crear_usuarios_masivo(filas):
+            yield json.dumps(evento) + '\n'
+
+    return Response(stream_with_context(eventos()), mimetype='application/x-ndjson')
+
 @app.route('/usuarios/<int:user_id>/editar', methods=['GET', 'POST'])
 @role_required('gerente')
 def editar_usuario(user_id):
@@ -431,6 +668,42 @@ def eliminar_usuario(user_id):
         flash(f'Error al eliminar usuario: {str(e)}', 'danger')
     return redirect(url_for('usuarios'))
 
+# Reportes de ventas (leídos de los resúmenes diarios)
+def _parametros_reporte():
+    """Rango de fechas y agrupación del reporte; por defecto los últimos 30 días"""
+    hoy = datetime.now().date()
+    desde = request.args.get('desde') or (hoy - timedelta(days=29)).isoformat()
+    hasta = request.args.get('hasta') or hoy.isoformat()
+    return {
+        'desde': datetime.strptime(desde, '%Y-%m-%d').date(),
+        'hasta': datetime.strptime(hasta, '%Y-%m-%d').date(),
+        'granularidad': request.args.get('granularidad', 'dia'),
+        'agrupar_por': request.args.get('agrupar_por') or None
+    }
+
+@app.route('/reportes')
+@role_required('gerente')
+def reportes():
+    try:
+        parametros = _parametros_reporte()
+        serie = ReporteVentas.serie(**parametros)
+    except ValueError as e:
+        flash(f'Parámetros de reporte no válidos: {str(e)}', 'warning')
+        return redirect(url_for('reportes'))
+
+    return render_template('reportes.html',
+                           parametros=parametros,
+                           serie=serie,
+                           totales=ReporteVentas.totales(parametros['desde'], parametros['hasta']),
+                           mas_vendidos=ReporteVentas.mas_vendidos(parametros['desde'], parametros['hasta']))
+
+@app.route('/admin/consultas-lentas')
+@role_required('gerente')
+def consultas_lentas():
+    return render_template('consultas_lentas.html',
+                           consultas=database.obtener_consultas_lentas(),
+                           umbral_ms=database.SLOW_QUERY_MS)
+
 # API endpoints
 @app.route('/api/lote/<int:lote_id>')
 @login_required
@@ -440,6 +713,303 @@ def api_obtener_lote(lote_id):
         return jsonify(lote)
     return jsonify({'error': 'Lote no encontrado'}), 404
 
+@app.route('/api/lote/<int:lote_id>/fragmentos', methods=['GET', 'POST'])
+@role_required('gerente')
+def api_fragmentos_lote(lote_id):
+    """Fragmentos de un lote con mucha concurrencia; POST {"fragmentos": N} (0 vuelve al modo normal)"""
+    if request.method == 'POST':
+        fragmentos = (request.get_json(silent=True) or {}).get('fragmentos')
+        if not isinstance(fragmentos, int):
+            return jsonify({'error': 'Se esperaba {"fragmentos": N}'}), 400
+        try:
+            if not LoteMedicamento.fragmentar(lote_id, fragmentos):
+                return jsonify({'error': 'Lote no encontrado'}), 404
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    return jsonify({'lote_id': lote_id, 'fragmentos': LoteMedicamento.listar_fragmentos(lote_id)})
+
+@app.route('/api/reportes/ventas')
+@role_required('gerente')
+def api_reporte_ventas():
+    try:
+        parametros = _parametros_reporte()
+        serie = ReporteVentas.serie(tipo=request.args.get('tipo', 'venta'), **parametros)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({
+        'desde': parametros['desde'].isoformat(),
+        'hasta': parametros['hasta'].isoformat(),
+        'granularidad': parametros['granularidad'],
+        'agrupar_por': parametros['agrupar_por'],
+        'serie': [dict(fila, periodo=fila['periodo'].isoformat()) for fila in serie]
+    })
+
+@app.route('/api/reportes/mas-vendidos')
+@role_required('gerente')
+def api_mas_vendidos():
+    try:
+        parametros = _parametros_reporte()
+        medicamentos = ReporteVentas.mas_vendidos(
+            parametros['desde'], parametros['hasta'],
+            limite=min(request.args.get('limite', 10, type=int), 100),
+            criterio=request.args.get('criterio', 'unidades')
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'medicamentos': medicamentos})
+
+@app.route('/api/lote/<int:lote_id>/movimientos')
+@role_required('gerente', 'farmaceutico')
+def api_movimientos_lote(lote_id):
+    limite = min(request.args.get('limite', 100, type=int), 500)
+    movimientos = MovimientoStock.listar_por_lote(
+        lote_id, antes_de=request.args.get('antes_de', type=int), limite=limite
+    )
+    return jsonify({
+        'movimientos': movimientos,
+        'siguiente': movimientos[-1]['id'] if len(movimientos) == limite else None
+    })
+
+def _cursor_eventos(desde):
+    """
+    (desde, lote_ids) validados para el feed y el flujo SSE de eventos de inventario.
+    ValueError si los parámetros no son válidos; LookupError si el cursor es
+    anterior a los eventos conservados.
+    """
+    if desde is not None and desde < 0:
+        raise ValueError('desde debe ser una secuencia no negativa')
+    try:
+        lote_ids = [int(i) for i in request.args.get('lotes', '').split(',') if i.strip()] or None
+    except ValueError:
+        raise ValueError('lotes debe ser una lista de ids separados por comas')
+    if desde is not None:
+        primera, _ = EventoInventario.limites()
+        if primera is not None and desde < primera - 1:
+            raise LookupError(f'El cursor {desde} ya no está disponible (primer evento conservado: {primera})')
+    return desde, lote_ids
+
+@app.route('/api/inventario/eventos')
+@login_required
+def api_eventos_inventario():
+    """Feed de eventos de inventario por cursor: ?desde=<secuencia>&lotes=1,2,3"""
+    eventos.asegurar_escucha()
+    try:
+        desde, lote_ids = _cursor_eventos(request.args.get('desde', type=int))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 410
+    limite = min(request.args.get('limite', 500, type=int), 1000)
+    if desde is None:
+        primera, _ = EventoInventario.limites()
+        desde = primera - 1 if primera is not None else 0
+    lista = EventoInventario.listar(desde, limite=limite, lote_ids=lote_ids)
+    return jsonify({
+        'eventos': lista,
+        # Cursor para la siguiente petición (igual a desde si no hubo eventos nuevos)
+        'siguiente': lista[-1]['secuencia'] if lista else desde,
+        'completo': len(lista) < limite
+    })
+
+@app.route('/api/inventario/eventos/stream')
+@login_required
+def api_eventos_inventario_stream():
+    """Eventos de inventario como Server-Sent Events (reanuda desde Last-Event-ID o ?desde=)"""
+    desde = request.headers.get('Last-Event-ID', type=int)
+    if desde is None:
+        desde = request.args.get('desde', type=int)
+    try:
+        desde, lote_ids = _cursor_eventos(desde)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 410
+    if not eventos.reservar_conexion_sse():
+        return jsonify({'error': 'Demasiadas conexiones de eventos; use /api/inventario/eventos'}), 503, {'Retry-After': '30'}
+    try:
+        respuesta = Response(stream_with_context(eventos.flujo_sse(desde, lote_ids)),
+                             mimetype='text/event-stream')
+    except Exception:
+        eventos.liberar_conexion_sse()
+        raise
+    respuesta.call_on_close(eventos.liberar_conexion_sse)
+    respuesta.headers['Cache-Control'] = 'no-cache'
+    # nginx: no acumular la respuesta en su búfer
+    respuesta.headers['X-Accel-Buffering'] = 'no'
+    return respuesta
+
+@app.route('/api/inventario/historico')
+@role_required('gerente')
+def api_inventario_historico():
+    fecha = request.args.get('fecha')
+    try:
+        fecha = datetime.fromisoformat(fecha) if fecha else datetime.now()
+    except ValueError:
+        return jsonify({'error': 'Fecha no válida (usar AAAA-MM-DD o AAAA-MM-DDTHH:MM)'}), 400
+    lotes = MovimientoStock.stock_en_fecha(fecha, medicamento_id=request.args.get('medicamento_id', type=int))
+    return jsonify({
+        'fecha': fecha.isoformat(),
+        'lotes': lotes,
+        'unidades': sum(lote['saldo'] for lote in lotes)
+    })
+
+@app.route('/api/valoracion')
+@role_required('gerente')
+def api_valoracion():
+    metodo = request.args.get('metodo', 'fifo')
+    try:
+        medicamentos = Valoracion.listar(metodo)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({
+        'metodo': metodo,
+        'medicamentos': medicamentos,
+        'valor_total': sum(m['valor'] for m in medicamentos),
+        'movimientos_pendientes': Valoracion.pendientes()
+    })
+
+@app.route('/api/valoracion/costo-ventas')
+@role_required('gerente')
+def api_valoracion_costo_ventas():
+    metodo = request.args.get('metodo', 'fifo')
+    try:
+        parametros = _parametros_reporte()
+        medicamentos = Valoracion.costo_ventas(parametros['desde'], parametros['hasta'], metodo)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({
+        'desde': parametros['desde'].isoformat(),
+        'hasta': parametros['hasta'].isoformat(),
+        'metodo': metodo,
+        'medicamentos': medicamentos,
+        'costo_total': sum(m['costo'] for m in medicamentos)
+    })
+
+@app.route('/api/auditoria')
+@role_required('gerente')
+def api_auditoria():
+    """Cambios auditados, del más reciente al más antiguo (?tabla=&registro_id=&usuario_id=&despues_de=)"""
+    limite = min(request.args.get('limite', 50, type=int), 500)
+    eventos = auditoria.listar(
+        tabla=request.args.get('tabla') or None,
+        registro_id=request.args.get('registro_id', type=int),
+        usuario_id=request.args.get('usuario_id', type=int),
+        despues_de=request.args.get('despues_de', type=int),
+        limite=limite
+    )
+    for evento in eventos:
+        evento['fecha'] = evento['fecha'].isoformat()
+    return jsonify({
+        'eventos': eventos,
+        'siguiente': eventos[-1]['id'] if len(eventos) == limite else None
+    })
+
+@app.route('/api/compras/recepcion', methods=['POST'])
+@role_required('gerente', 'farmaceutico')
+def api_recepcion_compra():
+    """
+    Recepción de una entrega en una transacción:
+    {"lineas": [{"lote_id": 1, "cantidad": 50}, {"numero_lote": "L-2", "cantidad": 20}]}
+    Con la cabecera Idempotency-Key, un reintento retorna el resultado original.
+    """
+    datos = request.get_json(silent=True) or {}
+    lineas = datos.get('lineas')
+    if not isinstance(lineas, list) or not all(isinstance(linea, dict) for linea in lineas):
+        return jsonify({'error': 'Se esperaba {"lineas": [{"lote_id" o "numero_lote", "cantidad"}]}'}), 400
+    try:
+        items = _lineas_recepcion([
+            (linea['lote_id'] if isinstance(linea.get('lote_id'), int) else linea.get('numero_lote'),
+             linea.get('cantidad'))
+            for linea in lineas
+        ])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    exito, mensaje, transaccion_ids = Transaccion.registrar_compra_multiple(
+        items, session['user_id'], clave=_clave_idempotencia()
+    )
+    if not exito:
+        return jsonify({'error': mensaje}), 400
+    return jsonify({'mensaje': mensaje, 'transacciones': transaccion_ids}), 201
+
+@app.route('/api/ventas/asignada', methods=['POST'])
+@role_required('gerente', 'farmaceutico')
+def api_venta_asignada():
+    """
+    Venta de un medicamento con asignación automática del lote (FEFO, SKIP LOCKED):
+    {"medicamento_id": 1, "cantidad": 2}. 409 si los lotes siguen ocupados
+    tras los reintentos. Con la cabecera Idempotency-Key, un reintento
+    retorna el resultado original.
+    """
+    datos = request.get_json(silent=True) or {}
+    medicamento_id = datos.get('medicamento_id')
+    cantidad = datos.get('cantidad')
+    if not isinstance(medicamento_id, int) or not isinstance(cantidad, int):
+        return jsonify({'error': 'Se esperaba {"medicamento_id": int, "cantidad": int}'}), 400
+    exito, mensaje, transaccion_id = Transaccion.registrar_venta_asignada(
+        medicamento_id, session['user_id'], cantidad, clave=_clave_idempotencia()
+    )
+    if not exito:
+        return jsonify({'error': mensaje}), 409 if mensaje == OCUPADO[1] else 400
+    return jsonify({'mensaje': mensaje, 'transaccion_id': transaccion_id}), 201
+
+@app.route('/api/interacciones')
+@login_required
+def api_interacciones():
+    """Interacciones entre los medicamentos de ?medicamentos=1,2,3"""
+    try:
+        ids = [int(i) for i in request.args.get('medicamentos', '').split(',') if i.strip()]
+    except ValueError:
+        return jsonify({'error': 'medicamentos debe ser una lista de ids separados por comas'}), 400
+    if len(ids) > 100:
+        return jsonify({'error': 'Máximo 100 medicamentos por consulta'}), 400
+    return jsonify({'interacciones': Interaccion.verificar(ids)})
+
+@app.route('/api/medicamentos/buscar')
+@login_required
+def api_buscar_medicamentos():
+    limite = min(request.args.get('limite', 20, type=int), 100)
+    return jsonify({'medicamentos': Medicamento.buscar(request.args.get('q', ''), limite)})
+
+@app.route('/api/medicamentos/<int:medicamento_id>/lotes')
+@login_required
+def api_lotes_medicamento(medicamento_id):
+    lotes = LoteMedicamento.listar_por_medicamento(medicamento_id)
+    return jsonify({
+        'lotes': [
+            dict(lote, fecha_caducidad=lote['fecha_caducidad'].isoformat(),
+                 precio_unitario=float(lote['precio_unitario']))
+            for lote in lotes
+        ]
+    })
+
+@app.route('/api/compuestos/buscar')
+@login_required
+def api_buscar_compuestos():
+    limite = min(request.args.get('limite', 20, type=int), 100)
+    return jsonify({'compuestos': CompuestoQuimico.buscar(request.args.get('q', ''), limite)})
+
+@app.route('/api/alertas/caducidad')
+@login_required
+def api_alertas_caducidad():
+    limite = min(request.args.get('limite', 50, type=int), 200)
+    alertas = AlertaCaducidad.listar(
+        despues_de=request.args.get('despues_de', type=int),
+        limite=limite,
+        solo_pendientes=request.args.get('todas') != '1'
+    )
+    return jsonify({
+        'alertas': alertas,
+        'siguiente': alertas[-1]['id'] if len(alertas) == limite else None
+    })
+
+@app.route('/api/alertas/caducidad/<int:alerta_id>/atender', methods=['POST'])
+@role_required('gerente', 'farmaceutico')
+def api_atender_alerta(alerta_id):
+    if AlertaCaducidad.atender(alerta_id):
+        return jsonify({'atendida': alerta_id})
+    return jsonify({'error': 'Alerta no encontrada o ya atendida'}), 404
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # Servidor de desarrollo; en producción usar: gunicorn -c gunicorn.conf.py wsgi:application
+    app.run(debug=os.getenv('FLASK_ENV') == 'development', host='0.0.0.0', port=5000)
 
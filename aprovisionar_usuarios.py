@@ -0,0 +1,49 @@
+"""
+Alta masiva de usuarios desde un archivo CSV.
+
+El CSV lleva encabezado username,password,nombre_completo,email,rol. Las
+contraseñas se cifran con bcrypt en varios procesos en paralelo (el coste de
+bcrypt es deliberadamente alto: en serie, miles de usuarios tardan minutos) y
+los usuarios se insertan con una sola sentencia. Las filas cuyo username o
+email ya existen se informan como conflicto y no detienen la carga.
+
+Uso:
+    python aprovisionar_usuarios.py usuarios.csv
+    python aprovisionar_usuarios.py usuarios.csv --procesos 8
+"""
+import argparse
+import csv
+import sys
+import time
+
+from models_auth import Usuario, PROCESOS_HASH
+
+def parsear_argumentos():
+    parser = argparse.ArgumentParser(description='Alta masiva de usuarios desde CSV')
+    parser.add_argument('archivo', help='CSV con username,password,nombre_completo,email,rol')
+    parser.add_argument('--procesos', type=int, default=PROCESOS_HASH,
+                        help='Procesos para calcular los hashes bcrypt')
+    return parser.parse_args()
+
+def main():
+    args = parsear_argumentos()
+    with open(args.archivo, newline='', encoding='utf-8-sig') as f:
+        filas = list(csv.DictReader(f))
+    print(f"Aprovisionando {len(filas):,} usuarios con {args.procesos} procesos...")
+
+    inicio = time.perf_counter()
+    resumen = None
+    for evento in Usuario.crear_usuarios_masivo(filas, procesos=args.procesos):
+        if evento['evento'] == 'hash':
+            print(f"  contraseñas: {evento['procesados']:,}/{evento['total']:,}", end='\r', flush=True)
+        elif evento['evento'] == 'fila' and evento['estado'] != 'creado':
+            print(f"✗ Fila {evento['fila']} ({evento['username'] or '-'}): {evento['error']}")
+        elif evento['evento'] == 'resumen':
+            resumen = evento
+
+    print(f"✓ {resumen['creados']:,} usuarios creados en {time.perf_counter() - inicio:.1f} s "
+          f"({resumen['conflictos']:,} conflictos, {resumen['invalidos']:,} inválidos)")
+    return 0 if resumen['conflictos'] + resumen['invalidos'] == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
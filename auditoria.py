@@ -0,0 +1,192 @@
+"""
+Auditoría de cambios en medicamentos, lotes y usuarios (migración 011).
+
+Los métodos crear/actualizar/eliminar de los modelos llaman a registrar()
+después de confirmar su transacción, con la fila antes y después del cambio
+(obtenidas en la misma sentencia con RETURNING). registrar() solo calcula la
+diferencia y la encola: un hilo escritor por proceso vacía la cola en lotes
+de hasta AUDITORIA_LOTE eventos con un solo INSERT, así que la petición no
+espera ninguna escritura de auditoría.
+
+La cola es acotada (AUDITORIA_COLA_MAX). Si se llena porque la base de datos
+no da abasto, el evento se escribe en el hilo de la petición en lugar de
+perderse. Al terminar el proceso se escriben los eventos pendientes.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from functools import partial
+
+from psycopg2.extras import Json, execute_values
+
+import metricas
+from database import get_db_cursor
+
+logger = logging.getLogger(__name__)
+
+AUDITORIA_COLA_MAX = int(os.getenv('AUDITORIA_COLA_MAX', '10000'))
+AUDITORIA_LOTE = int(os.getenv('AUDITORIA_LOTE', '500'))
+# Segundos que el escritor espera a juntar un lote antes de escribirlo
+AUDITORIA_INTERVALO = float(os.getenv('AUDITORIA_INTERVALO', '1'))
+
+# Campos cuyo valor no se guarda (solo que cambiaron)
+CAMPOS_OCULTOS = ('password_hash',)
+OCULTO = '***'
+
+_cola = queue.Queue(maxsize=AUDITORIA_COLA_MAX)
+_escritor = None
+_lock_escritor = threading.Lock()
+_json = partial(json.dumps, default=str)
+
+# Usuario que hace los cambios en el hilo actual (lo fija app.py en cada petición)
+_contexto = threading.local()
+
+def establecer_actor(usuario_id):
+    _contexto.usuario_id = usuario_id
+
+def actor_actual():
+    return getattr(_contexto, 'usuario_id', None)
+
+def _diferencias(antes, despues):
+    """{campo: [antes, después]} de los campos que cambiaron"""
+    if antes is None:
+        cambios = {campo: [None, valor] for campo, valor in despues.items()}
+    elif despues is None:
+        cambios = {campo: [valor, None] for campo, valor in antes.items()}
+    else:
+        cambios = {campo: [antes.get(campo), valor] for campo, valor in despues.items()
+                   if antes.get(campo) != valor}
+    for campo in CAMPOS_OCULTOS:
+        if campo in cambios:
+            cambios[campo] = [OCULTO if valor is not None else None for valor in cambios[campo]]
+    return cambios
+
+def dividir_fila(row, campos):
+    """(antes, después) de una fila con RETURNING <columnas antes>, <columnas después>"""
+    n = len(campos)
+    return dict(zip(campos, row[:n])), dict(zip(campos, row[n:2 * n]))
+
+def registrar(tabla, registro_id, antes=None, despues=None, usuario_id=None):
+    """
+    Encolar el cambio de un registro. antes=None es una inserción y despues=None
+    una eliminación; una actualización sin cambios no se registra.
+    """
+    operacion = 'INSERT' if antes is None else 'DELETE' if despues is None else 'UPDATE'
+    cambios = _diferencias(antes, despues)
+    if not cambios:
+        return
+    evento = (datetime.now(), tabla, registro_id, operacion,
+              usuario_id if usuario_id is not None else actor_actual(), cambios)
+    _asegurar_escritor()
+    try:
+        _cola.put_nowait(evento)
+    except queue.Full:
+        metricas.registro.incrementar(
+            'pharmaflow_auditoria_escrituras_sincronas_total', {}, 1,
+            ayuda='Eventos de auditoría escritos en la petición por tener la cola llena'
+        )
+        try:
+            _escribir([evento])
+        except Exception:
+            logger.exception("No se pudo escribir el evento de auditoría %s", _json(evento))
+
+def _escribir(eventos):
+    with get_db_cursor() as cursor:
+        execute_values(
+            cursor,
+            """INSERT INTO auditoria (fecha, tabla, registro_id, operacion, usuario_id, cambios)
+               VALUES %s""",
+            [evento[:5] + (Json(evento[5], dumps=_json),) for evento in eventos],
+            page_size=len(eventos)
+        )
+    metricas.registro.incrementar(
+        'pharmaflow_auditoria_eventos_total', {}, len(eventos),
+        ayuda='Eventos de auditoría escritos'
+    )
+
+def _tomar_lote():
+    """Esperar el primer evento y juntar más durante AUDITORIA_INTERVALO segundos"""
+    lote = [_cola.get()]
+    limite = time.monotonic() + AUDITORIA_INTERVALO
+    while len(lote) < AUDITORIA_LOTE:
+        restante = limite - time.monotonic()
+        try:
+            lote.append(_cola.get(timeout=restante) if restante > 0 else _cola.get_nowait())
+        except queue.Empty:
+            break
+    return lote
+
+def _bucle_escritor():
+    espera = 1
+    while True:
+        lote = _tomar_lote()
+        # Reintentar el mismo lote hasta que se escriba: mientras tanto los eventos
+        # nuevos esperan en la cola (y si se llena, registrar() escribe en línea)
+        while True:
+            try:
+                _escribir(lote)
+                espera = 1
+                break
+            except Exception:
+                logger.exception("Error al escribir %s eventos de auditoría; reintento en %s s", len(lote), espera)
+                time.sleep(espera)
+                espera = min(espera * 2, 30)
+        for _ in lote:
+            _cola.task_done()
+
+def _asegurar_escritor():
+    """Lanzar el hilo escritor (una vez por proceso, también después de fork)"""
+    global _escritor
+    if _escritor is not None and _escritor.is_alive():
+        return
+    with _lock_escritor:
+        if _escritor is None or not _escritor.is_alive():
+            _escritor = threading.Thread(target=_bucle_escritor, name='escritor-auditoria', daemon=True)
+            _escritor.start()
+
+def vaciar(timeout=5):
+    """Esperar a que se escriban los eventos encolados; retorna los que quedaron pendientes"""
+    limite = time.monotonic() + timeout
+    while _cola.unfinished_tasks and time.monotonic() < limite:
+        time.sleep(0.05)
+    return _cola.unfinished_tasks
+
+atexit.register(vaciar)
+
+def listar(tabla=None, registro_id=None, usuario_id=None, despues_de=None, limite=50):
+    """Eventos de auditoría del más reciente al más antiguo, paginados por id"""
+    condiciones = []
+    parametros = []
+    for columna, valor in (('tabla', tabla), ('registro_id', registro_id), ('usuario_id', usuario_id)):
+        if valor is not None:
+            condiciones.append(f"{columna} = %s")
+            parametros.append(valor)
+    if despues_de is not None:
+        condiciones.append("id < %s")
+        parametros.append(despues_de)
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ''
+    with get_db_cursor(commit=False) as cursor:
+        cursor.execute(
+            f"""SELECT id, fecha, tabla, registro_id, operacion, usuario_id, cambios
+                FROM auditoria {where}
+                ORDER BY id DESC
+                LIMIT %s""",
+            parametros + [limite]
+        )
+        return [
+            {
+                'id': row[0],
+                'fecha': row[1],
+                'tabla': row[2],
+                'registro_id': row[3],
+                'operacion': row[4],
+                'usuario_id': row[5],
+                'cambios': row[6]
+            }
+            for row in cursor.fetchall()
+        ]
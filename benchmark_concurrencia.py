@@ -0,0 +1,282 @@
+"""
+Benchmark de las estrategias de concurrencia de Transaccion.registrar_venta.
+
+Ejecuta N clientes concurrentes vendiendo contra:
+  - un lote "caliente" compartido por todos los clientes (máxima contención)
+  - lotes "fríos", uno por cliente (sin contención)
+  - un lote "fragmentado" compartido, con su stock repartido entre fragmentos
+    (migración 014; --fragmentos, por defecto uno por cliente)
+con concurrencia optimista (columna version) y pesimista (SELECT ... FOR UPDATE).
+
+Reporta throughput, latencias p50/p95/p99, tasa de conflictos y reintentos y el
+tiempo de espera por bloqueo, y guarda los resultados en JSON para compararlos
+entre versiones.
+
+Uso:
+    python benchmark_concurrencia.py --clientes 16 --duracion 10
+    python benchmark_concurrencia.py --estrategias pesimista --escenarios caliente
+    python benchmark_concurrencia.py --escenarios caliente,fragmentado --clientes 16
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+from datetime import datetime
+
+STOCK_INICIAL = 10_000_000
+PREFIJO_LOTE = 'BENCH-'
+
+def parsear_argumentos():
+    parser = argparse.ArgumentParser(description='Benchmark de concurrencia de ventas')
+    parser.add_argument('--clientes', type=int, default=8, help='Clientes concurrentes')
+    parser.add_argument('--duracion', type=float, default=10, help='Segundos por corrida')
+    parser.add_argument('--calentamiento', type=float, default=2, help='Segundos de calentamiento (no se miden)')
+    parser.add_argument('--estrategias', default='optimista,pesimista')
+    parser.add_argument('--escenarios', default='caliente,frio')
+    parser.add_argument('--fragmentos', type=int, default=0,
+                        help='Fragmentos del lote del escenario fragmentado (0: uno por cliente)')
+    parser.add_argument('--cantidad', type=int, default=1, help='Unidades por venta')
+    parser.add_argument('--reintentos', type=int, default=5, help='Reintentos máximos ante conflicto')
+    parser.add_argument('--espera-reintento-ms', type=float, default=0,
+                        help='Espera máxima aleatoria antes de reintentar')
+    parser.add_argument('--usuario', default='admin', help='Usuario que registra las ventas')
+    parser.add_argument('--semilla', type=int, default=42)
+    parser.add_argument('--salida', default='resultados_benchmark', help='Directorio de resultados JSON')
+    parser.add_argument('--conservar', action='store_true', help='No borrar los datos del benchmark')
+    return parser.parse_args()
+
+def percentil(valores_ordenados, p):
+    """Percentil por rango más cercano sobre una lista ya ordenada"""
+    if not valores_ordenados:
+        return None
+    indice = max(0, min(len(valores_ordenados) - 1, int(round(p / 100 * len(valores_ordenados))) - 1))
+    return valores_ordenados[indice]
+
+def resumen_ms(valores):
+    ordenados = sorted(valores)
+    if not ordenados:
+        return {'p50': None, 'p95': None, 'p99': None, 'max': None, 'media': None}
+    return {
+        'p50': round(percentil(ordenados, 50) * 1000, 3),
+        'p95': round(percentil(ordenados, 95) * 1000, 3),
+        'p99': round(percentil(ordenados, 99) * 1000, 3),
+        'max': round(ordenados[-1] * 1000, 3),
+        'media': round(sum(ordenados) / len(ordenados) * 1000, 3)
+    }
+
+def commit_actual():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def preparar_datos(args):
+    """Crear el medicamento y los lotes del benchmark"""
+    from models_inventario import Medicamento, LoteMedicamento
+
+    ejecucion = datetime.now().strftime('%Y%m%d%H%M%S')
+    medicamento_id = Medicamento.crear(
+        nombre=f'Benchmark {ejecucion}', descripcion='Datos temporales de benchmark',
+        principio_activo='Benchmark', categoria='Benchmark', requiere_receta=False
+    )
+
+    def crear_lote(sufijo):
+        return LoteMedicamento.crear(
+            medicamento_id=medicamento_id,
+            numero_lote=f'{PREFIJO_LOTE}{ejecucion}-{sufijo}',
+            cantidad=STOCK_INICIAL, precio_unitario=1.00,
+            fecha_fabricacion='2024-01-01', fecha_caducidad='2099-12-31',
+            proveedor='Benchmark'
+        )
+
+    lotes = {
+        'caliente': [crear_lote('CALIENTE')],
+        'frio': [crear_lote(f'FRIO-{i}') for i in range(args.clientes)]
+    }
+    if 'fragmentado' in args.escenarios.split(','):
+        lotes['fragmentado'] = [crear_lote('FRAGMENTADO')]
+        LoteMedicamento.fragmentar(lotes['fragmentado'][0], args.fragmentos or args.clientes)
+    return medicamento_id, lotes
+
+def limpiar_datos(medicamento_id, lotes):
+    from database import get_db_cursor
+
+    lote_ids = [lote_id for ids in lotes.values() for lote_id in ids]
+    with get_db_cursor() as cursor:
+        cursor.execute("DELETE FROM transacciones WHERE lote_id = ANY(%s)", (lote_ids,))
+        cursor.execute("DELETE FROM lotes_medicamentos WHERE id = ANY(%s)", (lote_ids,))
+        for cola in ('cola_valoracion', 'cola_eventos_inventario'):
+            cursor.execute(
+                f"""DELETE FROM {cola} c USING movimientos_stock m
+                    WHERE c.movimiento_id = m.id AND m.lote_id = ANY(%s)""",
+                (lote_ids,)
+            )
+        cursor.execute("DELETE FROM movimientos_stock WHERE lote_id = ANY(%s)", (lote_ids,))
+        for tabla in ('capas_fifo', 'valoracion_medicamento', 'costo_ventas_diario', 'movimientos_valorados'):
+            cursor.execute(f"DELETE FROM {tabla} WHERE medicamento_id = %s", (medicamento_id,))
+        cursor.execute("DELETE FROM medicamentos WHERE id = %s", (medicamento_id,))
+
+def es_espera_por_bloqueo(sentencia):
+    """Sentencias que adquieren el bloqueo de fila del lote"""
+    texto = str(sentencia).upper()
+    return 'FOR UPDATE' in texto or 'FOR NO KEY UPDATE' in texto or 'UPDATE LOTES_MEDICAMENTOS' in texto
+
+class Cliente(threading.Thread):
+    """Cliente que registra ventas en bucle hasta que se le indica detenerse"""
+
+    def __init__(self, indice, args, lote_id, usuario_id, usar_optimista, inicio_medicion, fin):
+        super().__init__(daemon=True)
+        self.args = args
+        self.lote_id = lote_id
+        self.usuario_id = usuario_id
+        self.usar_optimista = usar_optimista
+        self.inicio_medicion = inicio_medicion
+        self.fin = fin
+        self.random = random.Random(args.semilla * 1000 + indice)
+
+        self.latencias = []
+        self.esperas_bloqueo = []
+        self.ventas = 0
+        self.conflictos = 0
+        self.reintentos = 0
+        self.fallidas = 0
+        self.errores = 0
+
+    def run(self):
+        import metricas
+        from models_inventario import Transaccion
+
+        while time.perf_counter() < self.fin:
+            medir = time.perf_counter() >= self.inicio_medicion
+            metricas.iniciar_contexto()
+            inicio = time.perf_counter()
+            conflictos = 0
+
+            for intento in range(self.args.reintentos + 1):
+                exito, mensaje, _ = Transaccion.registrar_venta(
+                    self.lote_id, self.usuario_id, self.args.cantidad, self.usar_optimista
+                )
+                if exito or not mensaje.startswith('Conflicto'):
+                    break
+                conflictos += 1
+                if self.args.espera_reintento_ms > 0:
+                    time.sleep(self.random.uniform(0, self.args.espera_reintento_ms) / 1000)
+
+            duracion = time.perf_counter() - inicio
+            if not medir:
+                continue
+
+            self.latencias.append(duracion)
+            self.esperas_bloqueo.append(sum(
+                d for sentencia, d, _ in metricas.consultas_actuales() if es_espera_por_bloqueo(sentencia)
+            ))
+            self.conflictos += conflictos
+            self.reintentos += min(conflictos, self.args.reintentos)
+            if exito:
+                self.ventas += 1
+            elif mensaje.startswith('Conflicto'):
+                self.fallidas += 1
+            else:
+                self.errores += 1
+
+def ejecutar_corrida(args, estrategia, escenario, lotes, usuario_id):
+    ahora = time.perf_counter()
+    inicio_medicion = ahora + args.calentamiento
+    fin = inicio_medicion + args.duracion
+
+    clientes = []
+    for i in range(args.clientes):
+        lote_id = lotes['frio'][i] if escenario == 'frio' else lotes[escenario][0]
+        clientes.append(Cliente(i, args, lote_id, usuario_id, estrategia == 'optimista', inicio_medicion, fin))
+
+    for cliente in clientes:
+        cliente.start()
+    for cliente in clientes:
+        cliente.join()
+
+    latencias = [l for c in clientes for l in c.latencias]
+    esperas = [e for c in clientes for e in c.esperas_bloqueo]
+    operaciones = len(latencias)
+    ventas = sum(c.ventas for c in clientes)
+    conflictos = sum(c.conflictos for c in clientes)
+    intentos = operaciones + sum(c.reintentos for c in clientes)
+
+    return {
+        'estrategia': estrategia,
+        'escenario': escenario,
+        'clientes': args.clientes,
+        'duracion_s': args.duracion,
+        'operaciones': operaciones,
+        'ventas': ventas,
+        'throughput_ventas_s': round(ventas / args.duracion, 2),
+        'latencia_ms': resumen_ms(latencias),
+        'conflictos': conflictos,
+        'tasa_conflictos': round(conflictos / intentos, 4) if intentos else 0,
+        'reintentos': sum(c.reintentos for c in clientes),
+        'fallidas_por_conflicto': sum(c.fallidas for c in clientes),
+        'errores': sum(c.errores for c in clientes),
+        'espera_bloqueo_ms': {
+            'total': round(sum(esperas) * 1000, 3),
+            **{k: v for k, v in resumen_ms(esperas).items() if k in ('p50', 'p95', 'p99')}
+        }
+    }
+
+def imprimir_resumen(resultados):
+    print(f"\n{'estrategia':<11} {'escenario':<11} {'ventas/s':>9} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'conflictos':>10} {'reintentos':>10} {'bloqueo p95':>11}")
+    for r in resultados:
+        print(f"{r['estrategia']:<11} {r['escenario']:<11} {r['throughput_ventas_s']:>9} "
+              f"{r['latencia_ms']['p50']:>8} {r['latencia_ms']['p95']:>8} {r['latencia_ms']['p99']:>8} "
+              f"{r['tasa_conflictos']:>10.2%} {r['reintentos']:>10} {r['espera_bloqueo_ms']['p95']:>11}")
+
+def main():
+    args = parsear_argumentos()
+
+    # Una conexión por cliente; dimensionar el pool antes de importar database
+    os.environ.setdefault('POSTGRES_POOL_MAX', str(args.clientes + 2))
+
+    from database import get_db_cursor
+
+    with get_db_cursor(commit=False) as cursor:
+        cursor.execute("SELECT id FROM usuarios WHERE username = %s", (args.usuario,))
+        fila = cursor.fetchone()
+    if not fila:
+        print(f"✗ El usuario '{args.usuario}' no existe")
+        return
+    usuario_id = fila[0]
+
+    print("🔧 Preparando datos del benchmark...")
+    medicamento_id, lotes = preparar_datos(args)
+
+    resultados = []
+    try:
+        for escenario in args.escenarios.split(','):
+            for estrategia in args.estrategias.split(','):
+                print(f"▶ {estrategia} / {escenario}: {args.clientes} clientes, {args.duracion}s")
+                resultados.append(ejecutar_corrida(args, estrategia, escenario, lotes, usuario_id))
+    finally:
+        if not args.conservar:
+            limpiar_datos(medicamento_id, lotes)
+
+    imprimir_resumen(resultados)
+
+    os.makedirs(args.salida, exist_ok=True)
+    fecha = datetime.now()
+    ruta = os.path.join(args.salida, f"benchmark_{fecha.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(ruta, 'w', encoding='utf-8') as archivo:
+        json.dump({
+            'fecha': fecha.isoformat(timespec='seconds'),
+            'commit': commit_actual(),
+            'parametros': {k: v for k, v in vars(args).items() if k not in ('salida', 'conservar')},
+            'resultados': resultados
+        }, archivo, indent=2, ensure_ascii=False)
+    print(f"\n✓ Resultados guardados en {ruta}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Caché en memoria con expiración por tiempo (TTL).
+
+Es por proceso: cada worker de gunicorn mantiene la suya, así que un valor
+puede tardar hasta ttl segundos en refrescarse en todos los workers.
+"""
+import os
+import threading
+import time
+
+CACHE_TTL = float(os.getenv('CACHE_TTL', '300'))
+CACHE_MAX_ENTRADAS = int(os.getenv('CACHE_MAX_ENTRADAS', '1000'))
+
+class CacheTTL:
+    """Diccionario con expiración por entrada, seguro entre hilos"""
+
+    def __init__(self, ttl=CACHE_TTL, max_entradas=CACHE_MAX_ENTRADAS):
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        self._lock = threading.Lock()
+        self._entradas = {}
+
+    def obtener(self, clave):
+        """Valor guardado o None si no existe o expiró"""
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is None:
+                return None
+            expira, valor = entrada
+            if expira < time.monotonic():
+                del self._entradas[clave]
+                return None
+            return valor
+
+    def guardar(self, clave, valor, ttl=None):
+        with self._lock:
+            if len(self._entradas) >= self.max_entradas:
+                self._purgar()
+            self._entradas[clave] = (time.monotonic() + (self.ttl if ttl is None else ttl), valor)
+
+    def obtener_o_calcular(self, clave, funcion, ttl=None):
+        """Retornar el valor guardado o calcularlo con funcion() y guardarlo"""
+        valor = self.obtener(clave)
+        if valor is None:
+            valor = funcion()
+            self.guardar(clave, valor, ttl)
+        return valor
+
+    def invalidar(self, clave=None):
+        """Eliminar una entrada, o todas si no se indica clave"""
+        with self._lock:
+            if clave is None:
+                self._entradas.clear()
+            else:
+                self._entradas.pop(clave, None)
+
+    def _purgar(self):
+        # Primero las expiradas; si no basta, las que expiran antes
+        ahora = time.monotonic()
+        for clave in [c for c, (expira, _) in self._entradas.items() if expira < ahora]:
+            del self._entradas[clave]
+        if len(self._entradas) >= self.max_entradas:
+            sobrantes = sorted(self._entradas, key=lambda c: self._entradas[c][0])
+            for clave in sobrantes[:len(self._entradas) - self.max_entradas + 1]:
+                del self._entradas[clave]
@@ -5,6 +5,7 @@ from datetime import datetime, timedelta
 from models_auth import Usuario
 from models_inventario import Medicamento, LoteMedicamento, Transaccion
 from models_ensayos import EnsayoClinico
+from models_interacciones import Interaccion
 
 def crear_datos_prueba():
     """Crear datos de prueba para el sistema"""
@@ -153,8 +154,26 @@ def crear_datos_prueba():
         except Exception as e:
             print(f"ℹ {lote_data['numero_lote']}: {str(e)}")
 
-    # 4. Crear ensayos clínicos
-    print("\n4. Creando ensayos clínicos...")
+    # 4. Crear interacciones entre medicamentos
+    print("\n4. Creando interacciones...")
+    por_nombre = {m['nombre']: m['id'] for m in medicamentos}
+    interacciones_data = [
+        ('Ibuprofeno 400mg', 'Losartán 50mg', 'farmacodinámica', 'moderada',
+         'Los AINE reducen el efecto antihipertensivo y aumentan el riesgo de daño renal'),
+        ('Paracetamol 500mg', 'Ibuprofeno 400mg', 'aditiva', 'leve',
+         'Uso combinado frecuente; vigilar la dosis total diaria'),
+    ]
+    for nombre_1, nombre_2, tipo, severidad, descripcion in interacciones_data:
+        if nombre_1 not in por_nombre or nombre_2 not in por_nombre:
+            continue
+        try:
+            Interaccion.crear(por_nombre[nombre_1], por_nombre[nombre_2], tipo, severidad, descripcion)
+            print(f"✓ Interacción creada: {nombre_1} + {nombre_2}")
+        except Exception as e:
+            print(f"ℹ {nombre_1} + {nombre_2}: {str(e)}")
+
+    # 5. Crear ensayos clínicos
+    print("\n5. Creando ensayos clínicos...")
 
     if len(medicamentos) >= 2:
         ensayo1_data = {
@@ -1,11 +1,24 @@
 import os
+import re
+import sys
+import time
+import random
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+from functools import wraps
 from dotenv import load_dotenv
-from psycopg2 import pool
+from psycopg2 import pool, extensions, errors
 from pymongo import MongoClient
 from contextlib import contextmanager
 
+import metricas
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Configuración de PostgreSQL
 POSTGRES_CONFIG = {
     'host': os.getenv('POSTGRES_HOST', 'localhost'),
@@ -15,26 +28,283 @@ POSTGRES_CONFIG = {
     'password': os.getenv('POSTGRES_PASSWORD', 'your_password_here')
 }
 
-# Pool de conexiones PostgreSQL
-try:
-    postgres_pool = pool.SimpleConnectionPool(1, 20, **POSTGRES_CONFIG)
-    print("✓ PostgreSQL connection pool created successfully")
-except Exception as e:
-    print(f"✗ Error creating PostgreSQL pool: {e}")
-    postgres_pool = None
+# Tamaño del pool: cada hilo de un worker usa como máximo una conexión
+POSTGRES_POOL_MIN = int(os.getenv('POSTGRES_POOL_MIN', '1'))
+POSTGRES_POOL_MAX = int(os.getenv('POSTGRES_POOL_MAX', '20'))
+# Conexiones del pool que quedan para los hilos de fondo del worker (escritor
+# de auditoría, planificador de tareas) además de los hilos de gunicorn
+POSTGRES_POOL_RESERVA = int(os.getenv('POSTGRES_POOL_RESERVA', '4'))
+# Segundos que una petición espera una conexión con el pool agotado antes de fallar
+POSTGRES_POOL_ESPERA = float(os.getenv('POSTGRES_POOL_ESPERA', '5'))
 
 # Configuración de MongoDB
 MONGODB_URI = os.getenv('MONGODB_URI', 'mongodb://localhost:27017/')
 MONGODB_DB = os.getenv('MONGODB_DB', 'pharmaflow')
 
-try:
-    mongo_client = MongoClient(MONGODB_URI)
-    mongo_db = mongo_client[MONGODB_DB]
-    print("✓ MongoDB connected successfully")
-except Exception as e:
-    print(f"✗ Error connecting to MongoDB: {e}")
-    mongo_client = None
-    mongo_db = None
+# Registro de consultas lentas (SLOW_QUERY_MS < 0 lo desactiva)
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '200'))
+# Fracción de consultas lentas a las que se captura el plan con EXPLAIN
+EXPLAIN_SAMPLE_RATE = float(os.getenv('EXPLAIN_SAMPLE_RATE', '0'))
+SLOW_QUERY_BUFFER = int(os.getenv('SLOW_QUERY_BUFFER', '100'))
+
+# Espera máxima por un bloqueo de fila en las operaciones de stock (lock_timeout; 0 sin límite)
+BLOQUEO_TIMEOUT_MS = int(os.getenv('BLOQUEO_TIMEOUT_MS', '2000'))
+# Reintentos de una transacción que agotó esa espera o se interbloqueó, y espera base entre ellos
+BLOQUEO_REINTENTOS = int(os.getenv('BLOQUEO_REINTENTOS', '3'))
+BLOQUEO_ESPERA_MS = float(os.getenv('BLOQUEO_ESPERA_MS', '50'))
+
+# Errores tras los que conviene repetir la transacción completa
+ERRORES_BLOQUEO = (errors.LockNotAvailable, errors.DeadlockDetected)
+
+# Filas que trae cada viaje de un cursor del lado del servidor (iterar_consulta)
+FILAS_POR_LOTE = int(os.getenv('FILAS_POR_LOTE', '1000'))
+
+# Preparar (PREPARE) una vez por conexión las sentencias fijas de los modelos
+# que se ejecutan con ejecutar_preparada; 0 las envía siempre como texto
+SENTENCIAS_PREPARADAS = os.getenv('SENTENCIAS_PREPARADAS', '1') == '1'
+
+# Parámetros que nunca se escriben en el log
+CAMPOS_SENSIBLES = ('password', 'token', 'email', 'secret')
+
+# Últimas consultas lentas de este proceso (buffer circular)
+consultas_lentas = deque(maxlen=SLOW_QUERY_BUFFER)
+
+postgres_pool = None
+mongo_client = None
+mongo_db = None
+
+class ConexionPreparada(extensions.connection):
+    """
+    Conexión del pool que recuerda qué sentencias tiene preparadas su sesión.
+    Una conexión nueva (también la que el pool abre para reemplazar a una
+    caída, o las de un worker después de fork) empieza sin ninguna.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # nombre registrado -> nombre de la sentencia en esta sesión
+        self.preparadas = {}
+        self.generacion = 0
+
+    def invalidar_preparadas(self):
+        """Olvidar las sentencias preparadas; se vuelven a preparar con otro nombre"""
+        self.preparadas.clear()
+        self.generacion += 1
+
+class CursorInstrumentado(extensions.cursor):
+    """Cursor que registra sentencia, duración y filas de cada consulta"""
+
+    def execute(self, query, vars=None):
+        return self.ejecutar_como(query, vars, query, vars)
+
+    def ejecutar_como(self, query, vars, sentencia, parametros):
+        """
+        Ejecutar query registrando en las métricas y en el log de consultas
+        lentas la sentencia y los parámetros indicados (los originales de un EXECUTE)
+        """
+        inicio = time.perf_counter()
+        exito = False
+        try:
+            resultado = super().execute(query, vars)
+            exito = True
+            return resultado
+        finally:
+            duracion = time.perf_counter() - inicio
+            metricas.registrar_consulta(sentencia, duracion, self.rowcount)
+            if SLOW_QUERY_MS >= 0 and duracion * 1000 >= SLOW_QUERY_MS:
+                _registrar_consulta_lenta(self, sentencia, parametros, duracion, exito)
+
+    def executemany(self, query, vars_list):
+        inicio = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            metricas.registrar_consulta(query, time.perf_counter() - inicio, self.rowcount)
+
+def _metodo_llamador():
+    """Método del modelo (o función) que originó la consulta"""
+    frame = sys._getframe(2)
+    respaldo = None
+    while frame is not None:
+        modulo = frame.f_globals.get('__name__', '')
+        codigo = frame.f_code
+        nombre = f"{modulo}.{getattr(codigo, 'co_qualname', codigo.co_name)}"
+        if modulo.startswith('models_'):
+            return nombre
+        if respaldo is None and modulo not in (__name__, 'contextlib', 'metricas'):
+            respaldo = nombre
+        frame = frame.f_back
+    return respaldo or 'desconocido'
+
+def _recortar(valor, limite=200):
+    if isinstance(valor, (list, tuple)) and len(valor) > 10:
+        return f"{[_recortar(v) for v in valor[:10]]} ... ({len(valor)} elementos)"
+    texto = repr(valor)
+    return texto if len(texto) <= limite else texto[:limite] + '...'
+
+def _redactar_parametros(sentencia, parametros):
+    """Parámetros listos para el log, ocultando los que pueden ser sensibles"""
+    if parametros is None:
+        return None
+    sensible = any(campo in str(sentencia).lower() for campo in CAMPOS_SENSIBLES)
+    if isinstance(parametros, dict):
+        return {
+            clave: '***' if (sensible and isinstance(valor, (str, bytes)))
+                   or any(campo in clave.lower() for campo in CAMPOS_SENSIBLES)
+                   else _recortar(valor)
+            for clave, valor in parametros.items()
+        }
+    return [
+        '***' if sensible and isinstance(valor, (str, bytes)) else _recortar(valor)
+        for valor in parametros
+    ]
+
+def _capturar_plan(cursor, query, vars):
+    """
+    Ejecutar EXPLAIN de la consulta en la misma conexión, dentro de un savepoint
+    para no abortar la transacción si falla. Sin ANALYZE: ANALYZE ejecutaría la
+    consulta otra vez, y un SELECT que llama a una función con efectos
+    (fusionar_fragmentos, nextval...) o un WITH ... UPDATE los aplicaría dos veces.
+    """
+    texto = query if isinstance(query, str) else query.as_string(cursor)
+    conn = cursor.connection
+    usar_savepoint = not conn.autocommit
+    explain = conn.cursor(cursor_factory=extensions.cursor)
+    try:
+        if usar_savepoint:
+            explain.execute("SAVEPOINT captura_plan")
+        explain.execute('EXPLAIN ' + texto, vars)
+        plan = '\n'.join(fila[0] for fila in explain.fetchall())
+        if usar_savepoint:
+            explain.execute("RELEASE SAVEPOINT captura_plan")
+        return plan
+    except Exception as e:
+        if usar_savepoint:
+            try:
+                explain.execute("ROLLBACK TO SAVEPOINT captura_plan")
+            except Exception:
+                pass
+        return f"No se pudo obtener el plan: {e}"
+    finally:
+        explain.close()
+
+def _registrar_consulta_lenta(cursor, query, vars, duracion, exito):
+    """Registrar en el log y en el buffer circular una consulta lenta"""
+    try:
+        texto = ' '.join((query if isinstance(query, str) else query.as_string(cursor)).split())
+        parametros = _redactar_parametros(texto, vars)
+        origen = _metodo_llamador()
+        logger.warning(
+            "Consulta lenta (%.1f ms) en %s: %s | parámetros=%s",
+            duracion * 1000, origen, texto, parametros
+        )
+
+        plan = None
+        if exito and EXPLAIN_SAMPLE_RATE > 0 and random.random() < EXPLAIN_SAMPLE_RATE:
+            plan = _capturar_plan(cursor, query, vars)
+
+        consultas_lentas.append({
+            'fecha': datetime.now(),
+            'duracion_ms': round(duracion * 1000, 1),
+            'origen': origen,
+            'sentencia': texto,
+            'parametros': parametros,
+            'plan': plan
+        })
+    except Exception as e:
+        logger.error("No se pudo registrar la consulta lenta: %s", e)
+
+def obtener_consultas_lentas():
+    """Consultas lentas registradas por este proceso, de la más reciente a la más antigua"""
+    return list(reversed(consultas_lentas))
+
+class PoolConEspera(pool.ThreadedConnectionPool):
+    """
+    ThreadedConnectionPool que, agotado, espera hasta POSTGRES_POOL_ESPERA
+    segundos a que otro hilo devuelva una conexión (psycopg2 lanza PoolError
+    de inmediato). Si no llega ninguna, PoolError.
+    """
+
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        self._libres = threading.BoundedSemaphore(maxconn)
+        super().__init__(minconn, maxconn, *args, **kwargs)
+
+    def getconn(self, key=None):
+        inicio = time.perf_counter()
+        if not self._libres.acquire(timeout=POSTGRES_POOL_ESPERA):
+            metricas.registro.incrementar(
+                'pharmaflow_pool_agotado_total', {},
+                ayuda='Peticiones de conexión que agotaron POSTGRES_POOL_ESPERA'
+            )
+            raise pool.PoolError(f"Pool de conexiones agotado tras esperar {POSTGRES_POOL_ESPERA} s")
+        metricas.registro.observar(
+            'pharmaflow_espera_pool_segundos', {}, time.perf_counter() - inicio,
+            ayuda='Espera por una conexión libre del pool'
+        )
+        try:
+            return super().getconn(key)
+        except Exception:
+            self._libres.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        super().putconn(conn, key, close)
+        self._libres.release()
+
+def crear_pool_postgres():
+    """Crear el pool de conexiones PostgreSQL (seguro entre hilos)"""
+    global postgres_pool
+    try:
+        postgres_pool = PoolConEspera(
+            POSTGRES_POOL_MIN, POSTGRES_POOL_MAX,
+            connection_factory=ConexionPreparada, cursor_factory=CursorInstrumentado,
+            **POSTGRES_CONFIG
+        )
+        print("✓ PostgreSQL connection pool created successfully")
+    except Exception as e:
+        print(f"✗ Error creating PostgreSQL pool: {e}")
+        postgres_pool = None
+
+def conectar_mongodb():
+    """Crear el cliente de MongoDB"""
+    global mongo_client, mongo_db
+    try:
+        mongo_client = MongoClient(
+            MONGODB_URI, event_listeners=[metricas.MonitorComandosMongo()]
+        )
+        mongo_db = mongo_client[MONGODB_DB]
+        print("✓ MongoDB connected successfully")
+    except Exception as e:
+        print(f"✗ Error connecting to MongoDB: {e}")
+        mongo_client = None
+        mongo_db = None
+
+def cerrar_conexiones():
+    """
+    Cerrar el pool de PostgreSQL y el cliente de MongoDB.
+    Se llama en el proceso maestro antes de hacer fork para que los workers
+    no hereden sockets compartidos.
+    """
+    global postgres_pool, mongo_client, mongo_db
+    if postgres_pool is not None:
+        postgres_pool.closeall()
+        postgres_pool = None
+    if mongo_client is not None:
+        mongo_client.close()
+        mongo_client = None
+        mongo_db = None
+
+def reiniciar_conexiones():
+    """
+    Crear conexiones nuevas en un proceso hijo después de fork.
+    El maestro debe haber llamado antes a cerrar_conexiones(); cerrar desde
+    el hijo un socket heredado terminaría también la sesión del maestro.
+    """
+    crear_pool_postgres()
+    conectar_mongodb()
+
+crear_pool_postgres()
+conectar_mongodb()
 
 # Colecciones de MongoDB
 def get_ensayos_collection():
@@ -76,6 +346,154 @@ def get_db_cursor(commit=True):
         finally:
             cursor.close()
 
+# nombre -> (sentencia, cuerpo con $n, argumentos del EXECUTE, parámetros con nombre en orden o None)
+_sentencias = {}
+_MARCADOR = re.compile(r'%%|%s|%\((\w+)\)s')
+
+def _registrar_sentencia(nombre, sentencia):
+    """Traducir los marcadores de psycopg2 (%s o %(nombre)s) a $1, $2, ..."""
+    nombres = []
+    posicionales = 0
+
+    def numerar(marca):
+        nonlocal posicionales
+        if marca.group(0) == '%%':
+            return '%'
+        if marca.group(1) is None:
+            posicionales += 1
+            return f'${posicionales}'
+        if marca.group(1) not in nombres:
+            nombres.append(marca.group(1))
+        return f'${nombres.index(marca.group(1)) + 1}'
+
+    cuerpo = _MARCADOR.sub(numerar, sentencia)
+    total = len(nombres) or posicionales
+    argumentos = f" ({', '.join(['%s'] * total)})" if total else ''
+    _sentencias[nombre] = (sentencia, cuerpo, argumentos, nombres or None)
+    return _sentencias[nombre]
+
+def ejecutar_preparada(cursor, nombre, sentencia, parametros=None):
+    """
+    Ejecutar una sentencia fija del modelo como sentencia preparada: la
+    primera vez en cada conexión se envía PREPARE (PostgreSQL la analiza una
+    vez) y después solo EXECUTE con los parámetros. El nombre identifica a la
+    sentencia en todo el proceso. Sin SENTENCIAS_PREPARADAS, o con una
+    conexión que no es del pool, se ejecuta como texto.
+    """
+    conn = cursor.connection
+    if not SENTENCIAS_PREPARADAS or not isinstance(conn, ConexionPreparada) \
+            or not isinstance(cursor, CursorInstrumentado):
+        return cursor.execute(sentencia, parametros)
+
+    registrada = _sentencias.get(nombre)
+    if registrada is None:
+        registrada = _registrar_sentencia(nombre, sentencia)
+    elif registrada[0] is not sentencia and registrada[0] != sentencia:
+        raise ValueError(f"La sentencia preparada {nombre} ya está registrada con otro texto")
+    _, cuerpo, argumentos, nombres = registrada
+
+    en_sesion = conn.preparadas.get(nombre)
+    if en_sesion is None:
+        en_sesion = f"{nombre}_{conn.generacion}" if conn.generacion else nombre
+        cursor.execute(f"PREPARE {en_sesion} AS {cuerpo}")
+        conn.preparadas[nombre] = en_sesion
+    valores = [parametros[n] for n in nombres] if nombres else parametros
+    try:
+        return cursor.ejecutar_como(f"EXECUTE {en_sesion}{argumentos}", valores, sentencia, parametros)
+    except (errors.InvalidSqlStatementName, errors.FeatureNotSupported):
+        # La sesión perdió sus sentencias (DISCARD ALL) o cambió el tipo del
+        # resultado tras una migración: se vuelven a preparar en la próxima
+        conn.invalidar_preparadas()
+        raise
+
+def ejecutar_con_bloqueo(cursor, sentencia, parametros, operacion, preparada=None):
+    """
+    Ejecutar una sentencia que bloquea filas de lotes (FOR NO KEY UPDATE) y registrar
+    cuánto tardó, que es sobre todo la espera por el bloqueo. Con preparada
+    (nombre) se ejecuta con ejecutar_preparada.
+    """
+    inicio = time.perf_counter()
+    try:
+        if preparada:
+            ejecutar_preparada(cursor, preparada, sentencia, parametros)
+        else:
+            cursor.execute(sentencia, parametros)
+    finally:
+        metricas.registro.observar(
+            'pharmaflow_espera_bloqueo_segundos', {'operacion': operacion}, time.perf_counter() - inicio,
+            ayuda='Duración de las sentencias que bloquean filas de lotes'
+        )
+
+def reintentar_bloqueos(agotado):
+    """
+    Decorador: repetir la transacción completa cuando agota lock_timeout
+    (LockNotAvailable) o PostgreSQL la aborta por interbloqueo, hasta
+    BLOQUEO_REINTENTOS veces, con una espera aleatoria que se duplica en cada
+    intento (para que los reintentos no vuelvan a coincidir). Si se agotan
+    los reintentos retorna agotado. La función decorada no debe capturar
+    ERRORES_BLOQUEO.
+    """
+    def decorador(funcion):
+        @wraps(funcion)
+        def envoltura(*args, **kwargs):
+            for intento in range(BLOQUEO_REINTENTOS + 1):
+                try:
+                    return funcion(*args, **kwargs)
+                except ERRORES_BLOQUEO as e:
+                    motivo = 'interbloqueo' if isinstance(e, errors.DeadlockDetected) else 'lock_timeout'
+                    metricas.registro.incrementar(
+                        'pharmaflow_bloqueos_fallidos_total', {'operacion': funcion.__name__, 'motivo': motivo},
+                        ayuda='Transacciones abortadas por lock_timeout o interbloqueo'
+                    )
+                    if intento < BLOQUEO_REINTENTOS:
+                        time.sleep(random.uniform(0, BLOQUEO_ESPERA_MS * 2 ** intento) / 1000)
+            metricas.registro.incrementar(
+                'pharmaflow_bloqueos_agotados_total', {'operacion': funcion.__name__},
+                ayuda='Operaciones que agotaron los reintentos por bloqueo'
+            )
+            return agotado
+        return envoltura
+    return decorador
+
+def iterar_consulta(sentencia, parametros=None, tipo=None, lote=FILAS_POR_LOTE):
+    """
+    Generador de las filas de una consulta de lectura con un cursor del lado
+    del servidor: llegan de lote en lote, sin tener el resultado completo en
+    memoria. Con tipo (un registro de filas.py) cada fila se construye como
+    tal. La conexión queda ocupada hasta que el generador se agota o se cierra.
+    """
+    conn = postgres_pool.getconn()
+    try:
+        with conn.cursor('iterar_consulta') as cursor:
+            cursor.itersize = lote
+            cursor.execute(sentencia, parametros)
+            for row in cursor:
+                yield tipo(*row) if tipo else row
+    finally:
+        conn.rollback()
+        postgres_pool.putconn(conn)
+
+def patron_like(texto, prefijo=False):
+    """
+    Patrón '%texto%' (o 'texto%' si prefijo=True) para LIKE/ILIKE con los
+    comodines del texto escapados
+    """
+    escapado = texto.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return escapado + '%' if prefijo else '%' + escapado + '%'
+
+_extensiones = {}
+
+def extension_instalada(cursor, nombre):
+    """
+    Si la extensión de PostgreSQL está instalada en la BD. Se consulta una vez
+    por proceso con el cursor que ya tiene abierto el llamador (sin pedir otra
+    conexión al pool).
+    """
+    if nombre not in _extensiones:
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = %s)", (nombre,))
+        _extensiones[nombre] = cursor.fetchone()[0]
+    return _extensiones[nombre]
+
 def init_mongodb_indexes():
     """Crear índices en MongoDB para optimizar consultas"""
     if mongo_db is not None:
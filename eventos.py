@@ -0,0 +1,176 @@
+"""
+Eventos de inventario en tiempo real (migración 012).
+
+Cada proceso web mantiene una conexión dedicada a PostgreSQL con
+LISTEN inventario_pendiente / LISTEN inventario:
+  - inventario_pendiente (lo emite el trigger de movimientos al confirmar):
+    publica los movimientos pendientes con EventoInventario.publicar()
+  - inventario (lo emite el publicador): lee los eventos nuevos una sola vez
+    y los reparte a los clientes SSE del proceso desde un búfer en memoria
+
+Así, N clientes conectados a un worker cuestan una consulta por publicación,
+no N. Un cliente que se queda atrás del búfer (o que se reconecta con
+Last-Event-ID antiguo) se pone al día leyendo de eventos_inventario.
+
+Cada conexión SSE ocupa un hilo del worker mientras dura: EVENTOS_SSE_MAX
+limita cuántas admite cada proceso (ver threads en gunicorn.conf.py). Los
+consumidores que no necesitan inmediatez pueden usar el feed por cursor
+(/api/inventario/eventos).
+"""
+import json
+import logging
+import os
+import select
+import threading
+import time
+from collections import deque
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+import database
+from models_stock import EventoInventario, EVENTOS_LOTE
+
+logger = logging.getLogger(__name__)
+
+EVENTOS_SSE_MAX = int(os.getenv('EVENTOS_SSE_MAX', '4'))
+EVENTOS_BUFFER = int(os.getenv('EVENTOS_BUFFER', '2000'))
+# Segundos entre latidos de las conexiones SSE (mantienen vivos los proxies)
+EVENTOS_LATIDO = float(os.getenv('EVENTOS_LATIDO', '15'))
+# Sin avisos durante este tiempo se publica igualmente lo que haya pendiente
+EVENTOS_ESPERA = float(os.getenv('EVENTOS_ESPERA', '5'))
+
+class Difusor:
+    """Búfer de los últimos eventos del proceso con espera para los suscriptores"""
+
+    def __init__(self, capacidad=EVENTOS_BUFFER):
+        self.capacidad = capacidad
+        self._condicion = threading.Condition()
+        self._eventos = deque()
+        # El búfer contiene todos los eventos con secuencia > base
+        self.base = None
+        self.ultima = None
+
+    def iniciar(self, secuencia):
+        with self._condicion:
+            if self.base is None:
+                self.base = self.ultima = secuencia
+
+    def agregar(self, eventos):
+        with self._condicion:
+            for evento in eventos:
+                if len(self._eventos) == self.capacidad:
+                    self.base = self._eventos.popleft()['secuencia']
+                self._eventos.append(evento)
+            if eventos:
+                self.ultima = eventos[-1]['secuencia']
+                self._condicion.notify_all()
+
+    def esperar(self, desde, timeout):
+        """
+        Eventos con secuencia > desde, esperando hasta timeout segundos si no
+        hay ninguno. None si desde es anterior al búfer (hay que leer de la BD).
+        """
+        with self._condicion:
+            if self.base is None or desde < self.base:
+                return None
+            if self.ultima <= desde:
+                self._condicion.wait(timeout)
+            return [evento for evento in self._eventos if evento['secuencia'] > desde]
+
+difusor = Difusor()
+_escucha = None
+_lock_escucha = threading.Lock()
+_conexiones_sse = threading.BoundedSemaphore(EVENTOS_SSE_MAX)
+
+def _difundir_nuevos():
+    while True:
+        eventos = EventoInventario.listar(difusor.ultima, limite=EVENTOS_LOTE)
+        difusor.agregar(eventos)
+        if len(eventos) < EVENTOS_LOTE:
+            return
+
+def _escuchar(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("LISTEN inventario_pendiente")
+        cursor.execute("LISTEN inventario")
+    # Lo confirmado mientras no se escuchaba
+    EventoInventario.publicar()
+    _difundir_nuevos()
+    while True:
+        if select.select([conn], [], [], EVENTOS_ESPERA)[0]:
+            conn.poll()
+            canales = {aviso.channel for aviso in conn.notifies}
+            conn.notifies.clear()
+            if 'inventario_pendiente' in canales:
+                EventoInventario.publicar()
+        else:
+            EventoInventario.publicar()
+        _difundir_nuevos()
+
+def _bucle_escucha():
+    espera = 1
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(**database.POSTGRES_CONFIG)
+            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            espera = 1
+            _escuchar(conn)
+        except Exception:
+            logger.exception("Error en la escucha de eventos de inventario; reconexión en %s s", espera)
+        finally:
+            if conn is not None:
+                conn.close()
+        time.sleep(espera)
+        espera = min(espera * 2, 30)
+
+def asegurar_escucha():
+    """Lanzar el hilo de LISTEN del proceso (una vez por proceso, también después de fork)"""
+    global _escucha
+    if _escucha is not None and _escucha.is_alive():
+        return _escucha
+    with _lock_escucha:
+        if _escucha is None or not _escucha.is_alive():
+            difusor.iniciar(EventoInventario.limites()[1] or 0)
+            _escucha = threading.Thread(target=_bucle_escucha, name='escucha-inventario', daemon=True)
+            _escucha.start()
+    return _escucha
+
+def reservar_conexion_sse():
+    """False si el proceso ya atiende EVENTOS_SSE_MAX conexiones SSE"""
+    return _conexiones_sse.acquire(blocking=False)
+
+def liberar_conexion_sse():
+    _conexiones_sse.release()
+
+def _mensaje_sse(evento):
+    return f"id: {evento['secuencia']}\nevent: inventario\ndata: {json.dumps(evento)}\n\n"
+
+def flujo_sse(desde=None, lote_ids=None):
+    """
+    Generador de mensajes SSE a partir de la secuencia desde (None: solo
+    eventos nuevos), opcionalmente solo de los lotes indicados
+    """
+    asegurar_escucha()
+    filtro = set(lote_ids) if lote_ids else None
+    if desde is None:
+        desde = difusor.ultima
+    yield "retry: 3000\n\n"
+    ultimo_envio = time.monotonic()
+    while True:
+        eventos = difusor.esperar(desde, EVENTOS_LATIDO)
+        if eventos is None:
+            eventos = EventoInventario.listar(desde, limite=EVENTOS_LOTE)
+            if not eventos:
+                # Lo que falta entre desde y el búfer ya no está en la BD (purgado):
+                # seguir desde el búfer en lugar de volver a consultar en bucle
+                desde = max(desde, difusor.base)
+        for evento in eventos:
+            desde = evento['secuencia']
+            if filtro is None or evento['lote_id'] in filtro:
+                ultimo_envio = time.monotonic()
+                yield _mensaje_sse(evento)
+        if time.monotonic() - ultimo_envio >= EVENTOS_LATIDO:
+            ultimo_envio = time.monotonic()
+            yield ": latido\n\n"
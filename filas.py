@@ -0,0 +1,51 @@
+"""
+Registros compactos para las filas que devuelven los modelos.
+
+Cada tipo de fila es una clase con __slots__ (sin un diccionario por
+instancia) que se lee como atributo (fila.nombre) o como clave
+(fila['nombre']). Se comporta como un Mapping de solo lectura, así que las
+plantillas, dict(fila), fila.get() y jsonify (con el proveedor JSON de
+app.py) funcionan igual que con los diccionarios que construían los modelos.
+Los valores se guardan tal como llegan de psycopg2: NUMERIC sigue siendo
+Decimal.
+"""
+import keyword
+from collections.abc import Mapping
+from itertools import starmap
+
+class Fila(Mapping):
+    """Base de los registros: acceso por atributo y por clave"""
+    __slots__ = ()
+
+    def __getitem__(self, campo):
+        if campo in self.__slots__:
+            return getattr(self, campo)
+        raise KeyError(campo)
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __repr__(self):
+        valores = ', '.join(f'{campo}={getattr(self, campo)!r}' for campo in self.__slots__)
+        return f'{type(self).__name__}({valores})'
+
+def registro(nombre, campos):
+    """Clase de registro con los campos indicados, en el orden de las columnas"""
+    campos = tuple(campos)
+    invalidos = [campo for campo in campos
+                 if not campo.isidentifier() or keyword.iskeyword(campo) or campo.startswith('_')]
+    if invalidos:
+        raise ValueError(f"Nombres de campo no válidos: {', '.join(invalidos)}")
+    # __init__ posicional generado con los campos (como namedtuple): una
+    # asignación por columna, sin bucles ni setattr por cada fila leída
+    asignaciones = ''.join(f'\n    _fila.{campo} = {campo}' for campo in campos) or '\n    pass'
+    espacio = {}
+    exec(f"def __init__(_fila, {', '.join(campos)}):{asignaciones}", espacio)
+    return type(nombre, (Fila,), {'__slots__': campos, '__init__': espacio['__init__']})
+
+def listar(cursor, tipo):
+    """Filas del cursor como registros (sin la lista intermedia de tuplas de fetchall)"""
+    return list(starmap(tipo, cursor))
@@ -0,0 +1,328 @@
+"""
+Generador de datos sintéticos a gran escala para PharmaFlow Solutions.
+
+A diferencia de crear_datos_prueba.py (unos pocos registros de demostración
+creados uno a uno con los modelos), este script carga volúmenes de producción
+para medir rendimiento:
+  - PostgreSQL con COPY en bloques, repartidos entre varios procesos
+  - MongoDB con insert_many
+
+Distribuciones:
+  - Popularidad sesgada (tipo Zipf): pocos medicamentos concentran la mayoría
+    de los lotes y pocos lotes la mayoría de las transacciones
+  - Caducidades repartidas: lotes caducados, próximos a caducar y vigentes
+  - Ensayos con listas de efectos secundarios de cola larga (hasta cientos)
+
+Con la misma semilla y los mismos parámetros el contenido generado es el mismo
+(los ids dependen del estado de las secuencias). Las transacciones son un
+historial sintético: no se descuentan de cantidad_actual de los lotes.
+
+Uso:
+    python generar_datos_sinteticos.py --lotes 1000000 --transacciones 5000000 --ensayos 200000
+    python generar_datos_sinteticos.py --medicamentos 500 --lotes 20000 --transacciones 100000 --trabajadores 2
+"""
+import argparse
+import io
+import math
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+
+import bcrypt
+import psycopg2
+from pymongo import MongoClient
+
+from database import POSTGRES_CONFIG, MONGODB_URI, MONGODB_DB
+
+PASSWORD_SINTETICA = 'sintetico123'
+
+PRINCIPIOS_ACTIVOS = [
+    ('Paracetamol', 'Analgésico'), ('Ibuprofeno', 'Antiinflamatorio'), ('Naproxeno', 'Antiinflamatorio'),
+    ('Diclofenaco', 'Antiinflamatorio'), ('Ácido acetilsalicílico', 'Analgésico'), ('Tramadol', 'Analgésico'),
+    ('Amoxicilina', 'Antibiótico'), ('Azitromicina', 'Antibiótico'), ('Ciprofloxacino', 'Antibiótico'),
+    ('Cefalexina', 'Antibiótico'), ('Doxiciclina', 'Antibiótico'), ('Claritromicina', 'Antibiótico'),
+    ('Losartán Potásico', 'Antihipertensivo'), ('Enalapril', 'Antihipertensivo'), ('Amlodipino', 'Antihipertensivo'),
+    ('Metoprolol', 'Antihipertensivo'), ('Hidroclorotiazida', 'Diurético'), ('Furosemida', 'Diurético'),
+    ('Loratadina', 'Antihistamínico'), ('Cetirizina', 'Antihistamínico'), ('Desloratadina', 'Antihistamínico'),
+    ('Omeprazol', 'Antiácido'), ('Pantoprazol', 'Antiácido'), ('Ranitidina', 'Antiácido'),
+    ('Metformina', 'Antidiabético'), ('Glibenclamida', 'Antidiabético'), ('Sitagliptina', 'Antidiabético'),
+    ('Atorvastatina', 'Hipolipemiante'), ('Simvastatina', 'Hipolipemiante'), ('Rosuvastatina', 'Hipolipemiante'),
+    ('Sertralina', 'Antidepresivo'), ('Fluoxetina', 'Antidepresivo'), ('Escitalopram', 'Antidepresivo'),
+    ('Salbutamol', 'Broncodilatador'), ('Budesonida', 'Corticoide'), ('Prednisona', 'Corticoide'),
+    ('Levotiroxina', 'Hormona tiroidea'), ('Clonazepam', 'Ansiolítico'), ('Alprazolam', 'Ansiolítico'),
+    ('Warfarina', 'Anticoagulante'), ('Clopidogrel', 'Antiagregante'),
+]
+FORMAS = ['Tabletas', 'Cápsulas', 'Suspensión', 'Jarabe', 'Solución inyectable', 'Crema', 'Gotas']
+DOSIS_MG = [5, 10, 20, 25, 40, 50, 100, 200, 250, 400, 500, 850, 1000]
+PROVEEDORES = ['Laboratorios Farmex', 'Pharma Solutions SA', 'MediPharma Corp', 'BioGen Distribuciones',
+               'Droguería Central', 'Salud Global SA', 'Laboratorios Andinos', 'Genéricos del Norte']
+NOMBRES = ['María', 'José', 'Ana', 'Carlos', 'Lucía', 'Jorge', 'Elena', 'Luis', 'Sofía', 'Miguel',
+           'Valeria', 'Andrés', 'Camila', 'Diego', 'Paula', 'Fernando', 'Daniela', 'Ricardo']
+APELLIDOS = ['García', 'Pérez', 'Martínez', 'López', 'González', 'Rodríguez', 'Sánchez', 'Ramírez',
+             'Torres', 'Flores', 'Rivera', 'Gómez', 'Díaz', 'Morales', 'Herrera', 'Castro']
+FASES = ['Fase I', 'Fase II', 'Fase III', 'Fase IV']
+ESTADOS_ENSAYO = ['en_progreso', 'completado', 'suspendido']
+EFECTOS = ['Náuseas', 'Cefalea', 'Mareo', 'Fatiga', 'Insomnio', 'Somnolencia', 'Erupción cutánea',
+           'Dolor abdominal', 'Diarrea', 'Estreñimiento', 'Taquicardia', 'Hipotensión', 'Prurito',
+           'Boca seca', 'Visión borrosa', 'Ansiedad', 'Dolor muscular', 'Tos', 'Fiebre', 'Edema']
+SEVERIDADES = ['leve', 'leve', 'leve', 'moderada', 'moderada', 'severa']
+FRECUENCIAS = ['rara', 'poco_frecuente', 'frecuente', 'muy_frecuente']
+
+# Multiplicador para repartir los rangos de popularidad entre ids (debe ser primo)
+_MEZCLA = 2654435761
+
+def parsear_argumentos():
+    parser = argparse.ArgumentParser(description='Generador de datos sintéticos a gran escala')
+    parser.add_argument('--usuarios', type=int, default=500)
+    parser.add_argument('--medicamentos', type=int, default=5000)
+    parser.add_argument('--lotes', type=int, default=1_000_000)
+    parser.add_argument('--transacciones', type=int, default=5_000_000)
+    parser.add_argument('--ensayos', type=int, default=200_000)
+    parser.add_argument('--dias-historial', type=int, default=730, help='Antigüedad máxima de las transacciones')
+    parser.add_argument('--trabajadores', type=int, default=4, help='Procesos de carga en paralelo')
+    parser.add_argument('--tamano-bloque', type=int, default=50_000, help='Filas por COPY / insert_many')
+    parser.add_argument('--semilla', type=int, default=42)
+    return parser.parse_args()
+
+def conectar_postgres():
+    return psycopg2.connect(**POSTGRES_CONFIG)
+
+def reservar_ids(cursor, secuencia, cantidad):
+    """Reservar un rango contiguo de ids en la secuencia y retornar el primero"""
+    cursor.execute("SELECT setval(%s, nextval(%s) + %s - 1) - %s + 1",
+                   (secuencia, secuencia, cantidad, cantidad))
+    return cursor.fetchone()[0]
+
+def rango_sesgado(rnd, n):
+    """
+    Rango 0..n-1 con distribución log-uniforme (aprox. Zipf s=1): el rango 0 es
+    el más probable. Se mezcla con un multiplicador primo para que los ids
+    populares no queden todos contiguos.
+    """
+    rango = int(math.exp(rnd.random() * math.log(n + 1))) - 1
+    return (min(rango, n - 1) * _MEZCLA) % n
+
+def precio_lote(semilla, lote_id):
+    """Precio determinista por lote (el mismo en la carga de lotes y de transacciones)"""
+    h = (lote_id * _MEZCLA + semilla * 40503) % 4294967291
+    return round(1 + (h % 50000) / 100, 2)
+
+def _valor_csv(valor):
+    if valor is None:
+        return ''
+    if isinstance(valor, str):
+        return '"' + valor.replace('"', '""') + '"'
+    return str(valor)
+
+def copiar(conn, tabla, columnas, filas):
+    """COPY de una lista de tuplas a la tabla (formato CSV)"""
+    buffer = io.StringIO()
+    for fila in filas:
+        buffer.write(','.join(_valor_csv(v) for v in fila))
+        buffer.write('\n')
+    buffer.seek(0)
+    with conn.cursor() as cursor:
+        cursor.copy_expert(f"COPY {tabla} ({', '.join(columnas)}) FROM STDIN WITH (FORMAT csv)", buffer)
+    conn.commit()
+
+# Tareas de carga (se ejecutan en procesos trabajadores)
+def cargar_lotes(inicio, cantidad, contexto):
+    rnd = random.Random(f"{contexto['semilla']}-lotes-{inicio}")
+    hoy = date.today()
+    filas = []
+    for lote_id in range(inicio, inicio + cantidad):
+        medicamento_id = contexto['medicamento_inicio'] + rango_sesgado(rnd, contexto['medicamentos'])
+        cantidad_inicial = rnd.choice((100, 200, 500, 1000, 2000, 5000))
+        # La mayoría de los lotes tiene stock; algunos están agotados
+        cantidad_actual = 0 if rnd.random() < 0.1 else rnd.randint(1, cantidad_inicial)
+        fabricacion = hoy - timedelta(days=rnd.randint(0, 3 * 365))
+        caducidad = fabricacion + timedelta(days=rnd.randint(180, 5 * 365))
+        filas.append((
+            lote_id, medicamento_id, f'SYN-{lote_id}', cantidad_actual, cantidad_inicial,
+            precio_lote(contexto['semilla'], lote_id), fabricacion.isoformat(), caducidad.isoformat(),
+            rnd.choice(PROVEEDORES)
+        ))
+    conn = conectar_postgres()
+    try:
+        copiar(conn, 'lotes_medicamentos',
+               ['id', 'medicamento_id', 'numero_lote', 'cantidad_actual', 'cantidad_inicial',
+                'precio_unitario', 'fecha_fabricacion', 'fecha_caducidad', 'proveedor'], filas)
+    finally:
+        conn.close()
+    return cantidad
+
+def cargar_transacciones(inicio, cantidad, contexto):
+    rnd = random.Random(f"{contexto['semilla']}-transacciones-{inicio}")
+    ahora = datetime.now()
+    filas = []
+    for _ in range(cantidad):
+        lote_id = contexto['lote_inicio'] + rango_sesgado(rnd, contexto['lotes'])
+        tipo = 'compra' if rnd.random() < 0.05 else 'venta'
+        unidades = rnd.randint(50, 500) if tipo == 'compra' else min(1 + int(rnd.expovariate(0.7)), 20)
+        usuario_id = contexto['usuario_inicio'] + rnd.randrange(contexto['usuarios'])
+        # Más actividad reciente: la antigüedad sigue una distribución triangular
+        dias = int(rnd.triangular(0, contexto['dias_historial'], 0))
+        fecha = (ahora - timedelta(days=dias)).replace(hour=rnd.randint(8, 21), minute=rnd.randint(0, 59),
+                                                       second=rnd.randint(0, 59), microsecond=0)
+        precio_total = round(precio_lote(contexto['semilla'], lote_id) * unidades, 2)
+        filas.append((tipo, lote_id, usuario_id, unidades, precio_total, fecha.isoformat(sep=' ')))
+    conn = conectar_postgres()
+    try:
+        # El resumen diario se reconstruye al final en lugar de fila a fila
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT set_config('pharmaflow.omitir_resumen', 'on', false)")
+        copiar(conn, 'transacciones',
+               ['tipo', 'lote_id', 'usuario_id', 'cantidad', 'precio_total', 'fecha_transaccion'], filas)
+    finally:
+        conn.close()
+    return cantidad
+
+def _efecto_secundario(rnd, inicio_ensayo):
+    return {
+        'descripcion': rnd.choice(EFECTOS),
+        'severidad': rnd.choice(SEVERIDADES),
+        'frecuencia': rnd.choice(FRECUENCIAS),
+        'fecha_reporte': inicio_ensayo + timedelta(days=rnd.randint(1, 700)),
+        'detalles': {
+            'paciente_id': rnd.randint(1, 100_000),
+            'edad': rnd.randint(18, 90),
+            'dosis_mg': rnd.choice(DOSIS_MG),
+            'resuelto': rnd.random() < 0.7
+        }
+    }
+
+def cargar_ensayos(inicio, cantidad, contexto):
+    rnd = random.Random(f"{contexto['semilla']}-ensayos-{inicio}")
+    ahora = datetime.utcnow()
+    documentos = []
+    for i in range(inicio, inicio + cantidad):
+        medicamento_id = contexto['medicamento_inicio'] + rango_sesgado(rnd, contexto['medicamentos'])
+        fecha_inicio = ahora - timedelta(days=rnd.randint(0, 5 * 365))
+        estado = rnd.choice(ESTADOS_ENSAYO)
+        total = rnd.choice((20, 50, 100, 250, 500, 1000, 3000))
+        # Cola larga: la mayoría tiene pocos efectos, algunos cientos
+        num_efectos = min(int(rnd.lognormvariate(2.0, 1.2)), 800)
+        documentos.append({
+            'medicamento_id': medicamento_id,
+            'fase': rnd.choice(FASES),
+            'titulo': f'Ensayo sintético {i} de eficacia y seguridad',
+            'investigador_principal': f'Dr. {rnd.choice(NOMBRES)} {rnd.choice(APELLIDOS)}',
+            'fecha_inicio': fecha_inicio,
+            'fecha_fin': fecha_inicio + timedelta(days=rnd.randint(90, 900)) if estado == 'completado' else None,
+            'estado': estado,
+            'participantes': {'total': total, 'completados': rnd.randint(0, total)},
+            'resultados': {'eficacia': f'{rnd.randint(30, 95)}%'} if estado == 'completado' else {},
+            'efectos_secundarios': [_efecto_secundario(rnd, fecha_inicio) for _ in range(num_efectos)],
+            'notas_investigacion': [
+                {'texto': f'Nota de seguimiento {n + 1}', 'autor': f'Dr. {rnd.choice(APELLIDOS)}',
+                 'fecha': fecha_inicio + timedelta(days=30 * n), 'categoria': 'seguimiento'}
+                for n in range(rnd.randint(0, 10))
+            ],
+            'datos_adicionales': {'sintetico': True, 'grupo_edad': rnd.choice(['18-40', '18-65', '40-70', '65+'])},
+            'fecha_creacion': fecha_inicio,
+            'ultima_modificacion': ahora
+        })
+    cliente = MongoClient(MONGODB_URI)
+    try:
+        cliente[MONGODB_DB].ensayos_clinicos.insert_many(documentos, ordered=False)
+    finally:
+        cliente.close()
+    return cantidad
+
+def ejecutar_en_paralelo(nombre, tarea, total, inicio_ids, contexto, args):
+    """Dividir la carga en bloques y repartirlos entre los procesos trabajadores"""
+    if total <= 0:
+        return
+    inicio_reloj = time.perf_counter()
+    cargados = 0
+    with ProcessPoolExecutor(max_workers=args.trabajadores) as executor:
+        futuros = [
+            executor.submit(tarea, inicio_ids + desplazamiento,
+                            min(args.tamano_bloque, total - desplazamiento), contexto)
+            for desplazamiento in range(0, total, args.tamano_bloque)
+        ]
+        for futuro in as_completed(futuros):
+            cargados += futuro.result()
+            transcurrido = time.perf_counter() - inicio_reloj
+            print(f"\r  {nombre}: {cargados:,}/{total:,} ({cargados / transcurrido:,.0f} filas/s)", end='')
+    print(f"\n✓ {nombre} cargados en {time.perf_counter() - inicio_reloj:.1f}s")
+
+def generar_usuarios(conn, args, inicio):
+    rnd = random.Random(f"{args.semilla}-usuarios")
+    # Todos los usuarios sintéticos comparten password: un solo hash bcrypt
+    password_hash = bcrypt.hashpw(PASSWORD_SINTETICA.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    filas = []
+    for usuario_id in range(inicio, inicio + args.usuarios):
+        rol = rnd.choices(['farmaceutico', 'investigador', 'gerente'], weights=[70, 20, 10])[0]
+        filas.append((usuario_id, f'sint{usuario_id}', password_hash,
+                      f'{rnd.choice(NOMBRES)} {rnd.choice(APELLIDOS)}', f'sint{usuario_id}@pharmaflow.com', rol))
+    copiar(conn, 'usuarios', ['id', 'username', 'password_hash', 'nombre_completo', 'email', 'rol'], filas)
+
+def generar_medicamentos(conn, args, inicio):
+    rnd = random.Random(f"{args.semilla}-medicamentos")
+    filas = []
+    for medicamento_id in range(inicio, inicio + args.medicamentos):
+        principio, categoria = rnd.choice(PRINCIPIOS_ACTIVOS)
+        forma = rnd.choice(FORMAS)
+        nombre = f'{principio} {rnd.choice(DOSIS_MG)}mg {forma}'
+        filas.append((medicamento_id, f'{nombre} #{medicamento_id}'[:100], f'{categoria} en {forma.lower()}',
+                      principio, categoria, rnd.random() < 0.4))
+    copiar(conn, 'medicamentos',
+           ['id', 'nombre', 'descripcion', 'principio_activo', 'categoria', 'requiere_receta'], filas)
+
+def main():
+    args = parsear_argumentos()
+    print("🔧 Generando datos sintéticos...")
+
+    conn = conectar_postgres()
+    try:
+        with conn.cursor() as cursor:
+            usuario_inicio = reservar_ids(cursor, 'usuarios_id_seq', max(args.usuarios, 1))
+            medicamento_inicio = reservar_ids(cursor, 'medicamentos_id_seq', max(args.medicamentos, 1))
+            lote_inicio = reservar_ids(cursor, 'lotes_medicamentos_id_seq', max(args.lotes, 1))
+            # Particiones mensuales para todo el historial generado
+            cursor.execute("SELECT crear_particiones_transacciones(CURRENT_DATE - %s, CURRENT_DATE)",
+                           (args.dias_historial,))
+        conn.commit()
+
+        generar_usuarios(conn, args, usuario_inicio)
+        print(f"✓ {args.usuarios:,} usuarios (password: {PASSWORD_SINTETICA})")
+        generar_medicamentos(conn, args, medicamento_inicio)
+        print(f"✓ {args.medicamentos:,} medicamentos")
+    finally:
+        conn.close()
+
+    contexto = {
+        'semilla': args.semilla,
+        'dias_historial': args.dias_historial,
+        'usuario_inicio': usuario_inicio, 'usuarios': args.usuarios,
+        'medicamento_inicio': medicamento_inicio, 'medicamentos': args.medicamentos,
+        'lote_inicio': lote_inicio, 'lotes': args.lotes,
+    }
+
+    ejecutar_en_paralelo('Lotes', cargar_lotes, args.lotes, lote_inicio, contexto, args)
+    if args.lotes > 0 and args.usuarios > 0:
+        ejecutar_en_paralelo('Transacciones', cargar_transacciones, args.transacciones, 0, contexto, args)
+    # Los documentos de ensayos son pesados: bloques más pequeños para insert_many
+    args.tamano_bloque = min(args.tamano_bloque, 1000)
+    ejecutar_en_paralelo('Ensayos clínicos', cargar_ensayos, args.ensayos, 0, contexto, args)
+
+    conn = conectar_postgres()
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            if args.transacciones > 0:
+                cursor.execute("SELECT reconstruir_resumen_diario_lote(CURRENT_DATE - %s)", (args.dias_historial,))
+                cursor.execute("SELECT consolidar_resumen_diario_medicamento(CURRENT_DATE - %s)", (args.dias_historial,))
+                cursor.execute("SELECT consolidar_resumen_diario_usuario(CURRENT_DATE - %s)", (args.dias_historial,))
+                print("✓ Resúmenes diarios de ventas reconstruidos")
+            cursor.execute("""ANALYZE usuarios, medicamentos, lotes_medicamentos, transacciones,
+                              resumen_diario_lote, resumen_diario_medicamento, resumen_diario_usuario""")
+    finally:
+        conn.close()
+
+    print("Datos sintéticos generados exitosamente!")
+
+if __name__ == "__main__":
+    main()
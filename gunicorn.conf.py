@@ -0,0 +1,63 @@
+"""
+Configuración de gunicorn para PharmaFlow Solutions.
+
+    gunicorn -c gunicorn.conf.py wsgi:application
+
+Reinicio ordenado de workers:    kill -HUP <pid del maestro>
+Despliegue de código nuevo:      kill -USR2 <pid> y después -TERM al maestro viejo
+(con preload_app el código vive en el maestro, por eso HUP no lo recarga).
+Todos los valores se pueden ajustar con variables de entorno.
+"""
+import multiprocessing
+import os
+
+import database
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+
+# Cada hilo usa como máximo una conexión del pool. Los hilos de fondo del
+# worker (escritor de auditoría, planificador) usan también el pool, así que
+# los hilos de gunicorn dejan libres POSTGRES_POOL_RESERVA conexiones; si aun
+# así se agota, la petición espera hasta POSTGRES_POOL_ESPERA segundos.
+# Cada conexión SSE (/api/inventario/eventos/stream) retiene uno de estos hilos
+# mientras el cliente sigue conectado: EVENTOS_SSE_MAX (4 por defecto) debe
+# quedar bastante por debajo de threads para no dejar al worker sin hilos para
+# las demás peticiones. Para admitir más clientes SSE, subir GUNICORN_THREADS
+# y POSTGRES_POOL_MAX junto con EVENTOS_SSE_MAX.
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', str(max(1, database.POSTGRES_POOL_MAX - database.POSTGRES_POOL_RESERVA))))
+
+# Workers: 2 * CPU + 1, limitado para que workers * pool no supere el número
+# de conexiones que PostgreSQL tiene reservadas para la aplicación.
+_conexiones_disponibles = int(os.getenv('POSTGRES_MAX_CONNECTIONS', '100'))
+_workers_por_cpu = multiprocessing.cpu_count() * 2 + 1
+_workers_por_conexiones = max(1, _conexiones_disponibles // database.POSTGRES_POOL_MAX)
+workers = int(os.getenv('GUNICORN_WORKERS', str(min(_workers_por_cpu, _workers_por_conexiones))))
+
+# Cargar la aplicación una sola vez en el maestro (copy-on-write entre workers)
+preload_app = True
+
+# Reciclar workers periódicamente; el jitter evita que todos se reinicien a la vez
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '2000'))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', '200'))
+
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '5'))
+
+accesslog = os.getenv('GUNICORN_ACCESSLOG', '-')
+errorlog = os.getenv('GUNICORN_ERRORLOG', '-')
+loglevel = os.getenv('GUNICORN_LOGLEVEL', 'info')
+
+def when_ready(server):
+    """El maestro ya cargó la app: cerrar sus conexiones antes del primer fork"""
+    database.cerrar_conexiones()
+
+def post_fork(server, worker):
+    """Cada worker abre su propio pool de PostgreSQL y su propio MongoClient"""
+    database.reiniciar_conexiones()
+
+def post_worker_init(worker):
+    """Planificador de tareas en segundo plano (si TAREAS_EN_SEGUNDO_PLANO=1)"""
+    import tareas
+    tareas.iniciar_planificador()
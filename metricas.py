@@ -0,0 +1,272 @@
+"""
+Instrumentación de PharmaFlow Solutions.
+
+- Duración y filas de cada consulta PostgreSQL (ver CursorInstrumentado en database.py)
+- Duración de cada comando MongoDB (monitoreo de comandos de pymongo)
+- Latencia por endpoint y número de consultas por petición (hooks de Flask)
+- Perfilado opcional con cProfile de peticiones lentas
+
+Las métricas se agregan por proceso y se exponen en formato de texto de
+Prometheus en /metrics (cada worker de gunicorn reporta las suyas).
+"""
+import bisect
+import cProfile
+import logging
+import os
+import random
+import threading
+import time
+from collections import Counter
+
+from flask import Response, g, request, session
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+# Límites de los histogramas
+LIMITES_SEGUNDOS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LIMITES_CONSULTAS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# Configuración
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+ALERTA_CONSULTAS_POR_PETICION = int(os.getenv('ALERTA_CONSULTAS_POR_PETICION', '20'))
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_SLOW_MS = float(os.getenv('PROFILE_SLOW_MS', '500'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'perfiles')
+
+OPERACIONES_SQL = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'COPY', 'EXPLAIN'}
+
+class Histograma:
+    """Histograma acumulativo compatible con Prometheus"""
+
+    def __init__(self, limites):
+        self.limites = limites
+        self.conteos = [0] * (len(limites) + 1)
+        self.suma = 0.0
+        self.total = 0
+
+    def observar(self, valor):
+        self.conteos[bisect.bisect_left(self.limites, valor)] += 1
+        self.suma += valor
+        self.total += 1
+
+class RegistroMetricas:
+    """Almacén de histogramas y contadores del proceso, protegido con un lock"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histogramas = {}
+        self._contadores = {}
+        self._ayuda = {}
+
+    def observar(self, nombre, etiquetas, valor, limites=LIMITES_SEGUNDOS, ayuda=''):
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        with self._lock:
+            histograma = self._histogramas.get(clave)
+            if histograma is None:
+                histograma = self._histogramas[clave] = Histograma(limites)
+                self._ayuda.setdefault(nombre, ayuda)
+            histograma.observar(valor)
+
+    def incrementar(self, nombre, etiquetas, valor=1, ayuda=''):
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        with self._lock:
+            self._contadores[clave] = self._contadores.get(clave, 0) + valor
+            self._ayuda.setdefault(nombre, ayuda)
+
+    def exportar(self):
+        """Serializar todas las métricas en formato de texto de Prometheus"""
+        with self._lock:
+            histogramas = sorted(self._histogramas.items())
+            contadores = sorted(self._contadores.items())
+            ayuda = dict(self._ayuda)
+
+        lineas = []
+        ultimo = None
+        for (nombre, etiquetas), valor in contadores:
+            if nombre != ultimo:
+                lineas.append(f'# HELP {nombre} {ayuda.get(nombre, "")}')
+                lineas.append(f'# TYPE {nombre} counter')
+                ultimo = nombre
+            lineas.append(f'{nombre}{_formatear_etiquetas(etiquetas)} {valor}')
+
+        ultimo = None
+        for (nombre, etiquetas), histograma in histogramas:
+            if nombre != ultimo:
+                lineas.append(f'# HELP {nombre} {ayuda.get(nombre, "")}')
+                lineas.append(f'# TYPE {nombre} histogram')
+                ultimo = nombre
+            acumulado = 0
+            for limite, conteo in zip(histograma.limites, histograma.conteos):
+                acumulado += conteo
+                lineas.append(f'{nombre}_bucket{_formatear_etiquetas(etiquetas + (("le", repr(float(limite))),))} {acumulado}')
+            lineas.append(f'{nombre}_bucket{_formatear_etiquetas(etiquetas + (("le", "+Inf"),))} {histograma.total}')
+            lineas.append(f'{nombre}_sum{_formatear_etiquetas(etiquetas)} {histograma.suma}')
+            lineas.append(f'{nombre}_count{_formatear_etiquetas(etiquetas)} {histograma.total}')
+
+        return '\n'.join(lineas) + '\n'
+
+def _formatear_etiquetas(etiquetas):
+    if not etiquetas:
+        return ''
+    partes = []
+    for clave, valor in etiquetas:
+        valor = str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        partes.append(f'{clave}="{valor}"')
+    return '{' + ','.join(partes) + '}'
+
+registro = RegistroMetricas()
+
+# Contexto de la petición actual (por hilo, para que funcione también fuera de Flask)
+_contexto = threading.local()
+
+def iniciar_contexto():
+    """Empezar a acumular las consultas del hilo actual"""
+    _contexto.consultas = []
+    _contexto.comandos_mongo = 0
+
+def consultas_actuales():
+    """Consultas registradas en el hilo actual: lista de (sql, duración, filas)"""
+    return getattr(_contexto, 'consultas', None) or []
+
+def comandos_mongo_actuales():
+    return getattr(_contexto, 'comandos_mongo', 0)
+
+def _operacion(sentencia):
+    if not isinstance(sentencia, str):
+        return 'OTRO'
+    partes = sentencia.lstrip().split(None, 1)
+    operacion = partes[0].upper() if partes else ''
+    return operacion if operacion in OPERACIONES_SQL else 'OTRO'
+
+def registrar_consulta(sentencia, duracion, filas):
+    """Registrar una consulta PostgreSQL ejecutada por el cursor instrumentado"""
+    registro.observar(
+        'pharmaflow_db_query_duration_seconds', {'operacion': _operacion(sentencia)}, duracion,
+        ayuda='Duración de las consultas PostgreSQL'
+    )
+    consultas = getattr(_contexto, 'consultas', None)
+    if consultas is not None:
+        consultas.append((sentencia, duracion, filas))
+
+class MonitorComandosMongo(monitoring.CommandListener):
+    """Listener de pymongo que mide la duración de cada comando"""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._registrar(event, 'ok')
+
+    def failed(self, event):
+        self._registrar(event, 'error')
+
+    def _registrar(self, event, resultado):
+        registro.observar(
+            'pharmaflow_mongo_command_duration_seconds',
+            {'comando': event.command_name, 'resultado': resultado},
+            event.duration_micros / 1_000_000,
+            ayuda='Duración de los comandos MongoDB'
+        )
+        if hasattr(_contexto, 'comandos_mongo'):
+            _contexto.comandos_mongo += 1
+
+# Hooks de Flask
+def _antes_de_peticion():
+    iniciar_contexto()
+    g.inicio_peticion = time.perf_counter()
+    g.perfilador = None
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        perfilador = cProfile.Profile()
+        try:
+            perfilador.enable()
+            g.perfilador = perfilador
+        except ValueError:
+            # Ya hay otro perfilador activo en el intérprete
+            pass
+
+def _despues_de_peticion(response):
+    """Estado y duración hasta la respuesta (sin el tiempo de envío de un streaming)"""
+    if 'inicio_peticion' in g:
+        g.estado_respuesta = response.status_code
+        g.duracion_peticion = time.perf_counter() - g.inicio_peticion
+    return response
+
+def _fin_de_peticion(error=None):
+    """
+    Registrar las métricas de la petición y detener el perfilador. Se ejecuta
+    en teardown_request, también cuando la vista lanzó una excepción no
+    controlada (after_request no se ejecuta y la respuesta es un 500).
+    """
+    inicio = g.pop('inicio_peticion', None)
+    if inicio is None:
+        return
+
+    duracion = g.pop('duracion_peticion', None)
+    if duracion is None:
+        duracion = time.perf_counter() - inicio
+    estado = g.pop('estado_respuesta', 500)
+    endpoint = request.endpoint or 'desconocido'
+    consultas = consultas_actuales()
+
+    registro.observar(
+        'pharmaflow_http_request_duration_seconds',
+        {'endpoint': endpoint, 'metodo': request.method}, duracion,
+        ayuda='Latencia de las peticiones HTTP por endpoint'
+    )
+    registro.incrementar(
+        'pharmaflow_http_requests_total',
+        {'endpoint': endpoint, 'metodo': request.method, 'estado': estado},
+        ayuda='Peticiones HTTP por endpoint y código de estado'
+    )
+    registro.observar(
+        'pharmaflow_db_queries_per_request', {'endpoint': endpoint}, len(consultas),
+        limites=LIMITES_CONSULTAS, ayuda='Consultas PostgreSQL por petición'
+    )
+    registro.observar(
+        'pharmaflow_mongo_commands_per_request', {'endpoint': endpoint}, comandos_mongo_actuales(),
+        limites=LIMITES_CONSULTAS, ayuda='Comandos MongoDB por petición'
+    )
+
+    if len(consultas) >= ALERTA_CONSULTAS_POR_PETICION:
+        repetidas = Counter(str(sentencia) for sentencia, _, _ in consultas).most_common(3)
+        logger.warning(
+            "%s ejecutó %d consultas; más repetidas: %s",
+            endpoint, len(consultas), [(n, ' '.join(s.split())[:120]) for s, n in repetidas]
+        )
+
+    perfilador = g.pop('perfilador', None)
+    if perfilador is not None:
+        perfilador.disable()
+        if duracion * 1000 >= PROFILE_SLOW_MS:
+            _guardar_perfil(perfilador, endpoint, duracion)
+
+def _guardar_perfil(perfilador, endpoint, duracion):
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        nombre = f"{time.strftime('%Y%m%d-%H%M%S')}_{endpoint}_{int(duracion * 1000)}ms_{os.getpid()}.prof"
+        perfilador.dump_stats(os.path.join(PROFILE_DIR, nombre))
+    except OSError as e:
+        logger.error("No se pudo guardar el perfil de %s: %s", endpoint, e)
+
+def _acceso_metricas():
+    """Con METRICS_TOKEN, la cabecera Bearer; sin él (o sin cabecera), la sesión de un gerente"""
+    if METRICS_TOKEN and request.headers.get('Authorization') == f'Bearer {METRICS_TOKEN}':
+        return True
+    if 'user_id' not in session:
+        return False
+    from models_auth import Usuario  # models_auth importa database, que importa este módulo
+    return Usuario.rol_vigente(session['user_id']) == 'gerente'
+
+def vista_metricas():
+    """Endpoint /metrics en formato de texto de Prometheus"""
+    if not _acceso_metricas():
+        return Response('No autorizado\n', status=401, mimetype='text/plain')
+    return Response(registro.exportar(), mimetype='text/plain; version=0.0.4')
+
+def init_app(app):
+    """Registrar los hooks de instrumentación y el endpoint /metrics"""
+    app.before_request(_antes_de_peticion)
+    app.after_request(_despues_de_peticion)
+    app.teardown_request(_fin_de_peticion)
+    app.add_url_rule('/metrics', 'metrics', vista_metricas)
@@ -0,0 +1,89 @@
+-- Estado de caducidad precalculado en lotes_medicamentos
+-- Antes se calculaba con un CASE sobre CURRENT_DATE en vista_inventario para
+-- cada fila, lo que impedía filtrar por estado usando índices.
+
+ALTER TABLE lotes_medicamentos
+    ADD COLUMN IF NOT EXISTS estado_caducidad VARCHAR(20) NOT NULL DEFAULT 'vigente'
+    CHECK (estado_caducidad IN ('vigente', 'proximo_a_caducar', 'caducado'));
+
+-- Tramo de caducidad de una fecha respecto a hoy
+CREATE OR REPLACE FUNCTION calcular_estado_caducidad(fecha DATE)
+RETURNS VARCHAR AS $$
+    SELECT CASE
+        WHEN fecha < CURRENT_DATE THEN 'caducado'
+        WHEN fecha < CURRENT_DATE + INTERVAL '3 months' THEN 'proximo_a_caducar'
+        ELSE 'vigente'
+    END
+$$ LANGUAGE sql STABLE;
+
+-- Asignar el estado al crear un lote o cambiar su fecha de caducidad
+CREATE OR REPLACE FUNCTION asignar_estado_caducidad()
+RETURNS TRIGGER AS $$
+BEGIN
+    NEW.estado_caducidad = calcular_estado_caducidad(NEW.fecha_caducidad);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trigger_lotes_estado_caducidad ON lotes_medicamentos;
+CREATE TRIGGER trigger_lotes_estado_caducidad
+    BEFORE INSERT OR UPDATE OF fecha_caducidad ON lotes_medicamentos
+    FOR EACH ROW
+    EXECUTE FUNCTION asignar_estado_caducidad();
+
+-- Lotes que todavía pueden cambiar de tramo (los caducados ya no cambian)
+CREATE INDEX IF NOT EXISTS idx_lotes_caducidad_pendientes
+    ON lotes_medicamentos(fecha_caducidad) WHERE estado_caducidad <> 'caducado';
+
+-- Conjuntos pequeños que consultan las alertas y el dashboard. El predicado
+-- solo usa estado_caducidad: con cantidad_actual, que cambia en cada venta,
+-- ninguna venta de esos lotes podría ser una actualización HOT. Las consultas
+-- filtran cantidad_actual > 0 por su cuenta.
+CREATE INDEX IF NOT EXISTS idx_lotes_proximos_caducar
+    ON lotes_medicamentos(fecha_caducidad)
+    WHERE estado_caducidad = 'proximo_a_caducar';
+CREATE INDEX IF NOT EXISTS idx_lotes_caducados
+    ON lotes_medicamentos(fecha_caducidad)
+    WHERE estado_caducidad = 'caducado';
+
+-- Tarea diaria: actualizar solo los lotes que cruzaron un umbral desde la última ejecución
+CREATE OR REPLACE FUNCTION recalcular_estados_caducidad()
+RETURNS INTEGER AS $$
+DECLARE
+    filas INTEGER;
+BEGIN
+    UPDATE lotes_medicamentos
+    SET estado_caducidad = calcular_estado_caducidad(fecha_caducidad)
+    WHERE estado_caducidad <> 'caducado'
+      AND fecha_caducidad < CURRENT_DATE + INTERVAL '3 months'
+      AND estado_caducidad <> calcular_estado_caducidad(fecha_caducidad);
+    GET DIAGNOSTICS filas = ROW_COUNT;
+    RETURN filas;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Estado inicial de los lotes existentes
+UPDATE lotes_medicamentos
+SET estado_caducidad = calcular_estado_caducidad(fecha_caducidad)
+WHERE estado_caducidad <> calcular_estado_caducidad(fecha_caducidad);
+
+-- La vista usa la columna precalculada y ya no ordena: cada consulta ordena si lo necesita
+DROP VIEW IF EXISTS vista_inventario;
+CREATE VIEW vista_inventario AS
+SELECT
+    m.id as medicamento_id,
+    m.nombre as medicamento,
+    m.principio_activo,
+    l.id as lote_id,
+    l.numero_lote,
+    l.cantidad_actual,
+    l.precio_unitario,
+    l.fecha_caducidad,
+    l.version,
+    l.estado_caducidad
+FROM medicamentos m
+JOIN lotes_medicamentos l ON m.id = l.medicamento_id
+WHERE l.cantidad_actual > 0;
+
+GRANT ALL PRIVILEGES ON vista_inventario TO gerente;
+GRANT SELECT ON vista_inventario TO farmaceutico, investigador;
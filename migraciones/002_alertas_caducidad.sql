@@ -0,0 +1,47 @@
+-- Alertas de lotes próximos a caducar y caducados
+
+CREATE TABLE IF NOT EXISTS alertas_caducidad (
+    id BIGSERIAL PRIMARY KEY,
+    lote_id INTEGER NOT NULL REFERENCES lotes_medicamentos(id) ON DELETE CASCADE,
+    tipo VARCHAR(20) NOT NULL CHECK (tipo IN ('proximo_a_caducar', 'caducado')),
+    fecha_caducidad DATE NOT NULL,
+    cantidad INTEGER NOT NULL,
+    fecha_alerta TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    atendida BOOLEAN DEFAULT FALSE,
+    UNIQUE (lote_id, tipo)
+);
+
+-- Paginación de alertas pendientes de la más reciente a la más antigua
+CREATE INDEX IF NOT EXISTS idx_alertas_pendientes ON alertas_caducidad(id DESC) WHERE NOT atendida;
+
+-- Marcas de agua de las tareas incrementales (hasta dónde procesó cada una)
+CREATE TABLE IF NOT EXISTS marcas_tareas (
+    tarea VARCHAR(50) PRIMARY KEY,
+    ultima_fecha DATE,
+    ultima_ejecucion TIMESTAMP
+);
+
+-- Un lote creado o con la fecha cambiada que ya está dentro de un umbral no
+-- "cruza" ningún umbral en fechas futuras: su alerta se genera al escribirlo.
+CREATE OR REPLACE FUNCTION generar_alerta_caducidad()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF NEW.estado_caducidad <> 'vigente' AND NEW.cantidad_actual > 0 THEN
+        INSERT INTO alertas_caducidad (lote_id, tipo, fecha_caducidad, cantidad)
+        VALUES (NEW.id, NEW.estado_caducidad, NEW.fecha_caducidad, NEW.cantidad_actual)
+        ON CONFLICT (lote_id, tipo) DO NOTHING;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trigger_lotes_alerta_caducidad ON lotes_medicamentos;
+CREATE TRIGGER trigger_lotes_alerta_caducidad
+    AFTER INSERT OR UPDATE OF fecha_caducidad ON lotes_medicamentos
+    FOR EACH ROW
+    EXECUTE FUNCTION generar_alerta_caducidad();
+
+GRANT ALL PRIVILEGES ON alertas_caducidad, marcas_tareas TO gerente;
+GRANT USAGE ON SEQUENCE alertas_caducidad_id_seq TO gerente;
+GRANT SELECT, UPDATE ON alertas_caducidad TO farmaceutico;
+GRANT SELECT ON alertas_caducidad TO investigador;
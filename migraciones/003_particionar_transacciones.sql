@@ -0,0 +1,169 @@
+-- Particionado mensual de transacciones y resúmenes diarios de ventas
+
+-- Crear las particiones mensuales que cubren [desde, hasta]; retorna las creadas
+CREATE OR REPLACE FUNCTION crear_particiones_transacciones(desde DATE, hasta DATE)
+RETURNS INTEGER AS $$
+DECLARE
+    mes DATE := date_trunc('month', desde);
+    nombre TEXT;
+    creadas INTEGER := 0;
+BEGIN
+    WHILE mes <= hasta LOOP
+        nombre := 'transacciones_' || to_char(mes, 'YYYYMM');
+        IF to_regclass(nombre) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF transacciones FOR VALUES FROM (%L) TO (%L)',
+                nombre, mes, mes + INTERVAL '1 month'
+            );
+            creadas := creadas + 1;
+        END IF;
+        mes := mes + INTERVAL '1 month';
+    END LOOP;
+    RETURN creadas;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Reemplazar la tabla sin particionar (solo la primera vez)
+DO $$
+DECLARE
+    desde DATE;
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = to_regclass('transacciones')) <> 'r' THEN
+        RETURN;
+    END IF;
+
+    ALTER TABLE transacciones RENAME TO transacciones_sin_particionar;
+    ALTER SEQUENCE transacciones_id_seq OWNED BY NONE;
+
+    -- La clave primaria debe incluir la columna de particionado
+    CREATE TABLE transacciones (
+        id INTEGER NOT NULL DEFAULT nextval('transacciones_id_seq'),
+        tipo VARCHAR(10) NOT NULL CHECK (tipo IN ('compra', 'venta')),
+        lote_id INTEGER REFERENCES lotes_medicamentos(id),
+        usuario_id INTEGER REFERENCES usuarios(id),
+        cantidad INTEGER NOT NULL CHECK (cantidad > 0),
+        precio_total NUMERIC(12, 2) NOT NULL,
+        fecha_transaccion TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        notas TEXT,
+        PRIMARY KEY (id, fecha_transaccion)
+    ) PARTITION BY RANGE (fecha_transaccion);
+
+    ALTER SEQUENCE transacciones_id_seq OWNED BY transacciones.id;
+
+    -- Red de seguridad para filas fuera de las particiones creadas
+    CREATE TABLE transacciones_default PARTITION OF transacciones DEFAULT;
+
+    SELECT COALESCE(MIN(fecha_transaccion)::date, CURRENT_DATE) INTO desde FROM transacciones_sin_particionar;
+    PERFORM crear_particiones_transacciones(desde, (CURRENT_DATE + INTERVAL '3 months')::date);
+
+    INSERT INTO transacciones (id, tipo, lote_id, usuario_id, cantidad, precio_total, fecha_transaccion, notas)
+    SELECT id, tipo, lote_id, usuario_id, cantidad, precio_total,
+           COALESCE(fecha_transaccion, CURRENT_TIMESTAMP), notas
+    FROM transacciones_sin_particionar;
+
+    DROP TABLE transacciones_sin_particionar;
+END;
+$$;
+
+CREATE INDEX IF NOT EXISTS idx_transacciones_lote ON transacciones(lote_id);
+CREATE INDEX IF NOT EXISTS idx_transacciones_fecha ON transacciones(fecha_transaccion DESC);
+CREATE INDEX IF NOT EXISTS idx_transacciones_tipo ON transacciones(tipo);
+
+-- Resumen diario por lote, mantenido por trigger en cada transacción
+CREATE TABLE IF NOT EXISTS resumen_diario_lote (
+    fecha DATE NOT NULL,
+    lote_id INTEGER NOT NULL REFERENCES lotes_medicamentos(id) ON DELETE CASCADE,
+    tipo VARCHAR(10) NOT NULL,
+    unidades BIGINT NOT NULL DEFAULT 0,
+    importe NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    transacciones INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (fecha, lote_id, tipo)
+);
+
+-- Resumen diario por medicamento, consolidado por lotes desde resumen_diario_lote
+-- (ver tareas.py) para no serializar las ventas de lotes distintos en la misma fila
+CREATE TABLE IF NOT EXISTS resumen_diario_medicamento (
+    fecha DATE NOT NULL,
+    medicamento_id INTEGER NOT NULL REFERENCES medicamentos(id) ON DELETE CASCADE,
+    tipo VARCHAR(10) NOT NULL,
+    unidades BIGINT NOT NULL DEFAULT 0,
+    importe NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    transacciones INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (fecha, medicamento_id, tipo)
+);
+
+CREATE OR REPLACE FUNCTION acumular_resumen_diario_lote()
+RETURNS TRIGGER AS $$
+BEGIN
+    -- Las cargas masivas lo desactivan y reconstruyen el resumen al final
+    IF current_setting('pharmaflow.omitir_resumen', true) = 'on' OR NEW.lote_id IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    INSERT INTO resumen_diario_lote (fecha, lote_id, tipo, unidades, importe, transacciones)
+    VALUES (NEW.fecha_transaccion::date, NEW.lote_id, NEW.tipo, NEW.cantidad, NEW.precio_total, 1)
+    ON CONFLICT (fecha, lote_id, tipo) DO UPDATE
+    SET unidades = resumen_diario_lote.unidades + EXCLUDED.unidades,
+        importe = resumen_diario_lote.importe + EXCLUDED.importe,
+        transacciones = resumen_diario_lote.transacciones + 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trigger_transacciones_resumen ON transacciones;
+CREATE TRIGGER trigger_transacciones_resumen
+    AFTER INSERT ON transacciones
+    FOR EACH ROW
+    EXECUTE FUNCTION acumular_resumen_diario_lote();
+
+-- Recalcular el resumen por lote desde las transacciones de [desde, hoy]
+CREATE OR REPLACE FUNCTION reconstruir_resumen_diario_lote(desde DATE)
+RETURNS INTEGER AS $$
+DECLARE
+    filas INTEGER;
+BEGIN
+    DELETE FROM resumen_diario_lote WHERE fecha >= desde;
+    INSERT INTO resumen_diario_lote (fecha, lote_id, tipo, unidades, importe, transacciones)
+    SELECT fecha_transaccion::date, lote_id, tipo, SUM(cantidad), SUM(precio_total), COUNT(*)
+    FROM transacciones
+    WHERE fecha_transaccion >= desde AND lote_id IS NOT NULL
+    GROUP BY 1, 2, 3;
+    GET DIAGNOSTICS filas = ROW_COUNT;
+    RETURN filas;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Consolidar el resumen por medicamento de los días >= desde
+CREATE OR REPLACE FUNCTION consolidar_resumen_diario_medicamento(desde DATE)
+RETURNS INTEGER AS $$
+DECLARE
+    filas INTEGER;
+BEGIN
+    DELETE FROM resumen_diario_medicamento WHERE fecha >= desde;
+    INSERT INTO resumen_diario_medicamento (fecha, medicamento_id, tipo, unidades, importe, transacciones)
+    SELECT r.fecha, l.medicamento_id, r.tipo, SUM(r.unidades), SUM(r.importe), SUM(r.transacciones)
+    FROM resumen_diario_lote r
+    JOIN lotes_medicamentos l ON r.lote_id = l.id
+    WHERE r.fecha >= desde
+    GROUP BY 1, 2, 3;
+    GET DIAGNOSTICS filas = ROW_COUNT;
+    RETURN filas;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Carga inicial de los resúmenes (solo si están vacíos)
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM resumen_diario_lote) THEN
+        PERFORM reconstruir_resumen_diario_lote('-infinity');
+        PERFORM consolidar_resumen_diario_medicamento('-infinity');
+    END IF;
+END;
+$$;
+
+GRANT ALL PRIVILEGES ON transacciones, resumen_diario_lote, resumen_diario_medicamento TO gerente;
+GRANT SELECT, INSERT, UPDATE ON transacciones TO farmaceutico;
+GRANT SELECT, INSERT, UPDATE ON resumen_diario_lote TO farmaceutico;
+GRANT SELECT ON resumen_diario_medicamento TO farmaceutico;
+GRANT SELECT ON transacciones, resumen_diario_lote, resumen_diario_medicamento TO investigador;
+GRANT USAGE ON SEQUENCE transacciones_id_seq TO farmaceutico;
@@ -0,0 +1,40 @@
+-- Resumen diario de ventas por usuario para los reportes
+
+-- Se consolida por lotes desde transacciones (ver tareas.py): cada ejecución
+-- solo lee las particiones de los días desde la última consolidación.
+CREATE TABLE IF NOT EXISTS resumen_diario_usuario (
+    fecha DATE NOT NULL,
+    usuario_id INTEGER NOT NULL REFERENCES usuarios(id) ON DELETE CASCADE,
+    tipo VARCHAR(10) NOT NULL,
+    unidades BIGINT NOT NULL DEFAULT 0,
+    importe NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    transacciones INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (fecha, usuario_id, tipo)
+);
+
+CREATE OR REPLACE FUNCTION consolidar_resumen_diario_usuario(desde DATE)
+RETURNS INTEGER AS $$
+DECLARE
+    filas INTEGER;
+BEGIN
+    DELETE FROM resumen_diario_usuario WHERE fecha >= desde;
+    INSERT INTO resumen_diario_usuario (fecha, usuario_id, tipo, unidades, importe, transacciones)
+    SELECT fecha_transaccion::date, usuario_id, tipo, SUM(cantidad), SUM(precio_total), COUNT(*)
+    FROM transacciones
+    WHERE fecha_transaccion >= desde AND usuario_id IS NOT NULL
+    GROUP BY 1, 2, 3;
+    GET DIAGNOSTICS filas = ROW_COUNT;
+    RETURN filas;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM resumen_diario_usuario) THEN
+        PERFORM consolidar_resumen_diario_usuario('-infinity');
+    END IF;
+END;
+$$;
+
+GRANT ALL PRIVILEGES ON resumen_diario_usuario TO gerente;
+GRANT SELECT ON resumen_diario_usuario TO farmaceutico, investigador;
@@ -0,0 +1,133 @@
+-- Libro de movimientos de stock (solo inserción) con cortes periódicos
+
+-- Un movimiento por cada cambio de cantidad_actual, con el saldo resultante.
+-- origen: alta, venta, compra, ajuste, baja o apertura (saldo inicial al migrar)
+CREATE TABLE IF NOT EXISTS movimientos_stock (
+    id BIGSERIAL PRIMARY KEY,
+    lote_id INTEGER NOT NULL,
+    fecha TIMESTAMP NOT NULL DEFAULT clock_timestamp(),
+    cantidad INTEGER NOT NULL,
+    saldo INTEGER NOT NULL,
+    origen VARCHAR(20) NOT NULL,
+    usuario_id INTEGER
+);
+
+-- Sin clave foránea a lotes_medicamentos: el libro conserva la historia de
+-- los lotes eliminados (su último movimiento es la baja con saldo 0).
+CREATE INDEX IF NOT EXISTS idx_movimientos_lote ON movimientos_stock(lote_id, id DESC);
+-- Las filas se insertan en orden de fecha: BRIN ocupa unos pocos KB
+CREATE INDEX IF NOT EXISTS idx_movimientos_fecha ON movimientos_stock USING BRIN (fecha);
+
+-- Cortes: saldo de cada lote con stock en una fecha
+CREATE TABLE IF NOT EXISTS cortes_stock (
+    id SERIAL PRIMARY KEY,
+    fecha TIMESTAMP NOT NULL UNIQUE,
+    fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS cortes_stock_detalle (
+    corte_id INTEGER NOT NULL REFERENCES cortes_stock(id) ON DELETE CASCADE,
+    lote_id INTEGER NOT NULL,
+    saldo INTEGER NOT NULL,
+    PRIMARY KEY (corte_id, lote_id)
+);
+
+-- Las operaciones indican origen y usuario con set_config('pharmaflow.origen', ...)
+-- y set_config('pharmaflow.usuario_id', ...) locales a la transacción.
+CREATE OR REPLACE FUNCTION registrar_movimiento_stock()
+RETURNS TRIGGER AS $$
+DECLARE
+    v_origen TEXT := NULLIF(current_setting('pharmaflow.origen', true), '');
+    v_usuario INTEGER := NULLIF(current_setting('pharmaflow.usuario_id', true), '')::INTEGER;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO movimientos_stock (lote_id, cantidad, saldo, origen, usuario_id)
+        VALUES (NEW.id, NEW.cantidad_actual, NEW.cantidad_actual, COALESCE(v_origen, 'alta'), v_usuario);
+    ELSIF TG_OP = 'UPDATE' THEN
+        IF NEW.cantidad_actual IS DISTINCT FROM OLD.cantidad_actual THEN
+            INSERT INTO movimientos_stock (lote_id, cantidad, saldo, origen, usuario_id)
+            VALUES (NEW.id, NEW.cantidad_actual - OLD.cantidad_actual, NEW.cantidad_actual,
+                    COALESCE(v_origen, 'ajuste'), v_usuario);
+        END IF;
+    ELSE
+        INSERT INTO movimientos_stock (lote_id, cantidad, saldo, origen, usuario_id)
+        VALUES (OLD.id, -OLD.cantidad_actual, 0, COALESCE(v_origen, 'baja'), v_usuario);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trigger_lotes_movimiento_stock ON lotes_medicamentos;
+CREATE TRIGGER trigger_lotes_movimiento_stock
+    AFTER INSERT OR UPDATE OF cantidad_actual OR DELETE ON lotes_medicamentos
+    FOR EACH ROW
+    EXECUTE FUNCTION registrar_movimiento_stock();
+
+-- Saldo de cada lote en una fecha: el corte anterior más reciente más los
+-- movimientos posteriores a él (cada movimiento lleva el saldo del lote).
+CREATE OR REPLACE FUNCTION stock_en_fecha(p_fecha TIMESTAMP)
+RETURNS TABLE (lote_id INTEGER, saldo INTEGER) AS $$
+    WITH corte AS (
+        -- Estrictamente anterior: crear_corte_stock consulta con su propio corte ya insertado
+        SELECT id, fecha FROM cortes_stock
+        WHERE fecha < p_fecha
+        ORDER BY fecha DESC
+        LIMIT 1
+    ),
+    delta AS (
+        SELECT DISTINCT ON (m.lote_id) m.lote_id, m.saldo
+        FROM movimientos_stock m
+        WHERE m.fecha > COALESCE((SELECT fecha FROM corte), '-infinity')
+          AND m.fecha <= p_fecha
+        ORDER BY m.lote_id, m.id DESC
+    )
+    SELECT lote_id, saldo FROM delta
+    UNION ALL
+    SELECT d.lote_id, d.saldo
+    FROM cortes_stock_detalle d
+    WHERE d.corte_id = (SELECT id FROM corte)
+      AND NOT EXISTS (SELECT 1 FROM delta WHERE delta.lote_id = d.lote_id)
+$$ LANGUAGE sql STABLE;
+
+-- Crear el corte de la fecha indicada (solo lotes con saldo distinto de 0).
+-- La fecha debe quedar unos minutos en el pasado para que ya estén
+-- confirmadas todas las transacciones con movimientos anteriores a ella.
+CREATE OR REPLACE FUNCTION crear_corte_stock(p_fecha TIMESTAMP)
+RETURNS INTEGER AS $$
+DECLARE
+    v_corte INTEGER;
+BEGIN
+    INSERT INTO cortes_stock (fecha) VALUES (p_fecha)
+    ON CONFLICT (fecha) DO NOTHING
+    RETURNING id INTO v_corte;
+    IF v_corte IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    INSERT INTO cortes_stock_detalle (corte_id, lote_id, saldo)
+    SELECT v_corte, s.lote_id, s.saldo
+    FROM stock_en_fecha(p_fecha) s
+    WHERE s.saldo <> 0;
+    RETURN v_corte;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Saldo de apertura de los lotes existentes (solo la primera vez)
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM movimientos_stock) THEN
+        INSERT INTO movimientos_stock (lote_id, cantidad, saldo, origen)
+        SELECT id, cantidad_actual, cantidad_actual, 'apertura'
+        FROM lotes_medicamentos
+        ORDER BY id;
+    END IF;
+END;
+$$;
+
+-- El libro es de solo inserción para los roles de la aplicación
+GRANT SELECT, INSERT ON movimientos_stock TO gerente, farmaceutico;
+GRANT SELECT ON movimientos_stock TO investigador;
+GRANT USAGE ON SEQUENCE movimientos_stock_id_seq TO gerente, farmaceutico;
+GRANT ALL PRIVILEGES ON cortes_stock, cortes_stock_detalle TO gerente;
+GRANT USAGE ON SEQUENCE cortes_stock_id_seq TO gerente;
+GRANT SELECT ON cortes_stock, cortes_stock_detalle TO farmaceutico, investigador;
@@ -0,0 +1,94 @@
+-- Valoración de inventario (FIFO y costo promedio ponderado) a partir del libro de movimientos
+
+-- Cada movimiento guarda el medicamento y el costo unitario del lote en ese momento
+ALTER TABLE movimientos_stock ADD COLUMN IF NOT EXISTS medicamento_id INTEGER;
+ALTER TABLE movimientos_stock ADD COLUMN IF NOT EXISTS costo_unitario NUMERIC(10, 2);
+
+-- Movimientos pendientes de aplicar a la valoración (los consume models_valoracion.py)
+CREATE TABLE IF NOT EXISTS cola_valoracion (
+    movimiento_id BIGINT PRIMARY KEY
+);
+
+-- Valor del inventario por medicamento según cada método
+CREATE TABLE IF NOT EXISTS valoracion_medicamento (
+    medicamento_id INTEGER PRIMARY KEY,
+    unidades BIGINT NOT NULL DEFAULT 0,
+    valor_promedio NUMERIC(16, 4) NOT NULL DEFAULT 0,
+    valor_fifo NUMERIC(16, 4) NOT NULL DEFAULT 0,
+    ultimo_movimiento_id BIGINT,
+    actualizado TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Capas de costo FIFO con unidades restantes (las agotadas se eliminan)
+CREATE TABLE IF NOT EXISTS capas_fifo (
+    id BIGSERIAL PRIMARY KEY,
+    medicamento_id INTEGER NOT NULL,
+    movimiento_id BIGINT NOT NULL,
+    cantidad_restante INTEGER NOT NULL CHECK (cantidad_restante > 0),
+    costo_unitario NUMERIC(10, 2) NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_capas_fifo_medicamento ON capas_fifo(medicamento_id, id);
+
+-- Costo de lo vendido por día y medicamento según cada método
+CREATE TABLE IF NOT EXISTS costo_ventas_diario (
+    fecha DATE NOT NULL,
+    medicamento_id INTEGER NOT NULL,
+    unidades BIGINT NOT NULL DEFAULT 0,
+    costo_promedio NUMERIC(16, 4) NOT NULL DEFAULT 0,
+    costo_fifo NUMERIC(16, 4) NOT NULL DEFAULT 0,
+    PRIMARY KEY (fecha, medicamento_id)
+);
+
+CREATE OR REPLACE FUNCTION registrar_movimiento_stock()
+RETURNS TRIGGER AS $$
+DECLARE
+    v_origen TEXT := NULLIF(current_setting('pharmaflow.origen', true), '');
+    v_usuario INTEGER := NULLIF(current_setting('pharmaflow.usuario_id', true), '')::INTEGER;
+    v_movimiento BIGINT;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO movimientos_stock (lote_id, medicamento_id, cantidad, saldo, costo_unitario, origen, usuario_id)
+        VALUES (NEW.id, NEW.medicamento_id, NEW.cantidad_actual, NEW.cantidad_actual, NEW.precio_unitario,
+                COALESCE(v_origen, 'alta'), v_usuario)
+        RETURNING id INTO v_movimiento;
+    ELSIF TG_OP = 'UPDATE' THEN
+        IF NEW.cantidad_actual IS DISTINCT FROM OLD.cantidad_actual THEN
+            INSERT INTO movimientos_stock (lote_id, medicamento_id, cantidad, saldo, costo_unitario, origen, usuario_id)
+            VALUES (NEW.id, NEW.medicamento_id, NEW.cantidad_actual - OLD.cantidad_actual, NEW.cantidad_actual,
+                    NEW.precio_unitario, COALESCE(v_origen, 'ajuste'), v_usuario)
+            RETURNING id INTO v_movimiento;
+        END IF;
+    ELSE
+        INSERT INTO movimientos_stock (lote_id, medicamento_id, cantidad, saldo, costo_unitario, origen, usuario_id)
+        VALUES (OLD.id, OLD.medicamento_id, -OLD.cantidad_actual, 0, OLD.precio_unitario,
+                COALESCE(v_origen, 'baja'), v_usuario)
+        RETURNING id INTO v_movimiento;
+    END IF;
+
+    IF v_movimiento IS NOT NULL THEN
+        INSERT INTO cola_valoracion (movimiento_id) VALUES (v_movimiento);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Completar los movimientos existentes y encolarlos (solo la primera vez)
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM valoracion_medicamento) AND NOT EXISTS (SELECT 1 FROM cola_valoracion) THEN
+        UPDATE movimientos_stock m
+        SET medicamento_id = l.medicamento_id, costo_unitario = l.precio_unitario
+        FROM lotes_medicamentos l
+        WHERE m.lote_id = l.id AND m.medicamento_id IS NULL;
+
+        INSERT INTO cola_valoracion (movimiento_id)
+        SELECT id FROM movimientos_stock WHERE medicamento_id IS NOT NULL;
+    END IF;
+END;
+$$;
+
+GRANT SELECT, INSERT ON cola_valoracion TO farmaceutico;
+GRANT ALL PRIVILEGES ON cola_valoracion, valoracion_medicamento, capas_fifo, costo_ventas_diario TO gerente;
+GRANT USAGE ON SEQUENCE capas_fifo_id_seq TO gerente;
+GRANT SELECT ON valoracion_medicamento, costo_ventas_diario TO farmaceutico, investigador;
@@ -0,0 +1,44 @@
+-- Versión de tablas de catálogo que la aplicación mantiene en memoria.
+-- Cada worker compara la versión con la de su copia y la recarga si cambió.
+CREATE TABLE IF NOT EXISTS versiones_datos (
+    tabla VARCHAR(63) PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 1,
+    actualizado TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE OR REPLACE FUNCTION incrementar_version_datos()
+RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO versiones_datos (tabla) VALUES (TG_TABLE_NAME)
+    ON CONFLICT (tabla) DO UPDATE
+    SET version = versiones_datos.version + 1, actualizado = CURRENT_TIMESTAMP;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Un incremento por sentencia, no por fila
+DROP TRIGGER IF EXISTS trigger_version_interacciones ON interacciones_medicamentos;
+CREATE TRIGGER trigger_version_interacciones
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON interacciones_medicamentos
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION incrementar_version_datos();
+
+INSERT INTO versiones_datos (tabla) VALUES ('interacciones_medicamentos')
+ON CONFLICT (tabla) DO NOTHING;
+
+-- Un par de medicamentos aparece una sola vez (si ya hay pares repetidos el
+-- índice no se crea; el grafo conserva la interacción más severa de cada par)
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM interacciones_medicamentos
+        GROUP BY medicamento_id_1, medicamento_id_2 HAVING COUNT(*) > 1
+    ) THEN
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_interacciones_par
+            ON interacciones_medicamentos(medicamento_id_1, medicamento_id_2);
+    END IF;
+END;
+$$;
+
+GRANT SELECT ON versiones_datos TO gerente, farmaceutico, investigador;
+GRANT INSERT, UPDATE ON versiones_datos TO gerente;
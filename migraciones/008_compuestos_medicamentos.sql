@@ -0,0 +1,39 @@
+-- Catálogo de compuestos químicos vinculado a medicamentos, con búsqueda por trigramas
+
+-- Relación muchos a muchos entre medicamentos y compuestos
+CREATE TABLE IF NOT EXISTS medicamentos_compuestos (
+    medicamento_id INTEGER NOT NULL REFERENCES medicamentos(id) ON DELETE CASCADE,
+    compuesto_id INTEGER NOT NULL REFERENCES compuestos_quimicos(id) ON DELETE CASCADE,
+    PRIMARY KEY (medicamento_id, compuesto_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_medicamentos_compuestos_compuesto ON medicamentos_compuestos(compuesto_id);
+
+-- Vínculo inicial: compuestos cuyo nombre coincide con el principio activo
+INSERT INTO medicamentos_compuestos (medicamento_id, compuesto_id)
+SELECT m.id, c.id
+FROM medicamentos m
+JOIN compuestos_quimicos c ON lower(c.nombre) = lower(m.principio_activo)
+ON CONFLICT DO NOTHING;
+
+-- Búsqueda aproximada (similitud y ILIKE '%texto%') sobre nombre y fórmula.
+-- pg_trgm viene en postgresql-contrib; sin ella la aplicación usa ILIKE sin índice.
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE INDEX IF NOT EXISTS idx_compuestos_nombre_trgm
+            ON compuestos_quimicos USING GIN (nombre gin_trgm_ops);
+        CREATE INDEX IF NOT EXISTS idx_compuestos_formula_trgm
+            ON compuestos_quimicos USING GIN (formula_quimica gin_trgm_ops);
+    ELSE
+        RAISE NOTICE 'pg_trgm no está disponible: instale postgresql-contrib y vuelva a aplicar esta migración';
+    END IF;
+END;
+$$;
+
+GRANT ALL PRIVILEGES ON medicamentos_compuestos TO gerente;
+GRANT SELECT ON medicamentos_compuestos TO farmaceutico;
+GRANT SELECT, INSERT, DELETE ON medicamentos_compuestos TO investigador;
+GRANT INSERT, UPDATE ON compuestos_quimicos TO investigador;
+GRANT USAGE ON SEQUENCE compuestos_quimicos_id_seq TO investigador;
@@ -0,0 +1,18 @@
+-- Búsqueda aproximada de medicamentos por nombre, principio activo y categoría.
+-- idx_medicamentos_nombre e idx_medicamentos_principio_activo (btree) no sirven
+-- para ILIKE '%texto%' ni para similitud; los índices GIN de trigramas sí.
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE INDEX IF NOT EXISTS idx_medicamentos_nombre_trgm
+            ON medicamentos USING GIN (nombre gin_trgm_ops);
+        CREATE INDEX IF NOT EXISTS idx_medicamentos_principio_activo_trgm
+            ON medicamentos USING GIN (principio_activo gin_trgm_ops);
+        CREATE INDEX IF NOT EXISTS idx_medicamentos_categoria_trgm
+            ON medicamentos USING GIN (categoria gin_trgm_ops);
+    ELSE
+        RAISE NOTICE 'pg_trgm no está disponible: instale postgresql-contrib y vuelva a aplicar esta migración';
+    END IF;
+END;
+$$;
@@ -0,0 +1,9 @@
+-- Listado paginado de usuarios (ver Usuario.listar_usuarios)
+
+-- Filtro por rol y estado con paginación por id: se recorre el índice en orden
+-- desde el último id de la página anterior, sin ordenar ni saltar filas
+CREATE INDEX IF NOT EXISTS idx_usuarios_rol_activo_id ON usuarios(rol, activo, id);
+
+-- Búsqueda por prefijo del nombre o del correo (lower(col) LIKE 'texto%')
+CREATE INDEX IF NOT EXISTS idx_usuarios_nombre_prefijo ON usuarios(lower(nombre_completo) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS idx_usuarios_email_prefijo ON usuarios(lower(email) text_pattern_ops);
@@ -0,0 +1,22 @@
+-- Registro de auditoría (solo inserción) de los cambios en medicamentos,
+-- lotes y usuarios. La aplicación lo escribe en segundo plano y por lotes
+-- (ver auditoria.py): fecha es el momento del cambio y registrado el de la escritura.
+CREATE TABLE IF NOT EXISTS auditoria (
+    id BIGSERIAL PRIMARY KEY,
+    fecha TIMESTAMP NOT NULL,
+    registrado TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    tabla VARCHAR(63) NOT NULL,
+    registro_id INTEGER NOT NULL,
+    operacion VARCHAR(10) NOT NULL CHECK (operacion IN ('INSERT', 'UPDATE', 'DELETE')),
+    -- Sin clave foránea: la auditoría de un usuario sobrevive a su eliminación
+    usuario_id INTEGER,
+    -- {campo: [antes, después]} solo con los campos que cambiaron
+    cambios JSONB NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_auditoria_registro ON auditoria(tabla, registro_id, id);
+CREATE INDEX IF NOT EXISTS idx_auditoria_usuario ON auditoria(usuario_id, id);
+
+-- El registro es de solo inserción para los roles de la aplicación
+GRANT SELECT, INSERT ON auditoria TO gerente, farmaceutico, investigador;
+GRANT USAGE ON SEQUENCE auditoria_id_seq TO gerente, farmaceutico, investigador;
@@ -0,0 +1,72 @@
+-- Flujo de eventos de inventario para consumidores externos (SSE y feed por cursor).
+--
+-- movimientos_stock ya se escribe en la misma transacción que cada venta,
+-- compra o ajuste, pero sus ids no siguen el orden de confirmación: un cursor
+-- sobre ellos se saltaría movimientos de transacciones que confirman tarde.
+-- El trigger encola cada movimiento en cola_eventos_inventario y avisa con
+-- NOTIFY; el publicador (un proceso a la vez) pasa los movimientos ya
+-- confirmados a eventos_inventario, cuya secuencia sí es creciente en orden
+-- de publicación.
+CREATE TABLE IF NOT EXISTS cola_eventos_inventario (
+    movimiento_id BIGINT PRIMARY KEY,
+    -- Versión del lote tras el cambio (no se guarda en movimientos_stock)
+    version INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS eventos_inventario (
+    secuencia BIGSERIAL PRIMARY KEY,
+    movimiento_id BIGINT NOT NULL,
+    lote_id INTEGER NOT NULL,
+    medicamento_id INTEGER,
+    tipo VARCHAR(20) NOT NULL,
+    cantidad INTEGER NOT NULL,
+    saldo INTEGER NOT NULL,
+    version INTEGER,
+    fecha TIMESTAMP NOT NULL,
+    publicado TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_eventos_inventario_lote ON eventos_inventario(lote_id, secuencia);
+CREATE INDEX IF NOT EXISTS idx_eventos_inventario_publicado ON eventos_inventario USING BRIN (publicado);
+
+CREATE OR REPLACE FUNCTION registrar_movimiento_stock()
+RETURNS TRIGGER AS $$
+DECLARE
+    v_origen TEXT := NULLIF(current_setting('pharmaflow.origen', true), '');
+    v_usuario INTEGER := NULLIF(current_setting('pharmaflow.usuario_id', true), '')::INTEGER;
+    v_movimiento BIGINT;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO movimientos_stock (lote_id, medicamento_id, cantidad, saldo, costo_unitario, origen, usuario_id)
+        VALUES (NEW.id, NEW.medicamento_id, NEW.cantidad_actual, NEW.cantidad_actual, NEW.precio_unitario,
+                COALESCE(v_origen, 'alta'), v_usuario)
+        RETURNING id INTO v_movimiento;
+    ELSIF TG_OP = 'UPDATE' THEN
+        IF NEW.cantidad_actual IS DISTINCT FROM OLD.cantidad_actual THEN
+            INSERT INTO movimientos_stock (lote_id, medicamento_id, cantidad, saldo, costo_unitario, origen, usuario_id)
+            VALUES (NEW.id, NEW.medicamento_id, NEW.cantidad_actual - OLD.cantidad_actual, NEW.cantidad_actual,
+                    NEW.precio_unitario, COALESCE(v_origen, 'ajuste'), v_usuario)
+            RETURNING id INTO v_movimiento;
+        END IF;
+    ELSE
+        INSERT INTO movimientos_stock (lote_id, medicamento_id, cantidad, saldo, costo_unitario, origen, usuario_id)
+        VALUES (OLD.id, OLD.medicamento_id, -OLD.cantidad_actual, 0, OLD.precio_unitario,
+                COALESCE(v_origen, 'baja'), v_usuario)
+        RETURNING id INTO v_movimiento;
+    END IF;
+
+    IF v_movimiento IS NOT NULL THEN
+        INSERT INTO cola_valoracion (movimiento_id) VALUES (v_movimiento);
+        INSERT INTO cola_eventos_inventario (movimiento_id, version)
+        VALUES (v_movimiento, CASE WHEN TG_OP = 'DELETE' THEN NULL ELSE NEW.version END);
+        -- Se entrega al confirmar y los avisos iguales de una transacción se agrupan en uno
+        PERFORM pg_notify('inventario_pendiente', '');
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+GRANT SELECT, INSERT ON cola_eventos_inventario TO farmaceutico;
+GRANT ALL PRIVILEGES ON cola_eventos_inventario, eventos_inventario TO gerente;
+GRANT USAGE ON SEQUENCE eventos_inventario_secuencia_seq TO gerente;
+GRANT SELECT ON eventos_inventario TO farmaceutico, investigador;
@@ -0,0 +1,20 @@
+-- Claves de idempotencia de ventas y compras.
+-- La clave se guarda en la misma transacción que la operación, solo si tuvo
+-- éxito: un reintento con la misma clave recibe el resultado original y uno
+-- simultáneo choca con la clave primaria y se deshace. Cada usuario tiene su
+-- propio espacio de claves.
+CREATE TABLE IF NOT EXISTS claves_idempotencia (
+    usuario_id INTEGER NOT NULL,
+    clave VARCHAR(100) NOT NULL,
+    operacion VARCHAR(20) NOT NULL,
+    -- Resumen de los datos de la operación: la misma clave con otros datos se rechaza
+    huella CHAR(64) NOT NULL,
+    resultado JSONB NOT NULL,
+    creada TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (usuario_id, clave)
+);
+
+CREATE INDEX IF NOT EXISTS idx_claves_idempotencia_creada ON claves_idempotencia USING BRIN (creada);
+
+GRANT SELECT, INSERT ON claves_idempotencia TO farmaceutico;
+GRANT ALL PRIVILEGES ON claves_idempotencia TO gerente;
@@ -0,0 +1,123 @@
+-- Fragmentación de lotes con mucha concurrencia de ventas (modo opcional por lote).
+--
+-- El stock de un lote fragmentado se reparte entre N filas de lotes_fragmentos.
+-- Cada venta descuenta de un fragmento libre (FOR UPDATE SKIP LOCKED) sin
+-- bloquear la fila del lote, y acumula en el fragmento las unidades, el importe
+-- y el número de ventas pendientes. fusionar_fragmentos aplica lo pendiente al
+-- lote (un movimiento 'venta' en el libro y el resumen diario) y devuelve el
+-- stock al lote; repartir_fragmentos lo vuelve a repartir. Las transacciones
+-- de cada venta se insertan al momento, como en cualquier otra venta.
+--
+-- Invariante: cantidad_actual = SUM(disponible) + SUM(vendido) + stock sin repartir
+
+CREATE TABLE IF NOT EXISTS lotes_fragmentos (
+    lote_id INTEGER NOT NULL REFERENCES lotes_medicamentos(id) ON DELETE CASCADE,
+    fragmento SMALLINT NOT NULL,
+    disponible INTEGER NOT NULL DEFAULT 0 CHECK (disponible >= 0),
+    -- Ventas aún no aplicadas al lote, todas del día fecha_pendiente
+    vendido INTEGER NOT NULL DEFAULT 0,
+    importe NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    ventas INTEGER NOT NULL DEFAULT 0,
+    fecha_pendiente DATE,
+    PRIMARY KEY (lote_id, fragmento)
+);
+
+-- Aplicar al lote las ventas pendientes de sus fragmentos y devolverle el stock
+-- repartido (los fragmentos quedan vacíos). Bloquea el lote y después sus
+-- fragmentos, en ese orden. Retorna el número de ventas aplicadas.
+CREATE OR REPLACE FUNCTION fusionar_fragmentos(p_lote_id INTEGER)
+RETURNS INTEGER AS $$
+DECLARE
+    v_origen TEXT := current_setting('pharmaflow.origen', true);
+    v_usuario TEXT := current_setting('pharmaflow.usuario_id', true);
+    v_vendido BIGINT;
+    v_ventas INTEGER;
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM lotes_fragmentos WHERE lote_id = p_lote_id) THEN
+        RETURN 0;
+    END IF;
+
+    PERFORM 1 FROM lotes_medicamentos WHERE id = p_lote_id FOR UPDATE;
+    PERFORM 1 FROM lotes_fragmentos WHERE lote_id = p_lote_id ORDER BY fragmento FOR UPDATE;
+
+    SELECT COALESCE(SUM(vendido), 0), COALESCE(SUM(ventas), 0) INTO v_vendido, v_ventas
+    FROM lotes_fragmentos WHERE lote_id = p_lote_id;
+
+    IF v_ventas > 0 THEN
+        INSERT INTO resumen_diario_lote (fecha, lote_id, tipo, unidades, importe, transacciones)
+        SELECT fecha_pendiente, lote_id, 'venta', SUM(vendido), SUM(importe), SUM(ventas)
+        FROM lotes_fragmentos
+        WHERE lote_id = p_lote_id AND ventas > 0
+        GROUP BY fecha_pendiente, lote_id
+        ON CONFLICT (fecha, lote_id, tipo) DO UPDATE
+        SET unidades = resumen_diario_lote.unidades + EXCLUDED.unidades,
+            importe = resumen_diario_lote.importe + EXCLUDED.importe,
+            transacciones = resumen_diario_lote.transacciones + EXCLUDED.transacciones;
+
+        -- Un solo movimiento con las ventas acumuladas, sin usuario (son de varios)
+        PERFORM set_config('pharmaflow.origen', 'venta', true),
+                set_config('pharmaflow.usuario_id', '', true);
+        UPDATE lotes_medicamentos
+        SET cantidad_actual = cantidad_actual - v_vendido, version = version + 1
+        WHERE id = p_lote_id;
+        PERFORM set_config('pharmaflow.origen', COALESCE(v_origen, ''), true),
+                set_config('pharmaflow.usuario_id', COALESCE(v_usuario, ''), true);
+    END IF;
+
+    UPDATE lotes_fragmentos
+    SET disponible = 0, vendido = 0, importe = 0, ventas = 0, fecha_pendiente = NULL
+    WHERE lote_id = p_lote_id;
+    RETURN v_ventas;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Repartir el stock del lote entre sus fragmentos (después de fusionar_fragmentos,
+-- con el lote bloqueado). Con poco stock se usan menos fragmentos, ninguno con
+-- menos de p_minimo unidades, hasta quedar uno solo.
+CREATE OR REPLACE FUNCTION repartir_fragmentos(p_lote_id INTEGER, p_minimo INTEGER)
+RETURNS VOID AS $$
+DECLARE
+    v_stock INTEGER;
+    v_fragmentos INTEGER;
+    v_usados INTEGER;
+BEGIN
+    SELECT COUNT(*) INTO v_fragmentos FROM lotes_fragmentos WHERE lote_id = p_lote_id;
+    IF v_fragmentos = 0 THEN
+        RETURN;
+    END IF;
+    SELECT cantidad_actual INTO v_stock FROM lotes_medicamentos WHERE id = p_lote_id;
+    v_usados := GREATEST(1, LEAST(v_fragmentos, v_stock / GREATEST(p_minimo, 1)));
+
+    UPDATE lotes_fragmentos
+    SET disponible = CASE
+        WHEN fragmento < v_usados
+            THEN v_stock / v_usados + CASE WHEN fragmento < v_stock % v_usados THEN 1 ELSE 0 END
+        ELSE 0
+    END
+    WHERE lote_id = p_lote_id;
+END;
+$$ LANGUAGE plpgsql;
+
+-- El inventario descuenta las ventas de los fragmentos aún no aplicadas al lote
+CREATE OR REPLACE VIEW vista_inventario AS
+SELECT
+    m.id as medicamento_id,
+    m.nombre as medicamento,
+    m.principio_activo,
+    l.id as lote_id,
+    l.numero_lote,
+    (l.cantidad_actual - COALESCE(f.vendido, 0))::INTEGER AS cantidad_actual,
+    l.precio_unitario,
+    l.fecha_caducidad,
+    l.version,
+    l.estado_caducidad
+FROM medicamentos m
+JOIN lotes_medicamentos l ON m.id = l.medicamento_id
+LEFT JOIN (
+    SELECT lote_id, SUM(vendido) AS vendido FROM lotes_fragmentos GROUP BY lote_id
+) f ON f.lote_id = l.id
+WHERE l.cantidad_actual > 0 AND l.cantidad_actual - COALESCE(f.vendido, 0) > 0;
+
+GRANT ALL PRIVILEGES ON lotes_fragmentos TO gerente;
+GRANT SELECT, UPDATE ON lotes_fragmentos TO farmaceutico;
+GRANT SELECT ON lotes_fragmentos TO investigador;
@@ -0,0 +1,30 @@
+-- Índices parciales de caducidad sin cantidad_actual en el predicado.
+--
+-- La versión anterior de la migración 001 los creaba con
+-- "AND cantidad_actual > 0". Una columna usada en el predicado de un índice
+-- cuenta como indexada, así que ninguna venta de un lote podía ser una
+-- actualización HOT (cada venta escribía entradas nuevas en todos los índices
+-- de la tabla). Las consultas ya filtran cantidad_actual > 0 por su cuenta.
+
+DO $$
+DECLARE
+    v_indice TEXT;
+BEGIN
+    FOREACH v_indice IN ARRAY ARRAY['idx_lotes_proximos_caducar', 'idx_lotes_caducados'] LOOP
+        IF EXISTS (
+            SELECT 1 FROM pg_indexes
+            WHERE schemaname = current_schema() AND indexname = v_indice
+              AND indexdef LIKE '%cantidad_actual%'
+        ) THEN
+            EXECUTE format('DROP INDEX %I', v_indice);
+        END IF;
+    END LOOP;
+END;
+$$;
+
+CREATE INDEX IF NOT EXISTS idx_lotes_proximos_caducar
+    ON lotes_medicamentos(fecha_caducidad)
+    WHERE estado_caducidad = 'proximo_a_caducar';
+CREATE INDEX IF NOT EXISTS idx_lotes_caducados
+    ON lotes_medicamentos(fecha_caducidad)
+    WHERE estado_caducidad = 'caducado';
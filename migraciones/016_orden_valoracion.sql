@@ -0,0 +1,42 @@
+-- Orden en que la valoración aplicó los movimientos de cada medicamento.
+--
+-- Los ids de movimientos_stock no siguen el orden de confirmación entre lotes
+-- distintos (ver 012): una compra con id 100 puede confirmarse después de una
+-- venta con id 101 de otro lote del mismo medicamento, y procesar_pendientes
+-- aplica la venta antes porque es lo único confirmado. Reproducir el libro en
+-- orden de id (verificar) consumiría las capas FIFO en otro orden y reportaría
+-- diferencias falsas. Cada movimiento aplicado guarda aquí su posición en la
+-- secuencia de su medicamento, y la verificación reproduce ese mismo orden.
+-- Dentro de un lote el orden de id sí es el de confirmación: el trigger toma
+-- el id con la fila del lote bloqueada.
+
+CREATE TABLE IF NOT EXISTS movimientos_valorados (
+    medicamento_id INTEGER NOT NULL,
+    orden BIGINT NOT NULL,
+    movimiento_id BIGINT NOT NULL,
+    PRIMARY KEY (medicamento_id, orden)
+);
+
+-- Movimientos aplicados de cada medicamento (último orden asignado)
+ALTER TABLE valoracion_medicamento ADD COLUMN IF NOT EXISTS movimientos_aplicados BIGINT NOT NULL DEFAULT 0;
+
+-- Los movimientos aplicados antes de esta migración, en orden de id (el que se usaba)
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM movimientos_valorados) THEN
+        INSERT INTO movimientos_valorados (medicamento_id, orden, movimiento_id)
+        SELECT m.medicamento_id, row_number() OVER (PARTITION BY m.medicamento_id ORDER BY m.id), m.id
+        FROM movimientos_stock m
+        WHERE m.medicamento_id IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM cola_valoracion c WHERE c.movimiento_id = m.id);
+
+        UPDATE valoracion_medicamento v
+        SET movimientos_aplicados = t.aplicados
+        FROM (SELECT medicamento_id, MAX(orden) AS aplicados
+              FROM movimientos_valorados GROUP BY medicamento_id) t
+        WHERE v.medicamento_id = t.medicamento_id;
+    END IF;
+END;
+$$;
+
+GRANT ALL PRIVILEGES ON movimientos_valorados TO gerente;
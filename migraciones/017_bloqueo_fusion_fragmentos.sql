@@ -0,0 +1,56 @@
+-- fusionar_fragmentos bloquea el lote con FOR NO KEY UPDATE.
+--
+-- Una venta desde un fragmento bloquea el fragmento y después inserta su fila
+-- en transacciones, cuya clave foránea toma FOR KEY SHARE sobre el lote. Con
+-- FOR UPDATE sobre el lote, fusionar_fragmentos (rebalanceo o venta que no
+-- cabe en ningún fragmento) esperaba al fragmento de la venta mientras la
+-- venta esperaba al lote: interbloqueo. FOR NO KEY UPDATE no entra en
+-- conflicto con FOR KEY SHARE y basta, porque nunca se modifica la clave del
+-- lote. Las ventas y compras que bloquean el lote antes de fusionar usan el
+-- mismo modo (models_inventario.py).
+
+CREATE OR REPLACE FUNCTION fusionar_fragmentos(p_lote_id INTEGER)
+RETURNS INTEGER AS $$
+DECLARE
+    v_origen TEXT := current_setting('pharmaflow.origen', true);
+    v_usuario TEXT := current_setting('pharmaflow.usuario_id', true);
+    v_vendido BIGINT;
+    v_ventas INTEGER;
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM lotes_fragmentos WHERE lote_id = p_lote_id) THEN
+        RETURN 0;
+    END IF;
+
+    PERFORM 1 FROM lotes_medicamentos WHERE id = p_lote_id FOR NO KEY UPDATE;
+    PERFORM 1 FROM lotes_fragmentos WHERE lote_id = p_lote_id ORDER BY fragmento FOR UPDATE;
+
+    SELECT COALESCE(SUM(vendido), 0), COALESCE(SUM(ventas), 0) INTO v_vendido, v_ventas
+    FROM lotes_fragmentos WHERE lote_id = p_lote_id;
+
+    IF v_ventas > 0 THEN
+        INSERT INTO resumen_diario_lote (fecha, lote_id, tipo, unidades, importe, transacciones)
+        SELECT fecha_pendiente, lote_id, 'venta', SUM(vendido), SUM(importe), SUM(ventas)
+        FROM lotes_fragmentos
+        WHERE lote_id = p_lote_id AND ventas > 0
+        GROUP BY fecha_pendiente, lote_id
+        ON CONFLICT (fecha, lote_id, tipo) DO UPDATE
+        SET unidades = resumen_diario_lote.unidades + EXCLUDED.unidades,
+            importe = resumen_diario_lote.importe + EXCLUDED.importe,
+            transacciones = resumen_diario_lote.transacciones + EXCLUDED.transacciones;
+
+        -- Un solo movimiento con las ventas acumuladas, sin usuario (son de varios)
+        PERFORM set_config('pharmaflow.origen', 'venta', true),
+                set_config('pharmaflow.usuario_id', '', true);
+        UPDATE lotes_medicamentos
+        SET cantidad_actual = cantidad_actual - v_vendido, version = version + 1
+        WHERE id = p_lote_id;
+        PERFORM set_config('pharmaflow.origen', COALESCE(v_origen, ''), true),
+                set_config('pharmaflow.usuario_id', COALESCE(v_usuario, ''), true);
+    END IF;
+
+    UPDATE lotes_fragmentos
+    SET disponible = 0, vendido = 0, importe = 0, ventas = 0, fecha_pendiente = NULL
+    WHERE lote_id = p_lote_id;
+    RETURN v_ventas;
+END;
+$$ LANGUAGE plpgsql;
@@ -1,15 +1,58 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import bcrypt
-from database import get_db_cursor, get_sesiones_collection
+from psycopg2.extras import execute_values
+import auditoria
+import filas
+from cache import CacheTTL
+from database import get_db_cursor, get_sesiones_collection, patron_like, ejecutar_preparada
 from datetime import datetime, timedelta
 import secrets
 
+# Rol vigente de cada usuario para role_required (por proceso; los cambios
+# hechos desde otro worker tardan hasta ROLES_CACHE_TTL segundos en verse)
+ROLES_CACHE_TTL = float(os.getenv('ROLES_CACHE_TTL', '60'))
+_cache_roles = CacheTTL(ttl=ROLES_CACHE_TTL)
+
+ROLES = ('gerente', 'farmaceutico', 'investigador')
+CAMPOS_USUARIO = ('username', 'password', 'nombre_completo', 'email', 'rol')
+# Columnas de usuarios que se guardan en la auditoría
+CAMPOS_AUDITADOS = ('username', 'nombre_completo', 'email', 'rol', 'activo')
+# Procesos para calcular hashes bcrypt en el alta masiva (por defecto, uno por CPU)
+PROCESOS_HASH = int(os.getenv('PROCESOS_HASH', '0')) or os.cpu_count() or 1
+
+# Registro de las filas de listar_usuarios (filas.py)
+FilaUsuario = filas.registro('FilaUsuario', (
+    'id', 'username', 'nombre_completo', 'email', 'rol', 'activo', 'fecha_creacion'
+))
+
+def _hash_password(password):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+
+def _validar_fila(fila, vistos):
+    """Mensaje de error de una fila del alta masiva, o None si es válida"""
+    faltantes = [campo for campo in CAMPOS_USUARIO if not (fila.get(campo) or '').strip()]
+    if faltantes:
+        return f"Faltan campos: {', '.join(faltantes)}"
+    if len(fila['password'].strip()) < 6:
+        return "La contraseña debe tener al menos 6 caracteres"
+    if fila['rol'].strip() not in ROLES:
+        return f"Rol no válido: {fila['rol']}"
+    for campo in ('username', 'email'):
+        valor = fila[campo].strip().lower()
+        if (campo, valor) in vistos:
+            return f"{campo} repetido en el archivo: {fila[campo]}"
+        vistos.add((campo, valor))
+    return None
+
 class Usuario:
     """Modelo de usuario con autenticación"""
 
     @staticmethod
     def crear_usuario(username, password, nombre_completo, email, rol):
         """Crear nuevo usuario con hash de password"""
-        password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        password_hash = _hash_password(password)
 
         with get_db_cursor() as cursor:
             cursor.execute(
@@ -17,7 +60,100 @@ class Usuario:
                    VALUES (%s, %s, %s, %s, %s) RETURNING id""",
                 (username, password_hash, nombre_completo, email, rol)
             )
-            return cursor.fetchone()[0]
+            user_id = cursor.fetchone()[0]
+        auditoria.registrar('usuarios', user_id, despues={
+            'username': username, 'nombre_completo': nombre_completo, 'email': email, 'rol': rol
+        })
+        return user_id
+
+    @staticmethod
+    def crear_usuarios_masivo(entradas, procesos=PROCESOS_HASH):
+        """
+        Alta de muchos usuarios a la vez. entradas: diccionarios con CAMPOS_USUARIO.
+        Es un generador de eventos de progreso (diccionarios con 'evento'):
+          - 'hash': hashes calculados hasta el momento
+          - 'fila': resultado de cada fila (creado, conflicto o invalido)
+          - 'resumen': totales al terminar
+        Los hashes bcrypt se calculan en paralelo en un pool de procesos y los
+        usuarios válidos se insertan con una sola sentencia; las filas cuyo
+        username o email ya existen se reportan como conflicto.
+        """
+        entradas = list(entradas)
+        resultados = {}
+        validas = []
+        vistos = set()
+        for numero, fila in enumerate(entradas, start=1):
+            error = _validar_fila(fila, vistos)
+            if error:
+                resultados[numero] = {'evento': 'fila', 'fila': numero, 'username': fila.get('username'),
+                                      'estado': 'invalido', 'error': error}
+            else:
+                validas.append((numero, {campo: fila[campo].strip() for campo in CAMPOS_USUARIO}))
+
+        hashes = []
+        if validas:
+            # spawn: procesos nuevos que solo importan este módulo, sin heredar los hilos
+            # del worker (planificador, eventos, gthread) ni sus sockets de PostgreSQL y MongoDB
+            contexto = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=min(procesos, len(validas)), mp_context=contexto) as executor:
+                bloque = max(1, len(validas) // (procesos * 4))
+                passwords = [fila['password'] for _, fila in validas]
+                for password_hash in executor.map(_hash_password, passwords, chunksize=bloque):
+                    hashes.append(password_hash)
+                    if len(hashes) % 50 == 0 or len(hashes) == len(validas):
+                        yield {'evento': 'hash', 'procesados': len(hashes), 'total': len(validas)}
+
+        creados = {}
+        if validas:
+            with get_db_cursor() as cursor:
+                # Sin columna de conflicto: cubre las restricciones UNIQUE de username y de email
+                filas_creadas = execute_values(
+                    cursor,
+                    """INSERT INTO usuarios (username, password_hash, nombre_completo, email, rol)
+                       VALUES %s
+                       ON CONFLICT DO NOTHING
+                       RETURNING id, username""",
+                    [(fila['username'], password_hash, fila['nombre_completo'], fila['email'], fila['rol'])
+                     for (_, fila), password_hash in zip(validas, hashes)],
+                    page_size=len(validas),
+                    fetch=True
+                )
+                creados = {username: user_id for user_id, username in filas_creadas}
+
+                rechazadas = [fila for _, fila in validas if fila['username'] not in creados]
+                existentes = set()
+                if rechazadas:
+                    cursor.execute(
+                        """SELECT 'username', lower(username) FROM usuarios WHERE lower(username) = ANY(%s)
+                           UNION ALL
+                           SELECT 'email', lower(email) FROM usuarios WHERE lower(email) = ANY(%s)""",
+                        ([f['username'].lower() for f in rechazadas], [f['email'].lower() for f in rechazadas])
+                    )
+                    existentes = set(cursor.fetchall())
+
+            for numero, fila in validas:
+                if fila['username'] in creados:
+                    auditoria.registrar('usuarios', creados[fila['username']], despues={
+                        campo: fila[campo] for campo in ('username', 'nombre_completo', 'email', 'rol')
+                    })
+                    resultados[numero] = {'evento': 'fila', 'fila': numero, 'username': fila['username'],
+                                          'estado': 'creado', 'id': creados[fila['username']]}
+                else:
+                    campos = [c for c in ('username', 'email') if (c, fila[c].lower()) in existentes]
+                    resultados[numero] = {'evento': 'fila', 'fila': numero, 'username': fila['username'],
+                                          'estado': 'conflicto',
+                                          'error': f"Ya existe un usuario con ese {' y '.join(campos) or 'username o email'}"}
+
+        for numero in sorted(resultados):
+            yield resultados[numero]
+
+        yield {
+            'evento': 'resumen',
+            'total': len(entradas),
+            'creados': len(creados),
+            'conflictos': sum(1 for r in resultados.values() if r['estado'] == 'conflicto'),
+            'invalidos': sum(1 for r in resultados.values() if r['estado'] == 'invalido')
+        }
 
     @staticmethod
     def autenticar(username, password):
@@ -46,7 +182,8 @@ class Usuario:
     def obtener_por_id(user_id):
         """Obtener usuario por ID"""
         with get_db_cursor(commit=False) as cursor:
-            cursor.execute(
+            ejecutar_preparada(
+                cursor, 'usuario_por_id',
                 """SELECT id, username, nombre_completo, email, rol, activo
                    FROM usuarios WHERE id = %s""",
                 (user_id,)
@@ -64,55 +201,125 @@ class Usuario:
         return None
 
     @staticmethod
-    def listar_usuarios():
-        """Listar todos los usuarios"""
+    def rol_vigente(user_id):
+        """Rol del usuario si existe y está activo, None en otro caso (en caché)"""
+        rol = _cache_roles.obtener(user_id)
+        if rol is None:
+            with get_db_cursor(commit=False) as cursor:
+                ejecutar_preparada(
+                    cursor, 'rol_usuario', "SELECT rol, activo FROM usuarios WHERE id = %s", (user_id,)
+                )
+                result = cursor.fetchone()
+            # '' marca en caché a los usuarios inexistentes o inactivos
+            rol = result[0] if result and result[1] else ''
+            _cache_roles.guardar(user_id, rol)
+        return rol or None
+
+    @staticmethod
+    def listar_usuarios(despues_de=None, limite=50, rol=None, activo=None, prefijo=None):
+        """
+        Listar usuarios ordenados por id, paginados por cursor: la página
+        siguiente empieza después del último id de la anterior (despues_de).
+        Filtros opcionales por rol, estado y prefijo del nombre o del correo.
+        """
+        condiciones = ["(%(despues_de)s::integer IS NULL OR id > %(despues_de)s)"]
+        if rol:
+            condiciones.append("rol = %(rol)s")
+        if activo is not None:
+            condiciones.append("activo = %(activo)s")
+        if prefijo:
+            condiciones.append("(lower(nombre_completo) LIKE %(prefijo)s OR lower(email) LIKE %(prefijo)s)")
+
         with get_db_cursor(commit=False) as cursor:
             cursor.execute(
-                """SELECT id, username, nombre_completo, email, rol, activo, fecha_creacion
-                   FROM usuarios ORDER BY id"""
+                f"""SELECT id, username, nombre_completo, email, rol, activo, fecha_creacion
+                    FROM usuarios
+                    WHERE {' AND '.join(condiciones)}
+                    ORDER BY id
+                    LIMIT %(limite)s""",
+                {
+                    'despues_de': despues_de,
+                    'rol': rol,
+                    'activo': activo,
+                    'prefijo': patron_like(prefijo.lower(), prefijo=True) if prefijo else None,
+                    'limite': limite
+                }
+            )
+            return filas.listar(cursor, FilaUsuario)
+
+    @staticmethod
+    def cambiar_estado(user_ids, activo):
+        """
+        Activar o desactivar varios usuarios con una sola sentencia.
+        Retorna los ids que cambiaron de estado.
+        """
+        with get_db_cursor() as cursor:
+            cursor.execute(
+                """UPDATE usuarios SET activo = %s
+                   WHERE id = ANY(%s) AND activo IS DISTINCT FROM %s
+                   RETURNING id""",
+                (activo, list(user_ids), activo)
             )
-            usuarios = []
-            for row in cursor.fetchall():
-                usuarios.append({
-                    'id': row[0],
-                    'username': row[1],
-                    'nombre_completo': row[2],
-                    'email': row[3],
-                    'rol': row[4],
-                    'activo': row[5],
-                    'fecha_creacion': row[6]
-                })
-            return usuarios
+            cambiados = [row[0] for row in cursor.fetchall()]
+
+        for user_id in cambiados:
+            _cache_roles.invalidar(user_id)
+            auditoria.registrar('usuarios', user_id, {'activo': not activo}, {'activo': activo})
+        if cambiados and not activo:
+            Sesion.eliminar_sesiones_de(cambiados)
+        return cambiados
 
     @staticmethod
     def actualizar(user_id, nombre_completo, email, rol, activo):
         """Actualizar usuario existente (sin cambiar password)"""
         with get_db_cursor() as cursor:
             cursor.execute(
-                """UPDATE usuarios 
+                """UPDATE usuarios u
                    SET nombre_completo = %s, email = %s, rol = %s, activo = %s
-                   WHERE id = %s""",
+                   FROM (SELECT id, username, nombre_completo, email, rol, activo
+                         FROM usuarios WHERE id = %s FOR UPDATE) antes
+                   WHERE u.id = antes.id
+                   RETURNING antes.username, antes.nombre_completo, antes.email, antes.rol, antes.activo,
+                             u.username, u.nombre_completo, u.email, u.rol, u.activo""",
                 (nombre_completo, email, rol, activo, user_id)
             )
-            return cursor.rowcount > 0
+            row = cursor.fetchone()
+        _cache_roles.invalidar(user_id)
+        if row is None:
+            return False
+        auditoria.registrar('usuarios', user_id, *auditoria.dividir_fila(row, CAMPOS_AUDITADOS))
+        return True
 
     @staticmethod
     def actualizar_password(user_id, nueva_password):
         """Actualizar solo el password de un usuario"""
-        password_hash = bcrypt.hashpw(nueva_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        password_hash = _hash_password(nueva_password)
         with get_db_cursor() as cursor:
             cursor.execute(
                 """UPDATE usuarios SET password_hash = %s WHERE id = %s""",
                 (password_hash, user_id)
             )
-            return cursor.rowcount > 0
+            actualizado = cursor.rowcount > 0
+        if actualizado:
+            # Solo queda constancia del cambio: el hash no se guarda
+            auditoria.registrar('usuarios', user_id, {'password_hash': ''}, {'password_hash': password_hash})
+        return actualizado
 
     @staticmethod
     def eliminar(user_id):
         """Eliminar usuario"""
         with get_db_cursor() as cursor:
-            cursor.execute("DELETE FROM usuarios WHERE id = %s", (user_id,))
-            return cursor.rowcount > 0
+            cursor.execute(
+                """DELETE FROM usuarios WHERE id = %s
+                   RETURNING username, nombre_completo, email, rol, activo""",
+                (user_id,)
+            )
+            row = cursor.fetchone()
+        _cache_roles.invalidar(user_id)
+        if row is None:
+            return False
+        auditoria.registrar('usuarios', user_id, antes=dict(zip(CAMPOS_AUDITADOS, row)))
+        return True
 
 class Sesion:
     """Manejo de sesiones en MongoDB (clave-valor para acceso rápido)"""
@@ -152,6 +359,14 @@ class Sesion:
         sesiones = get_sesiones_collection()
         sesiones.delete_one({'token': token})
 
+    @staticmethod
+    def eliminar_sesiones_de(usuario_ids):
+        """Eliminar todas las sesiones de los usuarios indicados"""
+        sesiones = get_sesiones_collection()
+        if sesiones is None:
+            return 0
+        return sesiones.delete_many({'usuario_id': {'$in': list(usuario_ids)}}).deleted_count
+
     @staticmethod
     def limpiar_sesiones_expiradas():
         """Eliminar sesiones expiradas"""
@@ -0,0 +1,206 @@
+"""
+Catálogo de compuestos químicos y su vínculo con medicamentos (migración 008).
+
+La búsqueda usa los índices de trigramas de pg_trgm sobre nombre y fórmula
+(coincidencias parciales y con errores de escritura, ordenadas por similitud).
+El nivel de riesgo de cada medicamento es el más alto de sus compuestos; el
+resumen se guarda en caché COMPUESTOS_CACHE_TTL segundos y se invalida con
+cada cambio hecho desde este proceso.
+"""
+import os
+
+from cache import CacheTTL
+from database import get_db_cursor, extension_instalada, patron_like
+
+COMPUESTOS_CACHE_TTL = float(os.getenv('COMPUESTOS_CACHE_TTL', '300'))
+
+NIVELES_RIESGO = ('bajo', 'medio', 'alto')
+
+_cache = CacheTTL(ttl=COMPUESTOS_CACHE_TTL)
+
+def _fila_compuesto(row):
+    return {
+        'id': row[0],
+        'nombre': row[1],
+        'formula_quimica': row[2],
+        'descripcion': row[3],
+        'nivel_riesgo': row[4]
+    }
+
+class CompuestoQuimico:
+    """Modelo para compuestos químicos"""
+
+    @staticmethod
+    def crear(nombre, formula_quimica=None, descripcion=None, nivel_riesgo=None):
+        if nivel_riesgo is not None and nivel_riesgo not in NIVELES_RIESGO:
+            raise ValueError(f"Nivel de riesgo no válido: {nivel_riesgo}")
+        with get_db_cursor() as cursor:
+            cursor.execute(
+                """INSERT INTO compuestos_quimicos (nombre, formula_quimica, descripcion, nivel_riesgo)
+                   VALUES (%s, %s, %s, %s) RETURNING id""",
+                (nombre, formula_quimica, descripcion, nivel_riesgo)
+            )
+            compuesto_id = cursor.fetchone()[0]
+        _cache.invalidar()
+        return compuesto_id
+
+    @staticmethod
+    def actualizar(compuesto_id, nombre, formula_quimica, descripcion, nivel_riesgo):
+        if nivel_riesgo is not None and nivel_riesgo not in NIVELES_RIESGO:
+            raise ValueError(f"Nivel de riesgo no válido: {nivel_riesgo}")
+        with get_db_cursor() as cursor:
+            cursor.execute(
+                """UPDATE compuestos_quimicos
+                   SET nombre = %s, formula_quimica = %s, descripcion = %s, nivel_riesgo = %s
+                   WHERE id = %s""",
+                (nombre, formula_quimica, descripcion, nivel_riesgo, compuesto_id)
+            )
+            actualizado = cursor.rowcount > 0
+        _cache.invalidar()
+        return actualizado
+
+    @staticmethod
+    def eliminar(compuesto_id):
+        with get_db_cursor() as cursor:
+            cursor.execute("DELETE FROM compuestos_quimicos WHERE id = %s", (compuesto_id,))
+            eliminado = cursor.rowcount > 0
+        _cache.invalidar()
+        return eliminado
+
+    @staticmethod
+    def obtener_por_id(compuesto_id):
+        with get_db_cursor(commit=False) as cursor:
+            cursor.execute(
+                """SELECT id, nombre, formula_quimica, descripcion, nivel_riesgo
+                   FROM compuestos_quimicos WHERE id = %s""",
+                (compuesto_id,)
+            )
+            row = cursor.fetchone()
+            return _fila_compuesto(row) if row else None
+
+    @staticmethod
+    def listar(limite=200):
+        with get_db_cursor(commit=False) as cursor:
+            cursor.execute(
+                """SELECT id, nombre, formula_quimica, descripcion, nivel_riesgo
+                   FROM compuestos_quimicos ORDER BY nombre LIMIT %s""",
+                (limite,)
+            )
+            return [_fila_compuesto(row) for row in cursor.fetchall()]
+
+    @staticmethod
+    def buscar(texto, limite=20):
+        """
+        Compuestos cuyo nombre o fórmula contiene el texto o se le parece,
+        del más al menos similar. Sin pg_trgm solo hay coincidencias parciales.
+        """
+        texto = (texto or '').strip()
+        if not texto:
+            return []
+        patron = patron_like(texto)
+        with get_db_cursor(commit=False) as cursor:
+            if extension_instalada(cursor, 'pg_trgm'):
+                cursor.execute(
+                    """SELECT id, nombre, formula_quimica, descripcion, nivel_riesgo
+                       FROM compuestos_quimicos
+                       WHERE nombre %% %(texto)s OR formula_quimica %% %(texto)s
+                          OR nombre ILIKE %(patron)s OR formula_quimica ILIKE %(patron)s
+                       ORDER BY GREATEST(similarity(nombre, %(texto)s),
+                                         similarity(COALESCE(formula_quimica, ''), %(texto)s)) DESC,
+                                nombre
+                       LIMIT %(limite)s""",
+                    {'texto': texto, 'patron': patron, 'limite': limite}
+                )
+            else:
+                cursor.execute(
+                    """SELECT id, nombre, formula_quimica, descripcion, nivel_riesgo
+                       FROM compuestos_quimicos
+                       WHERE nombre ILIKE %(patron)s OR formula_quimica ILIKE %(patron)s
+                       ORDER BY nombre
+                       LIMIT %(limite)s""",
+                    {'patron': patron, 'limite': limite}
+                )
+            return [_fila_compuesto(row) for row in cursor.fetchall()]
+
+    @staticmethod
+    def vincular(medicamento_id, compuesto_id):
+        """Asociar un compuesto a un medicamento; retorna False si ya lo estaba"""
+        with get_db_cursor() as cursor:
+            cursor.execute(
+                """INSERT INTO medicamentos_compuestos (medicamento_id, compuesto_id)
+                   VALUES (%s, %s) ON CONFLICT DO NOTHING""",
+                (medicamento_id, compuesto_id)
+            )
+            vinculado = cursor.rowcount > 0
+        _cache.invalidar()
+        return vinculado
+
+    @staticmethod
+    def desvincular(medicamento_id, compuesto_id):
+        with get_db_cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM medicamentos_compuestos WHERE medicamento_id = %s AND compuesto_id = %s",
+                (medicamento_id, compuesto_id)
+            )
+            desvinculado = cursor.rowcount > 0
+        _cache.invalidar()
+        return desvinculado
+
+    @staticmethod
+    def listar_por_medicamento(medicamento_id):
+        with get_db_cursor(commit=False) as cursor:
+            cursor.execute(
+                """SELECT c.id, c.nombre, c.formula_quimica, c.descripcion, c.nivel_riesgo
+                   FROM medicamentos_compuestos mc
+                   JOIN compuestos_quimicos c ON mc.compuesto_id = c.id
+                   WHERE mc.medicamento_id = %s
+                   ORDER BY c.nombre""",
+                (medicamento_id,)
+            )
+            return [_fila_compuesto(row) for row in cursor.fetchall()]
+
+    @staticmethod
+    def medicamentos_del_compuesto(compuesto_id):
+        with get_db_cursor(commit=False) as cursor:
+            cursor.execute(
+                """SELECT m.id, m.nombre, m.principio_activo
+                   FROM medicamentos_compuestos mc
+                   JOIN medicamentos m ON mc.medicamento_id = m.id
+                   WHERE mc.compuesto_id = %s
+                   ORDER BY m.nombre""",
+                (compuesto_id,)
+            )
+            return [
+                {'id': row[0], 'nombre': row[1], 'principio_activo': row[2]}
+                for row in cursor.fetchall()
+            ]
+
+    @staticmethod
+    def riesgo_por_medicamento():
+        """
+        Diccionario medicamento_id -> {'nivel_riesgo', 'compuestos', 'compuestos_alto'}
+        con el nivel más alto entre los compuestos de cada medicamento (en caché).
+        """
+        return _cache.obtener_o_calcular('riesgo_por_medicamento', CompuestoQuimico._calcular_riesgo)
+
+    @staticmethod
+    def _calcular_riesgo():
+        with get_db_cursor(commit=False) as cursor:
+            cursor.execute(
+                """SELECT mc.medicamento_id,
+                          MAX(array_position(%s::varchar[], c.nivel_riesgo)),
+                          COUNT(*),
+                          COUNT(*) FILTER (WHERE c.nivel_riesgo = 'alto')
+                   FROM medicamentos_compuestos mc
+                   JOIN compuestos_quimicos c ON mc.compuesto_id = c.id
+                   GROUP BY mc.medicamento_id""",
+                (list(NIVELES_RIESGO),)
+            )
+            return {
+                row[0]: {
+                    'nivel_riesgo': NIVELES_RIESGO[row[1] - 1] if row[1] else None,
+                    'compuestos': row[2],
+                    'compuestos_alto': row[3]
+                }
+                for row in cursor.fetchall()
+            }
@@ -0,0 +1,120 @@
+"""
+Verificación de interacciones entre medicamentos con un grafo en memoria.
+
+Cada proceso carga interacciones_medicamentos en un diccionario de adyacencia
+(medicamento -> {medicamento: interacción}), así que revisar un carrito de k
+medicamentos son k·(k-1)/2 búsquedas en diccionarios, sin consultas a la base
+de datos. La tabla versiones_datos (migración 007) lleva un contador que un
+trigger incrementa con cada cambio; el grafo compara su versión como mucho
+cada INTERACCIONES_VERIFICAR_SEGUNDOS y se recarga solo si cambió.
+"""
+import os
+import threading
+import time
+from itertools import combinations
+
+from database import get_db_cursor
+
+INTERACCIONES_VERIFICAR_SEGUNDOS = float(os.getenv('INTERACCIONES_VERIFICAR_SEGUNDOS', '30'))
+
+SEVERIDADES = ('leve', 'moderada', 'severa')
+_ORDEN_SEVERIDAD = {severidad: i for i, severidad in enumerate(SEVERIDADES)}
+
+class GrafoInteracciones:
+    """Copia inmutable de la tabla de interacciones en forma de lista de adyacencia"""
+
+    __slots__ = ('version', 'adyacencia', 'cargado')
+
+    def __init__(self, version, filas):
+        self.version = version
+        self.cargado = time.monotonic()
+        self.adyacencia = {}
+        for medicamento_1, medicamento_2, tipo, severidad, descripcion in filas:
+            interaccion = (tipo, severidad, descripcion)
+            # Si hay varias filas para el mismo par se conserva la más severa
+            for a, b in ((medicamento_1, medicamento_2), (medicamento_2, medicamento_1)):
+                vecinos = self.adyacencia.setdefault(a, {})
+                actual = vecinos.get(b)
+                if actual is None or _ORDEN_SEVERIDAD.get(severidad, -1) > _ORDEN_SEVERIDAD.get(actual[1], -1):
+                    vecinos[b] = interaccion
+
+    def interacciones(self, medicamento_ids):
+        """Pares del conjunto que interactúan, del más severo al más leve"""
+        ids = sorted(set(medicamento_ids))
+        encontradas = []
+        for a, b in combinations(ids, 2):
+            interaccion = self.adyacencia.get(a, {}).get(b)
+            if interaccion is not None:
+                encontradas.append({
+                    'medicamento_id_1': a,
+                    'medicamento_id_2': b,
+                    'tipo': interaccion[0],
+                    'severidad': interaccion[1],
+                    'descripcion': interaccion[2]
+                })
+        encontradas.sort(key=lambda i: _ORDEN_SEVERIDAD.get(i['severidad'], -1), reverse=True)
+        return encontradas
+
+_grafo = None
+_lock = threading.Lock()
+
+class Interaccion:
+    """Consultas de interacciones sobre el grafo del proceso"""
+
+    @staticmethod
+    def grafo():
+        """Grafo vigente; comprueba la versión en la BD como mucho cada INTERACCIONES_VERIFICAR_SEGUNDOS"""
+        global _grafo
+        grafo = _grafo
+        if grafo is not None and time.monotonic() - grafo.cargado < INTERACCIONES_VERIFICAR_SEGUNDOS:
+            return grafo
+        with _lock:
+            if _grafo is not grafo:
+                # Otro hilo lo recargó mientras esperábamos
+                return _grafo
+            with get_db_cursor(commit=False) as cursor:
+                cursor.execute("SELECT version FROM versiones_datos WHERE tabla = 'interacciones_medicamentos'")
+                row = cursor.fetchone()
+                version = row[0] if row else 0
+                if grafo is not None and grafo.version == version:
+                    grafo.cargado = time.monotonic()
+                    return grafo
+                cursor.execute(
+                    """SELECT medicamento_id_1, medicamento_id_2, tipo_interaccion, severidad, descripcion
+                       FROM interacciones_medicamentos
+                       WHERE medicamento_id_1 IS NOT NULL AND medicamento_id_2 IS NOT NULL"""
+                )
+                _grafo = GrafoInteracciones(version, cursor.fetchall())
+            return _grafo
+
+    @staticmethod
+    def verificar(medicamento_ids):
+        """Interacciones entre los medicamentos indicados (lista de diccionarios)"""
+        return Interaccion.grafo().interacciones(medicamento_ids)
+
+    @staticmethod
+    def invalidar():
+        """Forzar la comprobación de versión en la próxima consulta"""
+        global _grafo
+        with _lock:
+            if _grafo is not None:
+                _grafo.cargado = float('-inf')
+
+    @staticmethod
+    def crear(medicamento_id_1, medicamento_id_2, tipo_interaccion, severidad, descripcion=None):
+        """Registrar una interacción (el par se guarda ordenado)"""
+        if severidad not in SEVERIDADES:
+            raise ValueError(f"Severidad no válida: {severidad}")
+        if medicamento_id_1 == medicamento_id_2:
+            raise ValueError("Una interacción requiere dos medicamentos distintos")
+        a, b = sorted((medicamento_id_1, medicamento_id_2))
+        with get_db_cursor() as cursor:
+            cursor.execute(
+                """INSERT INTO interacciones_medicamentos
+                   (medicamento_id_1, medicamento_id_2, tipo_interaccion, severidad, descripcion)
+                   VALUES (%s, %s, %s, %s, %s) RETURNING id""",
+                (a, b, tipo_interaccion, severidad, descripcion)
+            )
+            interaccion_id = cursor.fetchone()[0]
+        Interaccion.invalidar()
+        return interaccion_id
@@ -1,20 +1,64 @@
-from database import get_db_cursor
+import hashlib
+import json
+import os
+
+from database import (get_db_cursor, extension_instalada, patron_like, ejecutar_con_bloqueo,
+                      ejecutar_preparada, reintentar_bloqueos, ERRORES_BLOQUEO,
+                      BLOQUEO_TIMEOUT_MS)
 from psycopg2 import sql
+from psycopg2.extras import Json, execute_values
 import psycopg2
 
+import auditoria
+import filas
+from cache import CacheTTL
+
+# Horas que se conservan las claves de idempotencia de ventas y compras
+IDEMPOTENCIA_HORAS = int(os.getenv('IDEMPOTENCIA_HORAS', '24'))
+
+# Lotes fragmentados (migración 014): máximo de fragmentos por lote, unidades
+# mínimas por fragmento al repartir y segundos que se cachea la lista de lotes
+FRAGMENTOS_MAX = int(os.getenv('FRAGMENTOS_MAX', '32'))
+FRAGMENTOS_MINIMO = int(os.getenv('FRAGMENTOS_MINIMO', '10'))
+FRAGMENTOS_CACHE_TTL = float(os.getenv('FRAGMENTOS_CACHE_TTL', '30'))
+
+_cache_fragmentos = CacheTTL(ttl=FRAGMENTOS_CACHE_TTL)
+
+CAMPOS_MEDICAMENTO = ('nombre', 'descripcion', 'principio_activo', 'categoria', 'requiere_receta')
+CAMPOS_LOTE = ('medicamento_id', 'numero_lote', 'cantidad_actual', 'precio_unitario',
+               'fecha_fabricacion', 'fecha_caducidad', 'proveedor')
+
+# Registros de las filas que devuelven los listados (filas.py)
+FilaMedicamento = filas.registro('FilaMedicamento', ('id',) + CAMPOS_MEDICAMENTO)
+FilaInventario = filas.registro('FilaInventario', (
+    'medicamento_id', 'medicamento', 'principio_activo', 'lote_id', 'numero_lote',
+    'cantidad_actual', 'precio_unitario', 'fecha_caducidad', 'version', 'estado_caducidad'
+))
+FilaFragmento = filas.registro('FilaFragmento', ('fragmento', 'disponible', 'vendido', 'ventas', 'fecha_pendiente'))
+FilaAlerta = filas.registro('FilaAlerta', (
+    'id', 'lote_id', 'numero_lote', 'medicamento', 'tipo', 'fecha_caducidad',
+    'cantidad', 'fecha_alerta', 'atendida'
+))
+FilaTransaccion = filas.registro('FilaTransaccion', (
+    'id', 'tipo', 'medicamento', 'numero_lote', 'usuario', 'cantidad', 'precio_total', 'fecha'
+))
+
 class Medicamento:
     """Modelo para medicamentos"""
 
     @staticmethod
     def crear(nombre, descripcion, principio_activo, categoria, requiere_receta):
         """Crear nuevo medicamento"""
+        valores = (nombre, descripcion, principio_activo, categoria, requiere_receta)
         with get_db_cursor() as cursor:
             cursor.execute(
                 """INSERT INTO medicamentos (nombre, descripcion, principio_activo, categoria, requiere_receta)
                    VALUES (%s, %s, %s, %s, %s) RETURNING id""",
-                (nombre, descripcion, principio_activo, categoria, requiere_receta)
+                valores
             )
-            return cursor.fetchone()[0]
+            medicamento_id = cursor.fetchone()[0]
+        auditoria.registrar('medicamentos', medicamento_id, despues=dict(zip(CAMPOS_MEDICAMENTO, valores)))
+        return medicamento_id
 
     @staticmethod
     def listar():
@@ -24,17 +68,7 @@ class Medicamento:
                 """SELECT id, nombre, descripcion, principio_activo, categoria, requiere_receta
                    FROM medicamentos ORDER BY nombre"""
             )
-            medicamentos = []
-            for row in cursor.fetchall():
-                medicamentos.append({
-                    'id': row[0],
-                    'nombre': row[1],
-                    'descripcion': row[2],
-                    'principio_activo': row[3],
-                    'categoria': row[4],
-                    'requiere_receta': row[5]
-                })
-            return medicamentos
+            return filas.listar(cursor, FilaMedicamento)
 
     @staticmethod
     def obtener_por_id(medicamento_id):
@@ -57,34 +91,177 @@ class Medicamento:
                 }
         return None
 
+    @staticmethod
+    def buscar(texto, limite=20):
+        """
+        Medicamentos cuyo nombre, principio activo o categoría contiene el texto
+        o se parece a él (índices de trigramas, migración 009), del más al menos
+        parecido. Sin pg_trgm solo hay coincidencias parciales.
+        """
+        texto = (texto or '').strip()
+        if not texto:
+            return []
+        parametros = {'texto': texto, 'patron': patron_like(texto), 'limite': limite}
+        with get_db_cursor(commit=False) as cursor:
+            if extension_instalada(cursor, 'pg_trgm'):
+                # word_similarity: el texto escrito hasta ahora contra la palabra más parecida
+                cursor.execute(
+                    """SELECT id, nombre, descripcion, principio_activo, categoria, requiere_receta
+                       FROM medicamentos
+                       WHERE nombre ILIKE %(patron)s OR principio_activo ILIKE %(patron)s
+                          OR categoria ILIKE %(patron)s
+                          OR %(texto)s <%% nombre OR %(texto)s <%% principio_activo
+                       ORDER BY GREATEST(word_similarity(%(texto)s, nombre),
+                                         word_similarity(%(texto)s, principio_activo),
+                                         word_similarity(%(texto)s, COALESCE(categoria, ''))) DESC,
+                                nombre
+                       LIMIT %(limite)s""",
+                    parametros
+                )
+            else:
+                cursor.execute(
+                    """SELECT id, nombre, descripcion, principio_activo, categoria, requiere_receta
+                       FROM medicamentos
+                       WHERE nombre ILIKE %(patron)s OR principio_activo ILIKE %(patron)s
+                          OR categoria ILIKE %(patron)s
+                       ORDER BY nombre ILIKE %(patron)s DESC, nombre
+                       LIMIT %(limite)s""",
+                    parametros
+                )
+            return filas.listar(cursor, FilaMedicamento)
+
     @staticmethod
     def actualizar(medicamento_id, nombre, descripcion, principio_activo, categoria, requiere_receta):
         """Actualizar medicamento existente"""
         with get_db_cursor() as cursor:
+            # La subconsulta bloquea la fila y devuelve sus valores previos para la auditoría
             cursor.execute(
-                """UPDATE medicamentos 
+                """UPDATE medicamentos m
                    SET nombre = %s, descripcion = %s, principio_activo = %s, 
                        categoria = %s, requiere_receta = %s
-                   WHERE id = %s""",
+                   FROM (SELECT id, nombre, descripcion, principio_activo, categoria, requiere_receta
+                         FROM medicamentos WHERE id = %s FOR UPDATE) antes
+                   WHERE m.id = antes.id
+                   RETURNING antes.nombre, antes.descripcion, antes.principio_activo, antes.categoria,
+                             antes.requiere_receta,
+                             m.nombre, m.descripcion, m.principio_activo, m.categoria, m.requiere_receta""",
                 (nombre, descripcion, principio_activo, categoria, requiere_receta, medicamento_id)
             )
-            return cursor.rowcount > 0
+            row = cursor.fetchone()
+        if row is None:
+            return False
+        auditoria.registrar('medicamentos', medicamento_id, *auditoria.dividir_fila(row, CAMPOS_MEDICAMENTO))
+        return True
 
     @staticmethod
     def eliminar(medicamento_id):
         """Eliminar medicamento (solo si no tiene lotes asociados)"""
         with get_db_cursor() as cursor:
-            cursor.execute("DELETE FROM medicamentos WHERE id = %s", (medicamento_id,))
-            return cursor.rowcount > 0
+            cursor.execute(
+                """DELETE FROM medicamentos WHERE id = %s
+                   RETURNING nombre, descripcion, principio_activo, categoria, requiere_receta""",
+                (medicamento_id,)
+            )
+            row = cursor.fetchone()
+        if row is None:
+            return False
+        auditoria.registrar('medicamentos', medicamento_id, antes=dict(zip(CAMPOS_MEDICAMENTO, row)))
+        return True
+
+# Columnas de vista_inventario en el orden de FilaInventario
+SELECT_INVENTARIO = """SELECT medicamento_id, medicamento, principio_activo, lote_id, 
+                              numero_lote, cantidad_actual, precio_unitario, fecha_caducidad, 
+                              version, estado_caducidad
+                       FROM vista_inventario"""
+
+def _contexto_movimiento(cursor, origen, usuario_id=None):
+    """
+    Origen y usuario que el trigger de movimientos_stock anota en esta
+    transacción, y espera máxima por cada bloqueo de fila (SET LOCAL lock_timeout)
+    """
+    ejecutar_preparada(
+        cursor, 'contexto_movimiento',
+        """SELECT set_config('pharmaflow.origen', %s, true),
+                  set_config('pharmaflow.usuario_id', %s, true),
+                  set_config('lock_timeout', %s, true)""",
+        (origen, str(usuario_id) if usuario_id else '', str(BLOQUEO_TIMEOUT_MS))
+    )
+
+# Resultado de una venta o compra que agotó los reintentos por bloqueo
+OCUPADO = (False, "Conflicto de concurrencia: el lote está ocupado por otra operación. Intente nuevamente.", None)
+
+class _Rechazada(Exception):
+    """
+    Operación rechazada a mitad de la transacción: al lanzarla dentro de
+    get_db_cursor se deshace todo lo hecho, y quien la captura retorna resultado
+    """
+
+    def __init__(self, resultado):
+        super().__init__(resultado[1])
+        self.resultado = resultado
+
+def _lotes_fragmentados(cursor):
+    """
+    Ids de los lotes fragmentados, en caché. Solo decide si una venta intenta
+    primero un fragmento: la venta comprueba igualmente el estado del lote.
+    Al expirar la caché se consulta con el cursor de la venta (no con otra
+    conexión del pool).
+    """
+    def consultar():
+        cursor.execute("SELECT DISTINCT lote_id FROM lotes_fragmentos")
+        return frozenset(row[0] for row in cursor.fetchall())
+    return _cache_fragmentos.obtener_o_calcular('lotes', consultar)
+
+def _vender_de_fragmento(cursor, lote_id, usuario_id, cantidad):
+    """
+    Vender desde un fragmento libre del lote, elegido al azar, sin bloquear la
+    fila del lote (FOR UPDATE SKIP LOCKED: un fragmento ocupado no hace esperar).
+    Retorna el id de la transacción, o None si ningún fragmento libre tiene
+    stock suficiente (o el lote ya no está fragmentado).
+    """
+    ejecutar_preparada(
+        cursor, 'venta_fragmento',
+        """UPDATE lotes_fragmentos f
+           SET disponible = f.disponible - %(cantidad)s, vendido = f.vendido + %(cantidad)s,
+               importe = f.importe + l.precio_unitario * %(cantidad)s, ventas = f.ventas + 1,
+               fecha_pendiente = CURRENT_DATE
+           FROM lotes_medicamentos l
+           WHERE l.id = f.lote_id
+             AND (f.lote_id, f.fragmento) = (
+                 SELECT lote_id, fragmento FROM lotes_fragmentos
+                 WHERE lote_id = %(lote_id)s AND disponible >= %(cantidad)s
+                   AND (fecha_pendiente IS NULL OR fecha_pendiente = CURRENT_DATE)
+                 ORDER BY random()
+                 LIMIT 1
+                 FOR UPDATE SKIP LOCKED)
+           RETURNING l.precio_unitario""",
+        {'lote_id': lote_id, 'cantidad': cantidad}
+    )
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    # El resumen diario de estas ventas lo acumula fusionar_fragmentos
+    cursor.execute(
+        """SELECT set_config('pharmaflow.omitir_resumen', 'on', true);
+           INSERT INTO transacciones (tipo, lote_id, usuario_id, cantidad, precio_total)
+           VALUES ('venta', %s, %s, %s, %s) RETURNING id""",
+        (lote_id, usuario_id, cantidad, row[0] * cantidad)
+    )
+    transaccion_id = cursor.fetchone()[0]
+    cursor.execute("SELECT set_config('pharmaflow.omitir_resumen', 'off', true)")
+    return transaccion_id
 
 class LoteMedicamento:
     """Modelo para lotes de medicamentos con control de concurrencia"""
 
+    ESTADOS_CADUCIDAD = ('vigente', 'proximo_a_caducar', 'caducado')
+
     @staticmethod
     def crear(medicamento_id, numero_lote, cantidad, precio_unitario,
-              fecha_fabricacion, fecha_caducidad, proveedor):
+              fecha_fabricacion, fecha_caducidad, proveedor, usuario_id=None):
         """Crear nuevo lote"""
         with get_db_cursor() as cursor:
+            _contexto_movimiento(cursor, 'alta', usuario_id)
             cursor.execute(
                 """INSERT INTO lotes_medicamentos 
                    (medicamento_id, numero_lote, cantidad_actual, cantidad_inicial, 
@@ -93,41 +270,75 @@ class LoteMedicamento:
                 (medicamento_id, numero_lote, cantidad, cantidad, precio_unitario,
                  fecha_fabricacion, fecha_caducidad, proveedor)
             )
-            return cursor.fetchone()[0]
+            lote_id = cursor.fetchone()[0]
+        auditoria.registrar('lotes_medicamentos', lote_id, despues=dict(zip(CAMPOS_LOTE, (
+            medicamento_id, numero_lote, cantidad, precio_unitario, fecha_fabricacion, fecha_caducidad, proveedor
+        ))), usuario_id=usuario_id)
+        return lote_id
 
     @staticmethod
     def listar_inventario():
         """Listar inventario usando la vista optimizada"""
+        with get_db_cursor(commit=False) as cursor:
+            cursor.execute(SELECT_INVENTARIO + " ORDER BY fecha_caducidad")
+            return filas.listar(cursor, FilaInventario)
+
+    @staticmethod
+    def listar_por_medicamento(medicamento_id):
+        """Lotes con stock de un medicamento, del que caduca antes al que caduca después"""
         with get_db_cursor(commit=False) as cursor:
             cursor.execute(
-                """SELECT medicamento_id, medicamento, principio_activo, lote_id, 
-                          numero_lote, cantidad_actual, precio_unitario, fecha_caducidad, 
-                          version, estado_caducidad
-                   FROM vista_inventario"""
+                SELECT_INVENTARIO + " WHERE medicamento_id = %s ORDER BY fecha_caducidad",
+                (medicamento_id,)
             )
-            inventario = []
-            for row in cursor.fetchall():
-                inventario.append({
-                    'medicamento_id': row[0],
-                    'medicamento': row[1],
-                    'principio_activo': row[2],
-                    'lote_id': row[3],
-                    'numero_lote': row[4],
-                    'cantidad_actual': row[5],
-                    'precio_unitario': float(row[6]),
-                    'fecha_caducidad': row[7],
-                    'version': row[8],
-                    'estado_caducidad': row[9]
-                })
-            return inventario
+            return filas.listar(cursor, FilaInventario)
+
+    @staticmethod
+    def listar_por_estado(estado, limite=500):
+        """
+        Listar lotes con stock en un estado de caducidad ('vigente',
+        'proximo_a_caducar' o 'caducado'), del que caduca antes al que caduca después.
+        Los dos últimos se resuelven con los índices parciales de cada estado.
+        """
+        with get_db_cursor(commit=False) as cursor:
+            cursor.execute(
+                SELECT_INVENTARIO + " WHERE estado_caducidad = %s ORDER BY fecha_caducidad LIMIT %s",
+                (estado, limite)
+            )
+            return filas.listar(cursor, FilaInventario)
+
+    @staticmethod
+    def contar_por_estado(*estados):
+        """Contar lotes con stock en los estados de caducidad indicados"""
+        # Un conteo por estado para que cada uno use su índice parcial
+        subconsultas = " + ".join(
+            ["""(SELECT COUNT(*) FROM lotes_medicamentos
+                 WHERE estado_caducidad = %s AND cantidad_actual > 0)"""] * len(estados)
+        )
+        with get_db_cursor(commit=False) as cursor:
+            cursor.execute(f"SELECT {subconsultas}", estados)
+            return cursor.fetchone()[0]
+
+    @staticmethod
+    def recalcular_estados_caducidad():
+        """
+        Actualizar el estado de los lotes que cruzaron un umbral de caducidad.
+        Pensado para ejecutarse a diario (ver tareas.py); retorna los lotes actualizados.
+        """
+        with get_db_cursor() as cursor:
+            cursor.execute("SELECT recalcular_estados_caducidad()")
+            return cursor.fetchone()[0]
 
     @staticmethod
     def obtener_por_id(lote_id):
         """Obtener lote por ID con información del medicamento"""
         with get_db_cursor(commit=False) as cursor:
-            cursor.execute(
+            ejecutar_preparada(
+                cursor, 'lote_por_id',
                 """SELECT l.id, l.medicamento_id, m.nombre, l.numero_lote, 
-                          l.cantidad_actual, l.precio_unitario, l.fecha_fabricacion,
+                          l.cantidad_actual - COALESCE(
+                              (SELECT SUM(f.vendido) FROM lotes_fragmentos f WHERE f.lote_id = l.id), 0),
+                          l.precio_unitario, l.fecha_fabricacion,
                           l.fecha_caducidad, l.proveedor, l.version
                    FROM lotes_medicamentos l
                    JOIN medicamentos m ON l.medicamento_id = m.id
@@ -151,117 +362,455 @@ class LoteMedicamento:
         return None
 
     @staticmethod
-    def actualizar_cantidad_optimista(lote_id, nueva_cantidad, version_esperada):
+    def medicamentos_de_lotes(lote_ids):
+        """Diccionario lote_id -> medicamento_id de los lotes indicados"""
+        with get_db_cursor(commit=False) as cursor:
+            cursor.execute(
+                "SELECT id, medicamento_id FROM lotes_medicamentos WHERE id = ANY(%s)",
+                (list(lote_ids),)
+            )
+            return dict(cursor.fetchall())
+
+    @staticmethod
+    def ids_por_numero(numeros_lote):
+        """Diccionario numero_lote -> id de los lotes indicados (los que existen)"""
+        with get_db_cursor(commit=False) as cursor:
+            cursor.execute(
+                "SELECT numero_lote, id FROM lotes_medicamentos WHERE numero_lote = ANY(%s)",
+                (list(numeros_lote),)
+            )
+            return dict(cursor.fetchall())
+
+    @staticmethod
+    def fragmentar(lote_id, fragmentos):
         """
-        Actualizar cantidad con control de concurrencia optimista.
-        Retorna True si tuvo éxito, False si hubo conflicto de versión.
+        Repartir el stock del lote entre varios fragmentos para que las ventas
+        concurrentes no se serialicen en su fila (ver migración 014).
+        Con fragmentos=0 vuelve al modo normal. Retorna False si el lote no existe.
         """
+        if not 0 <= fragmentos <= FRAGMENTOS_MAX:
+            raise ValueError(f"El número de fragmentos debe estar entre 0 y {FRAGMENTOS_MAX}")
         with get_db_cursor() as cursor:
-            # Intentar actualizar solo si la versión coincide
+            cursor.execute("SELECT id FROM lotes_medicamentos WHERE id = %s FOR NO KEY UPDATE", (lote_id,))
+            if cursor.fetchone() is None:
+                return False
+            cursor.execute("SELECT fusionar_fragmentos(%s)", (lote_id,))
             cursor.execute(
-                """UPDATE lotes_medicamentos 
-                   SET cantidad_actual = %s, version = version + 1
-                   WHERE id = %s AND version = %s""",
-                (nueva_cantidad, lote_id, version_esperada)
+                "DELETE FROM lotes_fragmentos WHERE lote_id = %s AND fragmento >= %s",
+                (lote_id, fragmentos)
             )
+            if fragmentos:
+                cursor.execute(
+                    """INSERT INTO lotes_fragmentos (lote_id, fragmento)
+                       SELECT %s, generate_series(0, %s - 1)
+                       ON CONFLICT DO NOTHING""",
+                    (lote_id, fragmentos)
+                )
+                cursor.execute("SELECT repartir_fragmentos(%s, %s)", (lote_id, FRAGMENTOS_MINIMO))
+        _cache_fragmentos.invalidar()
+        return True
 
-            # Verificar si se actualizó alguna fila
-            return cursor.rowcount > 0
+    @staticmethod
+    def listar_fragmentos(lote_id):
+        with get_db_cursor(commit=False) as cursor:
+            cursor.execute(
+                """SELECT fragmento, disponible, vendido, ventas, fecha_pendiente
+                   FROM lotes_fragmentos WHERE lote_id = %s ORDER BY fragmento""",
+                (lote_id,)
+            )
+            return filas.listar(cursor, FilaFragmento)
+
+    @staticmethod
+    def rebalancear_fragmentos(minimo=FRAGMENTOS_MINIMO):
+        """
+        Aplicar a cada lote fragmentado sus ventas pendientes y volver a repartir
+        su stock (incluidas las compras recibidas desde el último reparto).
+        Cada lote en su propia transacción, con espera acotada y reintentos;
+        retorna los lotes rebalanceados (un lote que sigue ocupado queda para
+        la próxima ejecución).
+        """
+        with get_db_cursor(commit=False) as cursor:
+            cursor.execute(
+                """SELECT f.lote_id
+                   FROM lotes_fragmentos f
+                   JOIN lotes_medicamentos l ON l.id = f.lote_id
+                   GROUP BY f.lote_id, l.cantidad_actual
+                   HAVING SUM(f.ventas) > 0 OR SUM(f.disponible) + SUM(f.vendido) <> l.cantidad_actual
+                   ORDER BY f.lote_id"""
+            )
+            lote_ids = [row[0] for row in cursor.fetchall()]
+        return sum(LoteMedicamento._rebalancear_lote(lote_id, minimo) for lote_id in lote_ids)
+
+    @staticmethod
+    @reintentar_bloqueos(agotado=False)
+    def _rebalancear_lote(lote_id, minimo):
+        with get_db_cursor() as cursor:
+            _contexto_movimiento(cursor, 'venta')
+            cursor.execute("SELECT fusionar_fragmentos(%s)", (lote_id,))
+            cursor.execute("SELECT repartir_fragmentos(%s, %s)", (lote_id, minimo))
+        return True
 
     @staticmethod
+    def actualizar_cantidad_optimista(lote_id, nueva_cantidad, version_esperada):
+        """
+        Actualizar cantidad con control de concurrencia optimista.
+        Retorna True si tuvo éxito, False si hubo conflicto de versión.
+        La versión se compara con la del lote antes de aplicarle las ventas
+        pendientes de sus fragmentos (la versión que ve el llamador en el lote
+        y en vista_inventario), como en un lote sin fragmentar.
+        """
+        try:
+            with get_db_cursor() as cursor:
+                _contexto_movimiento(cursor, 'ajuste')
+                # Si la versión coincide, el lote queda bloqueado hasta el final: la
+                # fusión de los fragmentos incrementa la versión, pero ya no puede
+                # cambiar nadie más entre la comprobación y la actualización
+                cursor.execute(
+                    """SELECT 1 FROM lotes_medicamentos
+                       WHERE id = %s AND version = %s FOR NO KEY UPDATE""",
+                    (lote_id, version_esperada)
+                )
+                if cursor.fetchone() is None:
+                    return False
+                cursor.execute("SELECT fusionar_fragmentos(%s)", (lote_id,))
+                cursor.execute(
+                    """UPDATE lotes_medicamentos 
+                       SET cantidad_actual = %s, version = version + 1
+                       WHERE id = %s""",
+                    (nueva_cantidad, lote_id)
+                )
+                cursor.execute("SELECT repartir_fragmentos(%s, %s)", (lote_id, FRAGMENTOS_MINIMO))
+            return True
+        except ERRORES_BLOQUEO:
+            # Otra operación retuvo el lote más de lock_timeout: también es un conflicto
+            return False
+
+    @staticmethod
+    @reintentar_bloqueos(agotado=False)
     def actualizar_cantidad_pesimista(lote_id, nueva_cantidad):
         """
         Actualizar cantidad con control de concurrencia pesimista (row lock).
-        Usa SELECT FOR UPDATE para bloquear la fila.
+        Usa SELECT FOR NO KEY UPDATE para bloquear la fila, esperando como mucho
+        BLOQUEO_TIMEOUT_MS (con reintentos); False si no existe o sigue ocupada.
         """
         with get_db_cursor() as cursor:
+            _contexto_movimiento(cursor, 'ajuste')
             # Bloquear la fila para evitar modificaciones concurrentes
-            cursor.execute(
+            ejecutar_con_bloqueo(
+                cursor,
                 """SELECT cantidad_actual, version FROM lotes_medicamentos 
-                   WHERE id = %s FOR UPDATE""",
-                (lote_id,)
+                   WHERE id = %s FOR NO KEY UPDATE""",
+                (lote_id,), 'ajuste'
             )
             result = cursor.fetchone()
 
             if result:
+                # La nueva cantidad reemplaza al stock con las ventas pendientes aplicadas
+                cursor.execute("SELECT fusionar_fragmentos(%s)", (lote_id,))
                 cursor.execute(
                     """UPDATE lotes_medicamentos 
                        SET cantidad_actual = %s, version = version + 1
                        WHERE id = %s""",
                     (nueva_cantidad, lote_id)
                 )
+                cursor.execute("SELECT repartir_fragmentos(%s, %s)", (lote_id, FRAGMENTOS_MINIMO))
                 return True
         return False
 
     @staticmethod
-    def actualizar(lote_id, numero_lote, cantidad_actual, precio_unitario, fecha_fabricacion, fecha_caducidad, proveedor):
-        """Actualizar lote de medicamento"""
+    def actualizar(lote_id, numero_lote, cantidad_actual, precio_unitario, fecha_fabricacion, fecha_caducidad, proveedor,
+                   usuario_id=None):
+        """Actualizar lote de medicamento (un cambio de cantidad queda como ajuste en movimientos_stock)"""
         with get_db_cursor() as cursor:
+            _contexto_movimiento(cursor, 'ajuste', usuario_id)
+            # En un lote fragmentado el ajuste parte del stock con las ventas pendientes aplicadas
+            cursor.execute("SELECT fusionar_fragmentos(%s)", (lote_id,))
             cursor.execute(
-                """UPDATE lotes_medicamentos 
+                """UPDATE lotes_medicamentos l
                    SET numero_lote = %s, cantidad_actual = %s, precio_unitario = %s,
                        fecha_fabricacion = %s, fecha_caducidad = %s, proveedor = %s,
-                       version = version + 1
-                   WHERE id = %s""",
+                       version = l.version + 1
+                   FROM (SELECT id, medicamento_id, numero_lote, cantidad_actual, precio_unitario,
+                                fecha_fabricacion, fecha_caducidad, proveedor
+                         FROM lotes_medicamentos WHERE id = %s FOR NO KEY UPDATE) antes
+                   WHERE l.id = antes.id
+                   RETURNING antes.medicamento_id, antes.numero_lote, antes.cantidad_actual,
+                             antes.precio_unitario, antes.fecha_fabricacion, antes.fecha_caducidad,
+                             antes.proveedor,
+                             l.medicamento_id, l.numero_lote, l.cantidad_actual, l.precio_unitario,
+                             l.fecha_fabricacion, l.fecha_caducidad, l.proveedor""",
                 (numero_lote, cantidad_actual, precio_unitario, fecha_fabricacion,
                  fecha_caducidad, proveedor, lote_id)
             )
-            return cursor.rowcount > 0
+            row = cursor.fetchone()
+            cursor.execute("SELECT repartir_fragmentos(%s, %s)", (lote_id, FRAGMENTOS_MINIMO))
+        if row is None:
+            return False
+        auditoria.registrar('lotes_medicamentos', lote_id, *auditoria.dividir_fila(row, CAMPOS_LOTE),
+                            usuario_id=usuario_id)
+        return True
 
     @staticmethod
-    def eliminar(lote_id):
+    def eliminar(lote_id, usuario_id=None):
         """Eliminar lote (solo si no tiene transacciones)"""
         with get_db_cursor() as cursor:
-            cursor.execute("DELETE FROM lotes_medicamentos WHERE id = %s", (lote_id,))
+            _contexto_movimiento(cursor, 'baja', usuario_id)
+            # Las ventas pendientes de un lote fragmentado llegan al libro antes de la baja
+            cursor.execute("SELECT fusionar_fragmentos(%s)", (lote_id,))
+            cursor.execute(
+                """DELETE FROM lotes_medicamentos WHERE id = %s
+                   RETURNING medicamento_id, numero_lote, cantidad_actual, precio_unitario,
+                             fecha_fabricacion, fecha_caducidad, proveedor""",
+                (lote_id,)
+            )
+            row = cursor.fetchone()
+        if row is None:
+            return False
+        auditoria.registrar('lotes_medicamentos', lote_id, antes=dict(zip(CAMPOS_LOTE, row)),
+                            usuario_id=usuario_id)
+        return True
+
+def _leer_marca(cursor, tarea):
+    """
+    Fecha hasta la que procesó una tarea incremental ('-infinity' si nunca se
+    ejecutó). El FOR UPDATE serializa ejecuciones concurrentes de la tarea.
+    """
+    cursor.execute("SELECT ultima_fecha FROM marcas_tareas WHERE tarea = %s FOR UPDATE", (tarea,))
+    fila = cursor.fetchone()
+    return fila[0] if fila and fila[0] else '-infinity'
+
+def _guardar_marca(cursor, tarea):
+    cursor.execute(
+        """INSERT INTO marcas_tareas (tarea, ultima_fecha, ultima_ejecucion)
+           VALUES (%s, CURRENT_DATE, CURRENT_TIMESTAMP)
+           ON CONFLICT (tarea) DO UPDATE
+           SET ultima_fecha = EXCLUDED.ultima_fecha,
+               ultima_ejecucion = EXCLUDED.ultima_ejecucion""",
+        (tarea,)
+    )
+
+class AlertaCaducidad:
+    """Alertas de lotes que cruzan los umbrales de caducidad"""
+
+    TAREA = 'alertas_caducidad'
+
+    @staticmethod
+    def generar():
+        """
+        Crear las alertas de los lotes que cruzaron un umbral desde la última ejecución.
+
+        Solo recorre en idx_lotes_caducidad las fechas que entraron en cada umbral
+        desde la marca de agua ([marca + 3 meses, hoy + 3 meses) y [marca, hoy)),
+        así que el trabajo es proporcional a los días transcurridos y no al
+        inventario. Los lotes que ya nacen dentro de un umbral los alerta el
+        trigger trigger_lotes_alerta_caducidad. Retorna las alertas creadas.
+        """
+        with get_db_cursor() as cursor:
+            desde = _leer_marca(cursor, AlertaCaducidad.TAREA)
+
+            cursor.execute(
+                """INSERT INTO alertas_caducidad (lote_id, tipo, fecha_caducidad, cantidad)
+                   SELECT id,
+                          CASE WHEN fecha_caducidad < CURRENT_DATE
+                               THEN 'caducado' ELSE 'proximo_a_caducar' END,
+                          fecha_caducidad, cantidad_actual
+                   FROM lotes_medicamentos
+                   WHERE cantidad_actual > 0
+                     AND ((fecha_caducidad >= %(desde)s::date + INTERVAL '3 months'
+                           AND fecha_caducidad < CURRENT_DATE + INTERVAL '3 months')
+                       OR (fecha_caducidad >= %(desde)s::date
+                           AND fecha_caducidad < CURRENT_DATE))
+                   ON CONFLICT (lote_id, tipo) DO NOTHING""",
+                {'desde': desde}
+            )
+            creadas = cursor.rowcount
+            _guardar_marca(cursor, AlertaCaducidad.TAREA)
+            return creadas
+
+    @staticmethod
+    def listar(despues_de=None, limite=50, solo_pendientes=True):
+        """
+        Listar alertas de la más reciente a la más antigua, paginando por id
+        (despues_de es el id de la última alerta de la página anterior).
+        """
+        condiciones = []
+        parametros = []
+        if solo_pendientes:
+            condiciones.append("NOT a.atendida")
+        if despues_de is not None:
+            condiciones.append("a.id < %s")
+            parametros.append(despues_de)
+        where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+
+        with get_db_cursor(commit=False) as cursor:
+            cursor.execute(
+                f"""SELECT a.id, a.lote_id, l.numero_lote, m.nombre, a.tipo,
+                           a.fecha_caducidad, a.cantidad, a.fecha_alerta, a.atendida
+                    FROM alertas_caducidad a
+                    JOIN lotes_medicamentos l ON a.lote_id = l.id
+                    JOIN medicamentos m ON l.medicamento_id = m.id
+                    {where}
+                    ORDER BY a.id DESC
+                    LIMIT %s""",
+                parametros + [limite]
+            )
+            return filas.listar(cursor, FilaAlerta)
+
+    @staticmethod
+    def atender(alerta_id):
+        """Marcar una alerta como atendida"""
+        with get_db_cursor() as cursor:
+            cursor.execute(
+                "UPDATE alertas_caducidad SET atendida = TRUE WHERE id = %s AND NOT atendida",
+                (alerta_id,)
+            )
             return cursor.rowcount > 0
 
+class ClaveIdempotencia:
+    """
+    Claves de idempotencia de ventas y compras (migración 013).
+    La operación guarda su clave y su resultado en su propia transacción y
+    solo si tiene éxito; un reintento con la misma clave recibe ese resultado.
+    """
+
+    @staticmethod
+    def huella(operacion, items):
+        """Resumen de la operación y sus líneas (lote_id, cantidad)"""
+        datos = json.dumps([operacion, sorted([int(l), int(c)] for l, c in items)])
+        return hashlib.sha256(datos.encode()).hexdigest()
+
+    @staticmethod
+    def previo(cursor, clave, usuario_id, huella):
+        """Resultado de una operación anterior con la misma clave, o None"""
+        cursor.execute(
+            "SELECT huella, resultado FROM claves_idempotencia WHERE usuario_id = %s AND clave = %s",
+            (usuario_id, clave)
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        if row[0] != huella:
+            return (False, "La clave de idempotencia ya se usó con otros datos", None)
+        return tuple(row[1])
+
+    @staticmethod
+    def guardar(cursor, clave, usuario_id, operacion, huella, resultado):
+        cursor.execute(
+            """INSERT INTO claves_idempotencia (usuario_id, clave, operacion, huella, resultado)
+               VALUES (%s, %s, %s, %s, %s)""",
+            (usuario_id, clave, operacion, huella, Json(list(resultado)))
+        )
+
+    @staticmethod
+    def resultado_concurrente(error, clave, usuario_id, huella):
+        """
+        Resultado de la operación que ganó la carrera cuando dos peticiones con
+        la misma clave se ejecutaron a la vez (la perdedora se deshizo)
+        """
+        if error.diag.constraint_name != 'claves_idempotencia_pkey':
+            return (False, f"Error en la base de datos: {str(error)}", None)
+        with get_db_cursor(commit=False) as cursor:
+            return ClaveIdempotencia.previo(cursor, clave, usuario_id, huella)
+
+    @staticmethod
+    def purgar(horas=IDEMPOTENCIA_HORAS):
+        with get_db_cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM claves_idempotencia WHERE creada < LOCALTIMESTAMP - make_interval(hours => %s)",
+                (horas,)
+            )
+            return cursor.rowcount
+
 class Transaccion:
     """Modelo para transacciones de compra/venta"""
 
     @staticmethod
-    def registrar_venta(lote_id, usuario_id, cantidad, usar_optimista=True):
+    @reintentar_bloqueos(agotado=OCUPADO)
+    def registrar_venta(lote_id, usuario_id, cantidad, usar_optimista=True, clave=None):
         """
         Registrar una venta con control de concurrencia.
+        Con clave (de idempotencia), un reintento retorna el resultado original.
         Retorna (exito, mensaje, transaccion_id)
         """
+        huella = ClaveIdempotencia.huella('venta', [(lote_id, cantidad)]) if clave else None
         try:
             with get_db_cursor() as cursor:
+                if clave:
+                    previo = ClaveIdempotencia.previo(cursor, clave, usuario_id, huella)
+                    if previo:
+                        return previo
+                _contexto_movimiento(cursor, 'venta', usuario_id)
+
+                # Lote fragmentado: la venta sale de un fragmento sin bloquear el lote
+                if lote_id in _lotes_fragmentados(cursor):
+                    transaccion_id = _vender_de_fragmento(cursor, lote_id, usuario_id, cantidad)
+                    if transaccion_id is not None:
+                        resultado = (True, "Venta registrada exitosamente", transaccion_id)
+                        if clave:
+                            ClaveIdempotencia.guardar(cursor, clave, usuario_id, 'venta', huella, resultado)
+                        return resultado
+
                 # Obtener información del lote
                 if usar_optimista:
-                    cursor.execute(
-                        """SELECT cantidad_actual, precio_unitario, version 
+                    ejecutar_preparada(
+                        cursor, 'venta_lote',
+                        """SELECT cantidad_actual, precio_unitario, version,
+                                  EXISTS (SELECT 1 FROM lotes_fragmentos f WHERE f.lote_id = lotes_medicamentos.id)
                            FROM lotes_medicamentos WHERE id = %s""",
                         (lote_id,)
                     )
                 else:
-                    # Lock pesimista
-                    cursor.execute(
-                        """SELECT cantidad_actual, precio_unitario, version 
-                           FROM lotes_medicamentos WHERE id = %s FOR UPDATE""",
-                        (lote_id,)
+                    # Lock pesimista, con espera acotada por lock_timeout. Los lotes se
+                    # bloquean FOR NO KEY UPDATE: no choca con el FOR KEY SHARE que la
+                    # clave foránea de transacciones toma al vender de un fragmento
+                    # (FOR UPDATE interbloqueaba con esas ventas, migración 017)
+                    ejecutar_con_bloqueo(
+                        cursor,
+                        """SELECT cantidad_actual, precio_unitario, version,
+                                  EXISTS (SELECT 1 FROM lotes_fragmentos f WHERE f.lote_id = lotes_medicamentos.id)
+                           FROM lotes_medicamentos WHERE id = %s FOR NO KEY UPDATE""",
+                        (lote_id,), 'venta', preparada='venta_lote_bloqueo'
                     )
 
                 result = cursor.fetchone()
                 if not result:
                     return (False, "Lote no encontrado", None)
 
-                cantidad_actual, precio_unitario, version = result
+                cantidad_actual, precio_unitario, version, fragmentado = result
+                if fragmentado:
+                    # Ningún fragmento libre alcanza: se fusionan en el lote (bloqueado),
+                    # se vende del lote y al final se vuelve a repartir
+                    cursor.execute(
+                        """SELECT fusionar_fragmentos(%s);
+                           SELECT cantidad_actual, version FROM lotes_medicamentos WHERE id = %s""",
+                        (lote_id, lote_id)
+                    )
+                    cantidad_actual, version = cursor.fetchone()
+                    usar_optimista = False
 
                 if cantidad_actual < cantidad:
+                    if fragmentado:
+                        cursor.execute("SELECT repartir_fragmentos(%s, %s)", (lote_id, FRAGMENTOS_MINIMO))
                     return (False, f"Stock insuficiente. Disponible: {cantidad_actual}", None)
 
                 nueva_cantidad = cantidad_actual - cantidad
-                precio_total = float(precio_unitario) * cantidad
+                precio_total = precio_unitario * cantidad  # Decimal: precio_unitario es NUMERIC
 
                 # Actualizar cantidad según el método de concurrencia
                 if usar_optimista:
-                    exito = LoteMedicamento.actualizar_cantidad_optimista(
-                        lote_id, nueva_cantidad, version
+                    # En la misma transacción que el registro de la venta
+                    ejecutar_preparada(
+                        cursor, 'venta_actualizar_version',
+                        """UPDATE lotes_medicamentos 
+                           SET cantidad_actual = %s, version = version + 1
+                           WHERE id = %s AND version = %s""",
+                        (nueva_cantidad, lote_id, version)
                     )
-                    if not exito:
+                    if cursor.rowcount == 0:
                         return (False, "Conflicto de concurrencia. Intente nuevamente.", None)
                 else:
-                    cursor.execute(
+                    ejecutar_preparada(
+                        cursor, 'venta_actualizar',
                         """UPDATE lotes_medicamentos 
                            SET cantidad_actual = %s, version = version + 1
                            WHERE id = %s""",
@@ -269,56 +818,280 @@ class Transaccion:
                     )
 
                 # Registrar transacción
-                cursor.execute(
+                ejecutar_preparada(
+                    cursor, 'venta_insertar',
                     """INSERT INTO transacciones 
                        (tipo, lote_id, usuario_id, cantidad, precio_total)
                        VALUES ('venta', %s, %s, %s, %s) RETURNING id""",
                     (lote_id, usuario_id, cantidad, precio_total)
                 )
                 transaccion_id = cursor.fetchone()[0]
+                if fragmentado:
+                    cursor.execute("SELECT repartir_fragmentos(%s, %s)", (lote_id, FRAGMENTOS_MINIMO))
 
-                return (True, "Venta registrada exitosamente", transaccion_id)
+                resultado = (True, "Venta registrada exitosamente", transaccion_id)
+                if clave:
+                    ClaveIdempotencia.guardar(cursor, clave, usuario_id, 'venta', huella, resultado)
+                return resultado
 
+        except ERRORES_BLOQUEO:
+            raise  # los reintenta reintentar_bloqueos
+        except psycopg2.errors.UniqueViolation as e:
+            return ClaveIdempotencia.resultado_concurrente(e, clave, usuario_id, huella)
         except psycopg2.Error as e:
             return (False, f"Error en la base de datos: {str(e)}", None)
 
     @staticmethod
-    def registrar_compra(lote_id, usuario_id, cantidad):
-        """Registrar una compra (incrementa el stock)"""
+    @reintentar_bloqueos(agotado=OCUPADO)
+    def registrar_venta_multiple(items, usuario_id, clave=None):
+        """
+        Registrar en una sola transacción la venta de varios lotes.
+        items: lista de (lote_id, cantidad). Bloquea los lotes en orden de id
+        (pesimista, sin interbloqueos entre carritos) y no modifica ninguno si
+        alguno no tiene stock suficiente; las líneas de lotes fragmentados salen
+        de un fragmento sin bloquear el lote. Con clave (de idempotencia), un
+        reintento retorna el resultado original.
+        Retorna (exito, mensaje, transaccion_ids)
+        """
+        cantidades = {}
+        for lote_id, cantidad in items:
+            if cantidad <= 0:
+                return (False, "Las cantidades deben ser mayores que cero", None)
+            cantidades[lote_id] = cantidades.get(lote_id, 0) + cantidad
+        if not cantidades:
+            return (False, "La venta no tiene productos", None)
+
+        huella = ClaveIdempotencia.huella('venta', cantidades.items()) if clave else None
         try:
             with get_db_cursor() as cursor:
-                cursor.execute(
-                    """SELECT cantidad_actual, precio_unitario 
-                       FROM lotes_medicamentos WHERE id = %s FOR UPDATE""",
-                    (lote_id,)
-                )
-                result = cursor.fetchone()
+                if clave:
+                    previo = ClaveIdempotencia.previo(cursor, clave, usuario_id, huella)
+                    if previo:
+                        return previo
+                _contexto_movimiento(cursor, 'venta', usuario_id)
 
-                if not result:
-                    return (False, "Lote no encontrado", None)
+                # Las líneas de lotes fragmentados salen de un fragmento libre si alguno alcanza
+                transaccion_ids = []
+                pendientes = dict(cantidades)
+                fragmentados = _lotes_fragmentados(cursor)
+                for lote_id in sorted(l for l in cantidades if l in fragmentados):
+                    transaccion_id = _vender_de_fragmento(cursor, lote_id, usuario_id, cantidades[lote_id])
+                    if transaccion_id is not None:
+                        transaccion_ids.append(transaccion_id)
+                        del pendientes[lote_id]
+
+                if pendientes:
+                    ejecutar_con_bloqueo(
+                        cursor,
+                        """SELECT id, cantidad_actual, precio_unitario,
+                                  EXISTS (SELECT 1 FROM lotes_fragmentos f WHERE f.lote_id = lotes_medicamentos.id)
+                           FROM lotes_medicamentos WHERE id = ANY(%s)
+                           ORDER BY id FOR NO KEY UPDATE""",
+                        (sorted(pendientes),), 'venta_multiple'
+                    )
+                    lotes = {row[0]: list(row[1:3]) for row in cursor.fetchall() if not row[3]}
+                    fusionados = sorted(set(pendientes) - set(lotes))
+                    if fusionados:
+                        # Lotes fragmentados sin fragmento suficiente: se venden del lote
+                        cursor.execute(
+                            """SELECT fusionar_fragmentos(id) FROM unnest(%s::int[]) AS id;
+                               SELECT id, cantidad_actual, precio_unitario
+                               FROM lotes_medicamentos WHERE id = ANY(%s)""",
+                            (fusionados, fusionados)
+                        )
+                        lotes.update({row[0]: list(row[1:]) for row in cursor.fetchall()})
+
+                    for lote_id, cantidad in pendientes.items():
+                        if lote_id not in lotes or lotes[lote_id][0] < cantidad:
+                            # Deshace también las líneas ya vendidas de fragmentos
+                            if lote_id not in lotes:
+                                raise _Rechazada((False, f"Lote {lote_id} no encontrado", None))
+                            raise _Rechazada((False, f"Stock insuficiente en el lote {lote_id}. "
+                                                     f"Disponible: {lotes[lote_id][0]}", None))
+
+                    execute_values(
+                        cursor,
+                        """UPDATE lotes_medicamentos l
+                           SET cantidad_actual = l.cantidad_actual - v.cantidad, version = l.version + 1
+                           FROM (VALUES %s) AS v(id, cantidad)
+                           WHERE l.id = v.id""",
+                        sorted(pendientes.items())
+                    )
+                    insertadas = execute_values(
+                        cursor,
+                        """INSERT INTO transacciones (tipo, lote_id, usuario_id, cantidad, precio_total)
+                           VALUES %s RETURNING id""",
+                        [(lote_id, usuario_id, cantidad, lotes[lote_id][1] * cantidad)
+                         for lote_id, cantidad in pendientes.items()],
+                        template="('venta', %s, %s, %s, %s)",
+                        fetch=True
+                    )
+                    transaccion_ids.extend(f[0] for f in insertadas)
+                    for lote_id in fusionados:
+                        cursor.execute("SELECT repartir_fragmentos(%s, %s)", (lote_id, FRAGMENTOS_MINIMO))
+
+                resultado = (True, f"Venta de {len(transaccion_ids)} productos registrada exitosamente", transaccion_ids)
+                if clave:
+                    ClaveIdempotencia.guardar(cursor, clave, usuario_id, 'venta', huella, resultado)
+                return resultado
+
+        except _Rechazada as e:
+            return e.resultado
+        except ERRORES_BLOQUEO:
+            raise  # los reintenta reintentar_bloqueos
+        except psycopg2.errors.UniqueViolation as e:
+            return ClaveIdempotencia.resultado_concurrente(e, clave, usuario_id, huella)
+        except psycopg2.Error as e:
+            return (False, f"Error en la base de datos: {str(e)}", None)
+
+    @staticmethod
+    @reintentar_bloqueos(agotado=OCUPADO)
+    def registrar_venta_asignada(medicamento_id, usuario_id, cantidad, clave=None):
+        """
+        Vender un medicamento sin elegir el lote: se asigna el lote sin caducar
+        con stock suficiente que caduca antes (FEFO), saltando los que otra
+        venta tiene bloqueados (SKIP LOCKED) en lugar de esperarlos. Solo si
+        todos los candidatos están ocupados espera, acotado por lock_timeout.
+        Los lotes fragmentados no se asignan. Con clave (de idempotencia), un
+        reintento retorna el resultado original.
+        Retorna (exito, mensaje, transaccion_id)
+        """
+        if cantidad <= 0:
+            return (False, "La cantidad debe ser mayor que cero", None)
+        huella = ClaveIdempotencia.huella('venta_asignada', [(medicamento_id, cantidad)]) if clave else None
+        consulta = """SELECT id, precio_unitario FROM lotes_medicamentos l
+                      WHERE medicamento_id = %s AND cantidad_actual >= %s
+                        AND estado_caducidad <> 'caducado'
+                        AND NOT EXISTS (SELECT 1 FROM lotes_fragmentos f WHERE f.lote_id = l.id)
+                      ORDER BY fecha_caducidad, id
+                      LIMIT 1 FOR NO KEY UPDATE"""
+        try:
+            with get_db_cursor() as cursor:
+                if clave:
+                    previo = ClaveIdempotencia.previo(cursor, clave, usuario_id, huella)
+                    if previo:
+                        return previo
+                _contexto_movimiento(cursor, 'venta', usuario_id)
 
-                cantidad_actual, precio_unitario = result
-                nueva_cantidad = cantidad_actual + cantidad
-                precio_total = float(precio_unitario) * cantidad
+                ejecutar_con_bloqueo(cursor, consulta + " SKIP LOCKED", (medicamento_id, cantidad), 'venta_asignada')
+                result = cursor.fetchone()
+                if not result:
+                    # Sin candidatos libres: esperar al primero que tenga stock
+                    ejecutar_con_bloqueo(cursor, consulta, (medicamento_id, cantidad), 'venta_asignada')
+                    result = cursor.fetchone()
+                if not result:
+                    return (False, "Stock insuficiente en los lotes vigentes del medicamento", None)
 
+                lote_id, precio_unitario = result
                 cursor.execute(
-                    """UPDATE lotes_medicamentos 
-                       SET cantidad_actual = %s, version = version + 1
+                    """UPDATE lotes_medicamentos
+                       SET cantidad_actual = cantidad_actual - %s, version = version + 1
                        WHERE id = %s""",
-                    (nueva_cantidad, lote_id)
+                    (cantidad, lote_id)
                 )
-
                 cursor.execute(
-                    """INSERT INTO transacciones 
+                    """INSERT INTO transacciones
                        (tipo, lote_id, usuario_id, cantidad, precio_total)
-                       VALUES ('compra', %s, %s, %s, %s) RETURNING id""",
-                    (lote_id, usuario_id, cantidad, precio_total)
+                       VALUES ('venta', %s, %s, %s, %s) RETURNING id""",
+                    (lote_id, usuario_id, cantidad, precio_unitario * cantidad)
                 )
-                transaccion_id = cursor.fetchone()[0]
+                resultado = (True, "Venta registrada exitosamente", cursor.fetchone()[0])
+                if clave:
+                    ClaveIdempotencia.guardar(cursor, clave, usuario_id, 'venta', huella, resultado)
+                return resultado
+
+        except ERRORES_BLOQUEO:
+            raise  # los reintenta reintentar_bloqueos
+        except psycopg2.errors.UniqueViolation as e:
+            return ClaveIdempotencia.resultado_concurrente(e, clave, usuario_id, huella)
+        except psycopg2.Error as e:
+            return (False, f"Error en la base de datos: {str(e)}", None)
+
+    @staticmethod
+    def registrar_compra(lote_id, usuario_id, cantidad, clave=None):
+        """
+        Registrar una compra (incrementa el stock). Con clave (de idempotencia),
+        un reintento retorna el resultado original.
+        Retorna (exito, mensaje, transaccion_id)
+        """
+        exito, mensaje, transaccion_ids = Transaccion.registrar_compra_multiple(
+            [(lote_id, cantidad)], usuario_id, clave=clave
+        )
+        if not exito:
+            return (False, mensaje, None)
+        return (True, "Compra registrada exitosamente", transaccion_ids[0])
 
-                return (True, "Compra registrada exitosamente", transaccion_id)
+    @staticmethod
+    @reintentar_bloqueos(agotado=OCUPADO)
+    def registrar_compra_multiple(items, usuario_id, clave=None):
+        """
+        Registrar en una sola transacción la recepción de una entrega.
+        items: lista de (lote_id, cantidad). Bloquea los lotes en orden de id
+        en una sola consulta, suma las cantidades con un UPDATE por conjuntos
+        e inserta todas las transacciones de una vez: el número de sentencias
+        no depende del número de líneas. Con clave (de idempotencia), un
+        reintento retorna el resultado original.
+        Retorna (exito, mensaje, transaccion_ids)
+        """
+        cantidades = {}
+        for lote_id, cantidad in items:
+            if cantidad <= 0:
+                return (False, "Las cantidades deben ser mayores que cero", None)
+            cantidades[lote_id] = cantidades.get(lote_id, 0) + cantidad
+        if not cantidades:
+            return (False, "La compra no tiene productos", None)
+
+        huella = ClaveIdempotencia.huella('compra', cantidades.items()) if clave else None
+        try:
+            with get_db_cursor() as cursor:
+                if clave:
+                    previo = ClaveIdempotencia.previo(cursor, clave, usuario_id, huella)
+                    if previo:
+                        return previo
+                _contexto_movimiento(cursor, 'compra', usuario_id)
+                ejecutar_con_bloqueo(
+                    cursor,
+                    """SELECT id, precio_unitario
+                       FROM lotes_medicamentos WHERE id = ANY(%s)
+                       ORDER BY id FOR NO KEY UPDATE""",
+                    (sorted(cantidades),), 'compra'
+                )
+                precios = dict(cursor.fetchall())
+
+                faltantes = sorted(set(cantidades) - set(precios))
+                if faltantes:
+                    return (False, f"Lotes no encontrados: {', '.join(map(str, faltantes))}", None)
+
+                execute_values(
+                    cursor,
+                    """UPDATE lotes_medicamentos l
+                       SET cantidad_actual = l.cantidad_actual + v.cantidad, version = l.version + 1
+                       FROM (VALUES %s) AS v(id, cantidad)
+                       WHERE l.id = v.id""",
+                    sorted(cantidades.items()),
+                    page_size=len(cantidades)
+                )
+                insertadas = execute_values(
+                    cursor,
+                    """INSERT INTO transacciones (tipo, lote_id, usuario_id, cantidad, precio_total)
+                       VALUES %s RETURNING id""",
+                    [(lote_id, usuario_id, cantidad, precios[lote_id] * cantidad)
+                     for lote_id, cantidad in sorted(cantidades.items())],
+                    template="('compra', %s, %s, %s, %s)",
+                    page_size=len(cantidades),
+                    fetch=True
+                )
+                resultado = (True, f"Compra de {len(insertadas)} productos registrada exitosamente", [f[0] for f in insertadas])
+                if clave:
+                    ClaveIdempotencia.guardar(cursor, clave, usuario_id, 'compra', huella, resultado)
+                return resultado
+
+        except ERRORES_BLOQUEO:
+            raise  # los reintenta reintentar_bloqueos
+        except psycopg2.errors.UniqueViolation as e:
+            return ClaveIdempotencia.resultado_concurrente(e, clave, usuario_id, huella)
         except psycopg2.Error as e:
-            return (False, f"Error: {str(e)}", None)
+            return (False, f"Error en la base de datos: {str(e)}", None)
 
     @staticmethod
     def listar_historial(limite=50):
@@ -336,17 +1109,41 @@ class Transaccion:
                    LIMIT %s""",
                 (limite,)
             )
-            transacciones = []
-            for row in cursor.fetchall():
-                transacciones.append({
-                    'id': row[0],
-                    'tipo': row[1],
-                    'medicamento': row[2],
-                    'numero_lote': row[3],
-                    'usuario': row[4],
-                    'cantidad': row[5],
-                    'precio_total': float(row[6]),
-                    'fecha': row[7]
-                })
-            return transacciones
+            return filas.listar(cursor, FilaTransaccion)
 
+    @staticmethod
+    def crear_particiones(meses_adelante=3):
+        """Crear las particiones mensuales de transacciones hasta meses_adelante; retorna las creadas"""
+        with get_db_cursor() as cursor:
+            cursor.execute(
+                """SELECT crear_particiones_transacciones(
+                       CURRENT_DATE, (CURRENT_DATE + make_interval(months => %s))::date)""",
+                (meses_adelante,)
+            )
+            return cursor.fetchone()[0]
+
+    @staticmethod
+    def consolidar_resumenes():
+        """
+        Recalcular resumen_diario_medicamento y resumen_diario_usuario desde el
+        día de la última ejecución (los días anteriores ya no cambian).
+        Retorna las filas escritas.
+        """
+        escritas = 0
+        for tarea in ('resumen_diario_medicamento', 'resumen_diario_usuario'):
+            with get_db_cursor() as cursor:
+                desde = _leer_marca(cursor, tarea)
+                cursor.execute(f"SELECT consolidar_{tarea}(%s)", (desde,))
+                escritas += cursor.fetchone()[0]
+                _guardar_marca(cursor, tarea)
+        return escritas
+
+    @staticmethod
+    def contar_ventas_hoy():
+        """Número de ventas del día, leído del resumen diario por lote"""
+        with get_db_cursor(commit=False) as cursor:
+            cursor.execute(
+                """SELECT COALESCE(SUM(transacciones), 0) FROM resumen_diario_lote
+                   WHERE fecha = CURRENT_DATE AND tipo = 'venta'"""
+            )
+            return cursor.fetchone()[0]
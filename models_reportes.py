@@ -0,0 +1,140 @@
+"""
+Reportes de ventas de PharmaFlow Solutions.
+
+Se calculan sobre los resúmenes diarios (resumen_diario_lote,
+resumen_diario_medicamento y resumen_diario_usuario, ver migraciones 003 y 004),
+nunca sobre las filas de transacciones, y se guardan en caché REPORTES_CACHE_TTL
+segundos. Los resúmenes por medicamento y por usuario se consolidan cada
+INTERVALO_RESUMEN_VENTAS segundos, así que las cifras del día pueden ir
+ligeramente atrasadas respecto a los totales. Los importes se devuelven como
+Decimal, igual que en la valoración de inventario.
+"""
+import os
+from decimal import Decimal
+
+from cache import CacheTTL
+from database import get_db_cursor
+
+REPORTES_CACHE_TTL = float(os.getenv('REPORTES_CACHE_TTL', '300'))
+
+GRANULARIDADES = {'dia': 'day', 'semana': 'week', 'mes': 'month'}
+
+# agrupar_por -> (tabla de resumen, join, clave, nombre)
+AGRUPACIONES = {
+    None: ('resumen_diario_lote', '', 'NULL', 'NULL'),
+    'medicamento': ('resumen_diario_medicamento', 'JOIN medicamentos m ON r.medicamento_id = m.id',
+                    'm.id', 'm.nombre'),
+    'categoria': ('resumen_diario_medicamento', 'JOIN medicamentos m ON r.medicamento_id = m.id',
+                  "COALESCE(m.categoria, 'Sin categoría')", "COALESCE(m.categoria, 'Sin categoría')"),
+    'usuario': ('resumen_diario_usuario', 'JOIN usuarios u ON r.usuario_id = u.id',
+                'u.id', 'u.nombre_completo'),
+}
+
+CRITERIOS = ('unidades', 'importe')
+
+_cache = CacheTTL(ttl=REPORTES_CACHE_TTL)
+
+class ReporteVentas:
+    """Consultas de reportes de ventas sobre los resúmenes diarios"""
+
+    @staticmethod
+    def serie(desde, hasta, granularidad='dia', agrupar_por=None, tipo='venta'):
+        """
+        Unidades, importe y número de transacciones por periodo ('dia', 'semana'
+        o 'mes') entre desde y hasta (inclusive), opcionalmente por
+        'medicamento', 'categoria' o 'usuario'.
+        """
+        if granularidad not in GRANULARIDADES:
+            raise ValueError(f"Granularidad no válida: {granularidad}")
+        if agrupar_por not in AGRUPACIONES:
+            raise ValueError(f"Agrupación no válida: {agrupar_por}")
+
+        clave_cache = ('serie', desde, hasta, granularidad, agrupar_por, tipo)
+        return _cache.obtener_o_calcular(
+            clave_cache, lambda: ReporteVentas._consultar_serie(desde, hasta, granularidad, agrupar_por, tipo)
+        )
+
+    @staticmethod
+    def _consultar_serie(desde, hasta, granularidad, agrupar_por, tipo):
+        tabla, join, clave, nombre = AGRUPACIONES[agrupar_por]
+        with get_db_cursor(commit=False) as cursor:
+            cursor.execute(
+                f"""SELECT date_trunc(%(granularidad)s, r.fecha)::date AS periodo,
+                           {clave} AS clave, {nombre} AS nombre,
+                           SUM(r.unidades), SUM(r.importe), SUM(r.transacciones)
+                    FROM {tabla} r {join}
+                    WHERE r.fecha BETWEEN %(desde)s AND %(hasta)s AND r.tipo = %(tipo)s
+                    GROUP BY 1, 2, 3
+                    ORDER BY 1, 5 DESC""",
+                {'granularidad': GRANULARIDADES[granularidad], 'desde': desde, 'hasta': hasta, 'tipo': tipo}
+            )
+            return [
+                {
+                    'periodo': row[0],
+                    'clave': row[1],
+                    'nombre': row[2],
+                    'unidades': int(row[3]),
+                    'importe': row[4],
+                    'transacciones': int(row[5])
+                }
+                for row in cursor.fetchall()
+            ]
+
+    @staticmethod
+    def mas_vendidos(desde, hasta, limite=10, criterio='unidades'):
+        """Medicamentos más vendidos entre desde y hasta por unidades o por importe"""
+        if criterio not in CRITERIOS:
+            raise ValueError(f"Criterio no válido: {criterio}")
+
+        clave_cache = ('mas_vendidos', desde, hasta, limite, criterio)
+        return _cache.obtener_o_calcular(
+            clave_cache, lambda: ReporteVentas._consultar_mas_vendidos(desde, hasta, limite, criterio)
+        )
+
+    @staticmethod
+    def _consultar_mas_vendidos(desde, hasta, limite, criterio):
+        with get_db_cursor(commit=False) as cursor:
+            cursor.execute(
+                f"""SELECT m.id, m.nombre, m.categoria,
+                           SUM(r.unidades) AS unidades, SUM(r.importe) AS importe,
+                           SUM(r.transacciones)
+                    FROM resumen_diario_medicamento r
+                    JOIN medicamentos m ON r.medicamento_id = m.id
+                    WHERE r.fecha BETWEEN %s AND %s AND r.tipo = 'venta'
+                    GROUP BY m.id, m.nombre, m.categoria
+                    ORDER BY {criterio} DESC
+                    LIMIT %s""",
+                (desde, hasta, limite)
+            )
+            return [
+                {
+                    'medicamento_id': row[0],
+                    'medicamento': row[1],
+                    'categoria': row[2],
+                    'unidades': int(row[3]),
+                    'importe': row[4],
+                    'transacciones': int(row[5])
+                }
+                for row in cursor.fetchall()
+            ]
+
+    @staticmethod
+    def totales(desde, hasta):
+        """Totales de ventas y compras entre desde y hasta"""
+        def consultar():
+            with get_db_cursor(commit=False) as cursor:
+                cursor.execute(
+                    """SELECT tipo, SUM(unidades), SUM(importe), SUM(transacciones)
+                       FROM resumen_diario_lote
+                       WHERE fecha BETWEEN %s AND %s
+                       GROUP BY tipo""",
+                    (desde, hasta)
+                )
+                totales = {tipo: {'unidades': 0, 'importe': Decimal('0'), 'transacciones': 0}
+                           for tipo in ('venta', 'compra')}
+                for row in cursor.fetchall():
+                    totales[row[0]] = {'unidades': int(row[1]), 'importe': row[2],
+                                       'transacciones': int(row[3])}
+                return totales
+
+        return _cache.obtener_o_calcular(('totales', desde, hasta), consultar)
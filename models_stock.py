@@ -0,0 +1,195 @@
+"""
+Libro de movimientos de stock y cortes periódicos (migración 005).
+
+Cada cambio de lotes_medicamentos.cantidad_actual (ventas, compras, altas,
+ajustes manuales y bajas) lo registra el trigger trigger_lotes_movimiento_stock
+en movimientos_stock junto con el saldo resultante. Los cortes guardan el saldo
+de cada lote en una fecha; el stock en una fecha cualquiera se obtiene del corte
+anterior más los movimientos posteriores a él (función stock_en_fecha).
+
+Los movimientos también se publican como eventos de inventario con una
+secuencia creciente (migración 012, ver EventoInventario y eventos.py).
+"""
+import os
+
+from database import get_db_cursor
+
+# Movimientos publicados por transacción y días que se conservan los eventos
+EVENTOS_LOTE = int(os.getenv('EVENTOS_LOTE', '5000'))
+EVENTOS_RETENCION_DIAS = int(os.getenv('EVENTOS_RETENCION_DIAS', '7'))
+
+# Clave del advisory lock que serializa la publicación
+_BLOQUEO_PUBLICACION = 43012
+
+def _fila_evento(row):
+    return {
+        'secuencia': row[0],
+        'lote_id': row[1],
+        'medicamento_id': row[2],
+        'tipo': row[3],
+        'cantidad': row[4],
+        'saldo': row[5],
+        'version': row[6],
+        'fecha': row[7].isoformat()
+    }
+
+class MovimientoStock:
+    """Consultas sobre el libro de movimientos"""
+
+    @staticmethod
+    def listar_por_lote(lote_id, antes_de=None, limite=100):
+        """Movimientos de un lote del más reciente al más antiguo, paginados por id"""
+        with get_db_cursor(commit=False) as cursor:
+            cursor.execute(
+                """SELECT m.id, m.fecha, m.cantidad, m.saldo, m.origen, u.nombre_completo
+                   FROM movimientos_stock m
+                   LEFT JOIN usuarios u ON m.usuario_id = u.id
+                   WHERE m.lote_id = %s AND (%s::bigint IS NULL OR m.id < %s)
+                   ORDER BY m.id DESC
+                   LIMIT %s""",
+                (lote_id, antes_de, antes_de, limite)
+            )
+            return [
+                {
+                    'id': row[0],
+                    'fecha': row[1],
+                    'cantidad': row[2],
+                    'saldo': row[3],
+                    'origen': row[4],
+                    'usuario': row[5]
+                }
+                for row in cursor.fetchall()
+            ]
+
+    @staticmethod
+    def stock_en_fecha(fecha, medicamento_id=None):
+        """Saldo de cada lote con stock en la fecha indicada"""
+        with get_db_cursor(commit=False) as cursor:
+            cursor.execute(
+                """SELECT s.lote_id, l.numero_lote, m.id, m.nombre, s.saldo
+                   FROM stock_en_fecha(%s) s
+                   LEFT JOIN lotes_medicamentos l ON s.lote_id = l.id
+                   LEFT JOIN medicamentos m ON l.medicamento_id = m.id
+                   WHERE s.saldo > 0 AND (%s::integer IS NULL OR m.id = %s)
+                   ORDER BY m.nombre, s.lote_id""",
+                (fecha, medicamento_id, medicamento_id)
+            )
+            return [
+                {
+                    'lote_id': row[0],
+                    'numero_lote': row[1],
+                    'medicamento_id': row[2],
+                    'medicamento': row[3],
+                    'saldo': row[4]
+                }
+                for row in cursor.fetchall()
+            ]
+
+class CorteStock:
+    """Cortes periódicos del saldo de todos los lotes"""
+
+    @staticmethod
+    def crear(fecha=None):
+        """
+        Crear el corte de la fecha indicada (por defecto, el inicio del día
+        actual). Retorna el id del corte o None si ya existía.
+        """
+        with get_db_cursor() as cursor:
+            cursor.execute(
+                "SELECT crear_corte_stock(COALESCE(%s::timestamp, date_trunc('day', LOCALTIMESTAMP)))",
+                (fecha,)
+            )
+            return cursor.fetchone()[0]
+
+    @staticmethod
+    def listar(limite=50):
+        with get_db_cursor(commit=False) as cursor:
+            cursor.execute(
+                "SELECT id, fecha, fecha_creacion FROM cortes_stock ORDER BY fecha DESC LIMIT %s",
+                (limite,)
+            )
+            return [
+                {'id': row[0], 'fecha': row[1], 'fecha_creacion': row[2]}
+                for row in cursor.fetchall()
+            ]
+
+class EventoInventario:
+    """Eventos de inventario publicados desde el libro de movimientos"""
+
+    @staticmethod
+    def publicar(limite=EVENTOS_LOTE):
+        """
+        Pasar los movimientos confirmados de cola_eventos_inventario a
+        eventos_inventario. Las publicaciones se serializan con un advisory
+        lock, así que una secuencia mayor nunca se confirma antes que una menor.
+        Avisa con NOTIFY inventario la última secuencia publicada.
+        Retorna el número de eventos publicados.
+        """
+        total = 0
+        while True:
+            with get_db_cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", (_BLOQUEO_PUBLICACION,))
+                cursor.execute(
+                    """WITH pendientes AS (
+                           DELETE FROM cola_eventos_inventario
+                           WHERE movimiento_id IN (
+                               SELECT movimiento_id FROM cola_eventos_inventario
+                               ORDER BY movimiento_id LIMIT %s
+                           )
+                           RETURNING movimiento_id, version
+                       )
+                       INSERT INTO eventos_inventario
+                           (movimiento_id, lote_id, medicamento_id, tipo, cantidad, saldo, version, fecha)
+                       SELECT m.id, m.lote_id, m.medicamento_id, m.origen, m.cantidad, m.saldo, p.version, m.fecha
+                       FROM pendientes p
+                       JOIN movimientos_stock m ON m.id = p.movimiento_id
+                       ORDER BY m.id
+                       RETURNING secuencia""",
+                    (limite,)
+                )
+                secuencias = [row[0] for row in cursor.fetchall()]
+                if secuencias:
+                    cursor.execute("SELECT pg_notify('inventario', %s)", (str(max(secuencias)),))
+            total += len(secuencias)
+            if len(secuencias) < limite:
+                return total
+
+    @staticmethod
+    def listar(desde=0, limite=500, lote_ids=None):
+        """Eventos con secuencia mayor que desde, en orden de secuencia"""
+        with get_db_cursor(commit=False) as cursor:
+            cursor.execute(
+                """SELECT secuencia, lote_id, medicamento_id, tipo, cantidad, saldo, version, fecha
+                   FROM eventos_inventario
+                   WHERE secuencia > %s AND (%s::integer[] IS NULL OR lote_id = ANY(%s))
+                   ORDER BY secuencia
+                   LIMIT %s""",
+                (desde, lote_ids, lote_ids, limite)
+            )
+            return [_fila_evento(row) for row in cursor.fetchall()]
+
+    @staticmethod
+    def limites():
+        """(primera, última) secuencia conservada; (None, None) si no hay eventos"""
+        with get_db_cursor(commit=False) as cursor:
+            cursor.execute(
+                """SELECT (SELECT secuencia FROM eventos_inventario ORDER BY secuencia LIMIT 1),
+                          (SELECT secuencia FROM eventos_inventario ORDER BY secuencia DESC LIMIT 1)"""
+            )
+            return cursor.fetchone()
+
+    @staticmethod
+    def purgar(dias=EVENTOS_RETENCION_DIAS):
+        """
+        Eliminar los eventos publicados hace más de dias días. Se conserva
+        siempre el último, para que un cursor anterior a lo purgado se
+        detecte como vencido (ver limites).
+        """
+        with get_db_cursor() as cursor:
+            cursor.execute(
+                """DELETE FROM eventos_inventario
+                   WHERE publicado < LOCALTIMESTAMP - make_interval(days => %s)
+                     AND secuencia < (SELECT max(secuencia) FROM eventos_inventario)""",
+                (dias,)
+            )
+            return cursor.rowcount
@@ -0,0 +1,354 @@
+"""
+Valoración de inventario por medicamento (migración 006).
+
+Cada movimiento de movimientos_stock entra en cola_valoracion; procesar_pendientes
+los aplica por lotes al estado de cada medicamento. Cada consumidor toma todos
+los pendientes de los medicamentos que consigue bloquear (advisory lock por
+medicamento), así que varios consumidores pueden trabajar a la vez sin
+aplicar los movimientos de un medicamento fuera de orden. Un movimiento se
+aplica después de todos los ya aplicados de su medicamento (en el orden en
+que se confirmaron, no en el de sus ids) y su posición queda en
+movimientos_valorados (migración 016):
+  - Costo promedio ponderado: las entradas suman unidades y valor; las salidas
+    se valoran a valor / unidades.
+  - FIFO: cada entrada es una capa de costo (capas_fifo); las salidas consumen
+    las capas más antiguas del medicamento, sin importar de qué lote salen.
+Las salidas por venta acumulan el costo de lo vendido en costo_ventas_diario.
+
+Toda la aritmética se hace con Decimal. verificar() reconstruye la valoración
+desde cero con el libro completo, en ese mismo orden, y la compara con la
+almacenada.
+"""
+import logging
+import os
+from collections import deque
+from decimal import Decimal, ROUND_HALF_EVEN
+
+from psycopg2.extras import execute_values
+
+from database import get_db_cursor
+
+logger = logging.getLogger(__name__)
+
+VALORACION_LOTE = int(os.getenv('VALORACION_LOTE', '1000'))
+METODOS = ('fifo', 'promedio')
+
+CERO = Decimal('0')
+PRECISION = Decimal('0.0001')
+
+# Primera clave de los advisory locks por medicamento (la segunda es medicamento_id)
+BLOQUEO_VALORACION = 36_006
+
+def _redondear(valor):
+    return valor.quantize(PRECISION, rounding=ROUND_HALF_EVEN)
+
+class EstadoValoracion:
+    """Unidades, valor y capas FIFO de un medicamento"""
+
+    def __init__(self, medicamento_id, unidades=0, valor_promedio=CERO, valor_fifo=CERO, capas=(), aplicados=0):
+        self.medicamento_id = medicamento_id
+        self.unidades = unidades
+        # Movimientos aplicados: el siguiente recibe el orden aplicados + 1
+        self.aplicados = aplicados
+        self.valor_promedio = valor_promedio
+        self.valor_fifo = valor_fifo
+        # Cada capa: [id en capas_fifo (None si es nueva), movimiento_id, restante, costo]
+        self.capas = deque([list(capa) for capa in capas])
+        self.capas_agotadas = []
+        self.capas_modificadas = set()
+        self.ultimo_movimiento_id = None
+
+    def entrada(self, movimiento_id, cantidad, costo):
+        valor = cantidad * costo
+        self.unidades += cantidad
+        self.valor_promedio += valor
+        self.valor_fifo += valor
+        self.capas.append([None, movimiento_id, cantidad, costo])
+
+    def salida(self, cantidad):
+        """Retirar unidades; retorna su costo (promedio, fifo)"""
+        if self.unidades > 0:
+            costo_promedio = _redondear(self.valor_promedio * min(cantidad, self.unidades) / self.unidades)
+        else:
+            costo_promedio = CERO
+
+        costo_fifo = CERO
+        pendiente = cantidad
+        while pendiente > 0 and self.capas:
+            capa = self.capas[0]
+            usadas = min(pendiente, capa[2])
+            costo_fifo += usadas * capa[3]
+            capa[2] -= usadas
+            pendiente -= usadas
+            if capa[2] == 0:
+                self.capas.popleft()
+                if capa[0] is not None:
+                    self.capas_agotadas.append(capa[0])
+                    self.capas_modificadas.discard(capa[0])
+            elif capa[0] is not None:
+                self.capas_modificadas.add(capa[0])
+        if pendiente > 0:
+            logger.warning("Medicamento %s: salida de %d unidades sin capas FIFO suficientes",
+                           self.medicamento_id, pendiente)
+
+        self.unidades -= cantidad
+        if self.unidades <= 0:
+            self.unidades = 0
+            self.valor_promedio = CERO
+        else:
+            self.valor_promedio -= costo_promedio
+        self.valor_fifo -= costo_fifo
+        return costo_promedio, costo_fifo
+
+    def aplicar(self, movimiento_id, cantidad, costo):
+        """Aplicar un movimiento; retorna el costo (promedio, fifo) si es una salida"""
+        self.ultimo_movimiento_id = movimiento_id
+        self.aplicados += 1
+        if cantidad > 0:
+            self.entrada(movimiento_id, cantidad, costo)
+            return None
+        if cantidad < 0:
+            return self.salida(-cantidad)
+        return None
+
+class Valoracion:
+    """Consumo de la cola de movimientos y consultas de valoración"""
+
+    @staticmethod
+    def procesar_pendientes(limite=VALORACION_LOTE):
+        """
+        Aplicar los movimientos pendientes de los medicamentos que aparecen entre
+        los `limite` más antiguos de la cola y que ningún otro consumidor está
+        procesando (de cada uno, todos sus pendientes). Los pendientes se
+        confirmaron después de los ya aplicados; entre ellos se ordenan por id,
+        que dentro de un lote es el orden de confirmación. Retorna cuántos se
+        aplicaron.
+        """
+        with get_db_cursor() as cursor:
+            # pg_try_advisory_xact_lock es volátil: se evalúa una vez por medicamento
+            cursor.execute(
+                """SELECT medicamento_id
+                   FROM (SELECT DISTINCT m.medicamento_id
+                         FROM (SELECT movimiento_id FROM cola_valoracion
+                               ORDER BY movimiento_id LIMIT %s) c
+                         JOIN movimientos_stock m ON m.id = c.movimiento_id
+                         WHERE m.medicamento_id IS NOT NULL) candidatos
+                   WHERE pg_try_advisory_xact_lock(%s, medicamento_id)""",
+                (limite, BLOQUEO_VALORACION)
+            )
+            medicamento_ids = [row[0] for row in cursor.fetchall()]
+            # Los movimientos sin medicamento no se valoran: solo se quitan de la cola
+            cursor.execute(
+                """WITH pendientes AS (
+                       DELETE FROM cola_valoracion c
+                       USING movimientos_stock m
+                       WHERE m.id = c.movimiento_id
+                         AND (m.medicamento_id = ANY(%s) OR m.medicamento_id IS NULL)
+                       RETURNING m.id, m.medicamento_id, m.cantidad, m.costo_unitario, m.origen, m.fecha)
+                   SELECT id, medicamento_id, cantidad, costo_unitario, origen, fecha::date
+                   FROM pendientes
+                   WHERE medicamento_id IS NOT NULL
+                   ORDER BY id""",
+                (medicamento_ids,)
+            )
+            movimientos = cursor.fetchall()
+            if not movimientos:
+                return 0
+
+            estados = Valoracion._cargar_estados(cursor, {m[1] for m in movimientos})
+            costo_ventas = {}
+            valorados = []
+            for movimiento_id, medicamento_id, cantidad, costo, origen, fecha in movimientos:
+                estado = estados[medicamento_id]
+                costo_salida = estado.aplicar(movimiento_id, cantidad, costo)
+                valorados.append((medicamento_id, estado.aplicados, movimiento_id))
+                if costo_salida and origen == 'venta':
+                    clave = (fecha, medicamento_id)
+                    unidades, promedio, fifo = costo_ventas.get(clave, (0, CERO, CERO))
+                    costo_ventas[clave] = (unidades - cantidad, promedio + costo_salida[0], fifo + costo_salida[1])
+
+            Valoracion._guardar_estados(cursor, estados.values())
+            execute_values(
+                cursor,
+                "INSERT INTO movimientos_valorados (medicamento_id, orden, movimiento_id) VALUES %s",
+                valorados,
+                page_size=len(valorados)
+            )
+            if costo_ventas:
+                execute_values(
+                    cursor,
+                    """INSERT INTO costo_ventas_diario (fecha, medicamento_id, unidades, costo_promedio, costo_fifo)
+                       VALUES %s
+                       ON CONFLICT (fecha, medicamento_id) DO UPDATE
+                       SET unidades = costo_ventas_diario.unidades + EXCLUDED.unidades,
+                           costo_promedio = costo_ventas_diario.costo_promedio + EXCLUDED.costo_promedio,
+                           costo_fifo = costo_ventas_diario.costo_fifo + EXCLUDED.costo_fifo""",
+                    [(fecha, medicamento_id, *valores) for (fecha, medicamento_id), valores in costo_ventas.items()]
+                )
+            return len(movimientos)
+
+    @staticmethod
+    def _cargar_estados(cursor, medicamento_ids):
+        ids = list(medicamento_ids)
+        estados = {medicamento_id: EstadoValoracion(medicamento_id) for medicamento_id in ids}
+        cursor.execute(
+            """SELECT medicamento_id, unidades, valor_promedio, valor_fifo, movimientos_aplicados
+               FROM valoracion_medicamento WHERE medicamento_id = ANY(%s)""",
+            (ids,)
+        )
+        for medicamento_id, unidades, valor_promedio, valor_fifo, aplicados in cursor.fetchall():
+            estados[medicamento_id] = EstadoValoracion(medicamento_id, unidades, valor_promedio, valor_fifo,
+                                                       aplicados=aplicados)
+        cursor.execute(
+            """SELECT medicamento_id, id, movimiento_id, cantidad_restante, costo_unitario
+               FROM capas_fifo WHERE medicamento_id = ANY(%s)
+               ORDER BY medicamento_id, id""",
+            (ids,)
+        )
+        for medicamento_id, *capa in cursor.fetchall():
+            estados[medicamento_id].capas.append(capa)
+        return estados
+
+    @staticmethod
+    def _guardar_estados(cursor, estados):
+        agotadas = [capa_id for e in estados for capa_id in e.capas_agotadas]
+        if agotadas:
+            cursor.execute("DELETE FROM capas_fifo WHERE id = ANY(%s)", (agotadas,))
+
+        modificadas = [(capa[0], capa[2]) for e in estados for capa in e.capas if capa[0] in e.capas_modificadas]
+        if modificadas:
+            execute_values(
+                cursor,
+                """UPDATE capas_fifo SET cantidad_restante = v.restante
+                   FROM (VALUES %s) AS v(id, restante)
+                   WHERE capas_fifo.id = v.id""",
+                modificadas
+            )
+
+        nuevas = [(e.medicamento_id, capa[1], capa[2], capa[3]) for e in estados for capa in e.capas if capa[0] is None]
+        if nuevas:
+            execute_values(
+                cursor,
+                "INSERT INTO capas_fifo (medicamento_id, movimiento_id, cantidad_restante, costo_unitario) VALUES %s",
+                nuevas
+            )
+
+        execute_values(
+            cursor,
+            """INSERT INTO valoracion_medicamento
+                   (medicamento_id, unidades, valor_promedio, valor_fifo, ultimo_movimiento_id,
+                    movimientos_aplicados, actualizado)
+               VALUES %s
+               ON CONFLICT (medicamento_id) DO UPDATE
+               SET unidades = EXCLUDED.unidades,
+                   valor_promedio = EXCLUDED.valor_promedio,
+                   valor_fifo = EXCLUDED.valor_fifo,
+                   ultimo_movimiento_id = EXCLUDED.ultimo_movimiento_id,
+                   movimientos_aplicados = EXCLUDED.movimientos_aplicados,
+                   actualizado = EXCLUDED.actualizado""",
+            [(e.medicamento_id, e.unidades, e.valor_promedio, e.valor_fifo, e.ultimo_movimiento_id, e.aplicados)
+             for e in estados],
+            template="(%s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)"
+        )
+
+    @staticmethod
+    def listar(metodo='fifo'):
+        """Unidades, valor y costo unitario por medicamento según el método indicado"""
+        if metodo not in METODOS:
+            raise ValueError(f"Método no válido: {metodo}")
+        with get_db_cursor(commit=False) as cursor:
+            cursor.execute(
+                f"""SELECT v.medicamento_id, m.nombre, m.categoria, v.unidades, v.valor_{metodo}, v.actualizado
+                    FROM valoracion_medicamento v
+                    JOIN medicamentos m ON v.medicamento_id = m.id
+                    WHERE v.unidades > 0
+                    ORDER BY v.valor_{metodo} DESC"""
+            )
+            return [
+                {
+                    'medicamento_id': row[0],
+                    'medicamento': row[1],
+                    'categoria': row[2],
+                    'unidades': row[3],
+                    'valor': row[4],
+                    'costo_unitario': _redondear(row[4] / row[3]),
+                    'actualizado': row[5]
+                }
+                for row in cursor.fetchall()
+            ]
+
+    @staticmethod
+    def costo_ventas(desde, hasta, metodo='fifo'):
+        """Costo de lo vendido por medicamento entre desde y hasta (inclusive)"""
+        if metodo not in METODOS:
+            raise ValueError(f"Método no válido: {metodo}")
+        with get_db_cursor(commit=False) as cursor:
+            cursor.execute(
+                f"""SELECT c.medicamento_id, m.nombre, SUM(c.unidades), SUM(c.costo_{metodo})
+                    FROM costo_ventas_diario c
+                    JOIN medicamentos m ON c.medicamento_id = m.id
+                    WHERE c.fecha BETWEEN %s AND %s
+                    GROUP BY c.medicamento_id, m.nombre
+                    ORDER BY 4 DESC""",
+                (desde, hasta)
+            )
+            return [
+                {
+                    'medicamento_id': row[0],
+                    'medicamento': row[1],
+                    'unidades': int(row[2]),
+                    'costo': row[3]
+                }
+                for row in cursor.fetchall()
+            ]
+
+    @staticmethod
+    def pendientes():
+        with get_db_cursor(commit=False) as cursor:
+            cursor.execute("SELECT COUNT(*) FROM cola_valoracion")
+            return cursor.fetchone()[0]
+
+    @staticmethod
+    def verificar():
+        """
+        Recalcular la valoración reproduciendo todos los movimientos ya aplicados,
+        en el orden de movimientos_valorados, y compararla con
+        valoracion_medicamento. Recorre el libro completo: es
+        una tarea de verificación, no de uso diario. Retorna las diferencias.
+        """
+        estados = {}
+        with get_db_cursor(commit=False) as cursor:
+            # Una sola instantánea para el orden aplicado, el libro y la valoración almacenada
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            cursor.execute(
+                """SELECT m.id, v.medicamento_id, m.cantidad, m.costo_unitario
+                   FROM movimientos_valorados v
+                   JOIN movimientos_stock m ON m.id = v.movimiento_id
+                   ORDER BY v.medicamento_id, v.orden"""
+            )
+            while True:
+                filas = cursor.fetchmany(10_000)
+                if not filas:
+                    break
+                for movimiento_id, medicamento_id, cantidad, costo in filas:
+                    estado = estados.get(medicamento_id)
+                    if estado is None:
+                        estado = estados[medicamento_id] = EstadoValoracion(medicamento_id)
+                    estado.aplicar(movimiento_id, cantidad, costo)
+
+            cursor.execute("SELECT medicamento_id, unidades, valor_promedio, valor_fifo FROM valoracion_medicamento")
+            almacenados = {row[0]: row[1:] for row in cursor.fetchall()}
+
+        diferencias = []
+        for medicamento_id in sorted(set(estados) | set(almacenados)):
+            estado = estados.get(medicamento_id, EstadoValoracion(medicamento_id))
+            esperado = (estado.unidades, _redondear(estado.valor_promedio), _redondear(estado.valor_fifo))
+            actual = almacenados.get(medicamento_id, (0, CERO, CERO))
+            actual = (actual[0], _redondear(actual[1]), _redondear(actual[2]))
+            if esperado != actual:
+                diferencias.append({
+                    'medicamento_id': medicamento_id,
+                    'esperado': dict(zip(('unidades', 'valor_promedio', 'valor_fifo'), esperado)),
+                    'almacenado': dict(zip(('unidades', 'valor_promedio', 'valor_fifo'), actual))
+                })
+        return diferencias
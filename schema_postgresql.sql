@@ -49,6 +49,9 @@ CREATE TABLE lotes_medicamentos (
     fecha_caducidad DATE NOT NULL,
     proveedor VARCHAR(100),
     version INTEGER DEFAULT 1, -- Control de concurrencia optimista
+    -- Tramo de caducidad precalculado (trigger y tarea recalcular_estados_caducidad)
+    estado_caducidad VARCHAR(20) NOT NULL DEFAULT 'vigente'
+        CHECK (estado_caducidad IN ('vigente', 'proximo_a_caducar', 'caducado')),
     fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     ultima_modificacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
@@ -56,6 +59,14 @@ CREATE TABLE lotes_medicamentos (
 CREATE INDEX idx_lotes_medicamento ON lotes_medicamentos(medicamento_id);
 CREATE INDEX idx_lotes_numero ON lotes_medicamentos(numero_lote);
 CREATE INDEX idx_lotes_caducidad ON lotes_medicamentos(fecha_caducidad);
+-- Lotes que todavía pueden cambiar de tramo, y conjuntos pequeños por estado.
+-- Los predicados no usan cantidad_actual para que las ventas sean actualizaciones HOT
+CREATE INDEX idx_lotes_caducidad_pendientes
+    ON lotes_medicamentos(fecha_caducidad) WHERE estado_caducidad <> 'caducado';
+CREATE INDEX idx_lotes_proximos_caducar
+    ON lotes_medicamentos(fecha_caducidad) WHERE estado_caducidad = 'proximo_a_caducar';
+CREATE INDEX idx_lotes_caducados
+    ON lotes_medicamentos(fecha_caducidad) WHERE estado_caducidad = 'caducado';
 
 -- Tabla de transacciones (compras y ventas)
 CREATE TABLE transacciones (
@@ -116,6 +127,30 @@ CREATE TRIGGER trigger_lotes_timestamp
     FOR EACH ROW
     EXECUTE FUNCTION actualizar_timestamp();
 
+-- Tramo de caducidad de una fecha respecto a hoy
+CREATE OR REPLACE FUNCTION calcular_estado_caducidad(fecha DATE)
+RETURNS VARCHAR AS $$
+    SELECT CASE
+        WHEN fecha < CURRENT_DATE THEN 'caducado'
+        WHEN fecha < CURRENT_DATE + INTERVAL '3 months' THEN 'proximo_a_caducar'
+        ELSE 'vigente'
+    END
+$$ LANGUAGE sql STABLE;
+
+-- Asignar el estado al crear un lote o cambiar su fecha de caducidad
+CREATE OR REPLACE FUNCTION asignar_estado_caducidad()
+RETURNS TRIGGER AS $$
+BEGIN
+    NEW.estado_caducidad = calcular_estado_caducidad(NEW.fecha_caducidad);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trigger_lotes_estado_caducidad
+    BEFORE INSERT OR UPDATE OF fecha_caducidad ON lotes_medicamentos
+    FOR EACH ROW
+    EXECUTE FUNCTION asignar_estado_caducidad();
+
 -- Privilegios para el rol gerente (acceso total)
 GRANT ALL PRIVILEGES ON ALL TABLES IN SCHEMA public TO gerente;
 GRANT ALL PRIVILEGES ON ALL SEQUENCES IN SCHEMA public TO gerente;
@@ -141,15 +176,10 @@ SELECT
     l.precio_unitario,
     l.fecha_caducidad,
     l.version,
-    CASE
-        WHEN l.fecha_caducidad < CURRENT_DATE THEN 'caducado'
-        WHEN l.fecha_caducidad < CURRENT_DATE + INTERVAL '3 months' THEN 'proximo_a_caducar'
-        ELSE 'vigente'
-    END as estado_caducidad
+    l.estado_caducidad
 FROM medicamentos m
 JOIN lotes_medicamentos l ON m.id = l.medicamento_id
-WHERE l.cantidad_actual > 0
-ORDER BY l.fecha_caducidad;
+WHERE l.cantidad_actual > 0;
 
 GRANT ALL PRIVILEGES ON ALL TABLES IN SCHEMA public TO gerente;
 GRANT ALL PRIVILEGES ON ALL SEQUENCES IN SCHEMA public TO gerente;
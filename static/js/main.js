@@ -99,3 +99,123 @@ async function fetchJSON(url, options = {}) {
     }
 }
 
+
+// Type-ahead de medicamentos: muestra sugerencias de /api/medicamentos/buscar
+// bajo el input y llama a alSeleccionar(medicamento) al elegir una.
+function autocompletarMedicamentos(input, alSeleccionar) {
+    const contenedor = document.createElement('div');
+    contenedor.className = 'list-group position-absolute w-100 shadow-sm autocompletar-lista';
+    contenedor.style.zIndex = 1050;
+    input.parentNode.style.position = 'relative';
+    input.parentNode.appendChild(contenedor);
+    input.setAttribute('autocomplete', 'off');
+
+    let temporizador = null;
+    let consulta = 0;
+    let activo = -1;
+
+    function cerrar() {
+        contenedor.innerHTML = '';
+        activo = -1;
+    }
+
+    function elegir(medicamento) {
+        input.value = medicamento.nombre;
+        cerrar();
+        alSeleccionar(medicamento);
+    }
+
+    function mostrar(medicamentos) {
+        cerrar();
+        medicamentos.forEach(function(m) {
+            const opcion = document.createElement('button');
+            opcion.type = 'button';
+            opcion.className = 'list-group-item list-group-item-action';
+            opcion.innerHTML = '<strong></strong> <small class="text-muted"></small>';
+            opcion.querySelector('strong').textContent = m.nombre;
+            opcion.querySelector('small').textContent = m.principio_activo + (m.categoria ? ' · ' + m.categoria : '');
+            opcion.addEventListener('mousedown', function(e) {
+                e.preventDefault();
+                elegir(m);
+            });
+            opcion.medicamento = m;
+            contenedor.appendChild(opcion);
+        });
+    }
+
+    input.addEventListener('input', function() {
+        clearTimeout(temporizador);
+        const texto = input.value.trim();
+        if (texto.length < 2) {
+            cerrar();
+            return;
+        }
+        temporizador = setTimeout(function() {
+            const numero = ++consulta;
+            fetch('/api/medicamentos/buscar?limite=10&q=' + encodeURIComponent(texto))
+                .then(function(r) { return r.json(); })
+                .then(function(data) {
+                    // Ignorar respuestas de consultas anteriores
+                    if (numero === consulta) mostrar(data.medicamentos || []);
+                });
+        }, 200);
+    });
+
+    input.addEventListener('keydown', function(e) {
+        const opciones = contenedor.querySelectorAll('.list-group-item');
+        if (!opciones.length) return;
+        if (e.key === 'ArrowDown' || e.key === 'ArrowUp') {
+            e.preventDefault();
+            activo = (activo + (e.key === 'ArrowDown' ? 1 : -1) + opciones.length) % opciones.length;
+            opciones.forEach(function(o, i) { o.classList.toggle('active', i === activo); });
+        } else if (e.key === 'Enter' && activo >= 0) {
+            e.preventDefault();
+            elegir(opciones[activo].medicamento);
+        } else if (e.key === 'Escape') {
+            cerrar();
+        }
+    });
+
+    input.addEventListener('blur', cerrar);
+}
+
+// Stock en vivo: recibe de /api/inventario/eventos/stream los cambios de los
+// lotes posteriores a la secuencia con la que se generó la página y llama a
+// alCambiar(evento) con cada uno. Al reconectar, EventSource reanuda desde el
+// último evento recibido; si el servidor rechaza la conexión se reintenta cada 30 s.
+function inventarioEnVivo(desde, alCambiar) {
+    if (!window.EventSource) return;
+    let ultimo = desde;
+
+    function conectar() {
+        const fuente = new EventSource('/api/inventario/eventos/stream?desde=' + encodeURIComponent(ultimo));
+        fuente.addEventListener('inventario', function(e) {
+            ultimo = e.lastEventId;
+            alCambiar(JSON.parse(e.data));
+        });
+        fuente.addEventListener('error', function() {
+            if (fuente.readyState === EventSource.CLOSED) {
+                setTimeout(conectar, 30000);
+            }
+        });
+    }
+    conectar();
+}
+
+// Actualizar las filas [data-lote-id] de una tabla con un evento de inventario
+// (solo si es más reciente que la versión mostrada)
+function actualizarFilasLote(evento) {
+    document.querySelectorAll('tr[data-lote-id="' + evento.lote_id + '"]').forEach(function(fila) {
+        if (evento.version !== null && evento.version <= parseInt(fila.dataset.version)) return;
+        fila.dataset.version = evento.version;
+        const badge = fila.querySelector('.cantidad-lote');
+        if (badge) {
+            badge.textContent = evento.saldo + ' unidades';
+            badge.classList.remove('bg-danger', 'bg-warning', 'bg-success');
+            badge.classList.add(evento.saldo < 10 ? 'bg-danger' : evento.saldo < 50 ? 'bg-warning' : 'bg-success');
+        }
+        fila.classList.toggle('text-muted', evento.saldo === 0);
+        fila.classList.add('table-info');
+        setTimeout(function() { fila.classList.remove('table-info'); }, 1500);
+    });
+}
@@ -0,0 +1,195 @@
+"""
+Tareas periódicas de mantenimiento de PharmaFlow Solutions.
+
+Se pueden ejecutar desde cron, por ejemplo a diario a las 00:05:
+    5 0 * * * cd /ruta/pharmaflow && .venv/bin/python tareas.py recalcular_estados_caducidad
+
+o dejar que cada worker de gunicorn las ejecute en segundo plano
+(TAREAS_EN_SEGUNDO_PLANO=1, ver iniciar_planificador). Un advisory lock de
+PostgreSQL garantiza que cada tarea corra en un solo proceso a la vez.
+"""
+import logging
+import os
+import sys
+import threading
+import time
+import zlib
+
+import psycopg2
+
+from database import POSTGRES_CONFIG
+from models_inventario import LoteMedicamento, AlertaCaducidad, Transaccion, ClaveIdempotencia
+from models_stock import CorteStock, EventoInventario
+from models_valoracion import Valoracion
+
+logger = logging.getLogger(__name__)
+
+TAREAS_EN_SEGUNDO_PLANO = os.getenv('TAREAS_EN_SEGUNDO_PLANO', '0') == '1'
+INTERVALO_ALERTAS_CADUCIDAD = int(os.getenv('INTERVALO_ALERTAS_CADUCIDAD', '900'))
+INTERVALO_ESTADOS_CADUCIDAD = int(os.getenv('INTERVALO_ESTADOS_CADUCIDAD', '3600'))
+INTERVALO_RESUMEN_VENTAS = int(os.getenv('INTERVALO_RESUMEN_VENTAS', '300'))
+INTERVALO_PARTICIONES = int(os.getenv('INTERVALO_PARTICIONES', '86400'))
+INTERVALO_CORTES_STOCK = int(os.getenv('INTERVALO_CORTES_STOCK', '3600'))
+INTERVALO_VALORACION = int(os.getenv('INTERVALO_VALORACION', '60'))
+INTERVALO_VERIFICAR_VALORACION = int(os.getenv('INTERVALO_VERIFICAR_VALORACION', '86400'))
+INTERVALO_PUBLICAR_EVENTOS = int(os.getenv('INTERVALO_PUBLICAR_EVENTOS', '60'))
+INTERVALO_PURGAR_EVENTOS = int(os.getenv('INTERVALO_PURGAR_EVENTOS', '86400'))
+INTERVALO_PURGAR_IDEMPOTENCIA = int(os.getenv('INTERVALO_PURGAR_IDEMPOTENCIA', '3600'))
+INTERVALO_REBALANCEAR_FRAGMENTOS = int(os.getenv('INTERVALO_REBALANCEAR_FRAGMENTOS', '10'))
+
+def recalcular_estados_caducidad():
+    """Actualizar estado_caducidad de los lotes que cruzaron un umbral"""
+    lotes = LoteMedicamento.recalcular_estados_caducidad()
+    print(f"✓ Estado de caducidad actualizado en {lotes} lotes")
+
+def generar_alertas_caducidad():
+    """Crear alertas de los lotes que cruzaron un umbral desde la última ejecución"""
+    alertas = AlertaCaducidad.generar()
+    print(f"✓ {alertas} alertas de caducidad nuevas")
+
+def consolidar_resumen_ventas():
+    """Actualizar los resúmenes diarios de ventas por medicamento y por usuario"""
+    filas = Transaccion.consolidar_resumenes()
+    print(f"✓ Resúmenes de ventas actualizados ({filas} filas)")
+
+def crear_particiones_transacciones():
+    """Crear por adelantado las particiones mensuales de transacciones"""
+    particiones = Transaccion.crear_particiones()
+    print(f"✓ {particiones} particiones de transacciones nuevas")
+
+def crear_corte_stock():
+    """Guardar el saldo de todos los lotes al inicio del día (si no existe ya)"""
+    corte_id = CorteStock.crear()
+    if corte_id:
+        print(f"✓ Corte de stock #{corte_id} creado")
+    else:
+        print("✓ El corte de stock de hoy ya existía")
+
+def valorar_inventario():
+    """Aplicar a la valoración los movimientos de stock pendientes"""
+    total = 0
+    while True:
+        procesados = Valoracion.procesar_pendientes()
+        total += procesados
+        if procesados == 0:
+            break
+    print(f"✓ Valoración actualizada con {total} movimientos")
+
+def verificar_valoracion():
+    """Recalcular la valoración desde el libro completo y compararla con la almacenada"""
+    diferencias = Valoracion.verificar()
+    if not diferencias:
+        print("✓ Valoración de inventario verificada sin diferencias")
+        return
+    for d in diferencias:
+        logger.error("Valoración del medicamento %s: esperado %s, almacenado %s",
+                     d['medicamento_id'], d['esperado'], d['almacenado'])
+    print(f"✗ Valoración con diferencias en {len(diferencias)} medicamentos")
+
+def publicar_eventos_inventario():
+    """Publicar los movimientos pendientes como eventos de inventario (si no hay un worker escuchando)"""
+    eventos = EventoInventario.publicar()
+    print(f"✓ {eventos} eventos de inventario publicados")
+
+def purgar_eventos_inventario():
+    """Eliminar los eventos de inventario más antiguos que EVENTOS_RETENCION_DIAS"""
+    eventos = EventoInventario.purgar()
+    print(f"✓ {eventos} eventos de inventario eliminados")
+
+def purgar_claves_idempotencia():
+    """Eliminar las claves de idempotencia más antiguas que IDEMPOTENCIA_HORAS"""
+    claves = ClaveIdempotencia.purgar()
+    print(f"✓ {claves} claves de idempotencia eliminadas")
+
+def rebalancear_fragmentos():
+    """Aplicar las ventas pendientes de los lotes fragmentados y volver a repartir su stock"""
+    lotes = LoteMedicamento.rebalancear_fragmentos()
+    print(f"✓ {lotes} lotes fragmentados rebalanceados")
+
+TAREAS = {
+    'recalcular_estados_caducidad': recalcular_estados_caducidad,
+    'generar_alertas_caducidad': generar_alertas_caducidad,
+    'consolidar_resumen_ventas': consolidar_resumen_ventas,
+    'crear_particiones_transacciones': crear_particiones_transacciones,
+    'crear_corte_stock': crear_corte_stock,
+    'valorar_inventario': valorar_inventario,
+    'verificar_valoracion': verificar_valoracion,
+    'publicar_eventos_inventario': publicar_eventos_inventario,
+    'purgar_eventos_inventario': purgar_eventos_inventario,
+    'purgar_claves_idempotencia': purgar_claves_idempotencia,
+    'rebalancear_fragmentos': rebalancear_fragmentos,
+}
+
+# Tareas del planificador en segundo plano: (nombre, intervalo en segundos)
+PROGRAMACION = (
+    ('generar_alertas_caducidad', INTERVALO_ALERTAS_CADUCIDAD),
+    ('recalcular_estados_caducidad', INTERVALO_ESTADOS_CADUCIDAD),
+    ('consolidar_resumen_ventas', INTERVALO_RESUMEN_VENTAS),
+    ('crear_particiones_transacciones', INTERVALO_PARTICIONES),
+    ('crear_corte_stock', INTERVALO_CORTES_STOCK),
+    ('valorar_inventario', INTERVALO_VALORACION),
+    ('verificar_valoracion', INTERVALO_VERIFICAR_VALORACION),
+    ('publicar_eventos_inventario', INTERVALO_PUBLICAR_EVENTOS),
+    ('purgar_eventos_inventario', INTERVALO_PURGAR_EVENTOS),
+    ('purgar_claves_idempotencia', INTERVALO_PURGAR_IDEMPOTENCIA),
+    ('rebalancear_fragmentos', INTERVALO_REBALANCEAR_FRAGMENTOS),
+)
+
+# Conexión propia de cada hilo para los advisory locks de las tareas (un lock
+# de sesión es reentrante: dos hilos con la misma conexión lo obtendrían ambos)
+_bloqueos = threading.local()
+
+def _cursor_bloqueos():
+    """
+    Cursor de la conexión de los advisory locks, en autocommit: el lock de
+    sesión dura toda la tarea sin dejar una transacción abierta (que retendría
+    el xmin de VACUUM) ni ocupar una conexión del pool.
+    """
+    conexion = getattr(_bloqueos, 'conexion', None)
+    if conexion is None or conexion.closed:
+        conexion = _bloqueos.conexion = psycopg2.connect(**POSTGRES_CONFIG)
+        conexion.autocommit = True
+    return conexion.cursor()
+
+def ejecutar_exclusiva(nombre):
+    """
+    Ejecutar una tarea si ningún otro proceso la está ejecutando.
+    Retorna False si otro proceso tiene el advisory lock de la tarea.
+    """
+    clave = zlib.crc32(nombre.encode())
+    with _cursor_bloqueos() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(%s)", (clave,))
+        if not cursor.fetchone()[0]:
+            return False
+        try:
+            TAREAS[nombre]()
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (clave,))
+    return True
+
+def _bucle_planificador():
+    proximas = {nombre: time.monotonic() for nombre, _ in PROGRAMACION}
+    while True:
+        for nombre, intervalo in PROGRAMACION:
+            if time.monotonic() < proximas[nombre]:
+                continue
+            try:
+                ejecutar_exclusiva(nombre)
+            except Exception:
+                logger.exception("Error en la tarea %s", nombre)
+            proximas[nombre] = time.monotonic() + intervalo
+        time.sleep(max(0, min(proximas.values()) - time.monotonic()) + 1)
+
+def iniciar_planificador():
+    """Lanzar el hilo que ejecuta las tareas de PROGRAMACION (una vez por proceso)"""
+    if not TAREAS_EN_SEGUNDO_PLANO:
+        return None
+    hilo = threading.Thread(target=_bucle_planificador, name='planificador-tareas', daemon=True)
+    hilo.start()
+    return hilo
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or sys.argv[1] not in TAREAS:
+        print(f"Uso: python tareas.py <{'|'.join(TAREAS)}>")
+        sys.exit(1)
+    TAREAS[sys.argv[1]]()
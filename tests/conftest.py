@@ -0,0 +1,75 @@
+"""
+Fixtures comunes de las pruebas.
+
+Las pruebas que usan PostgreSQL se conectan a la base configurada en el
+entorno (.env, igual que la aplicación), que debe tener el schema y todas las
+migraciones aplicadas; si no hay conexión se omiten. Cada prueba crea su
+propio medicamento y sus lotes y los borra al terminar.
+"""
+import os
+import sys
+import uuid
+from decimal import Decimal
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+from database import get_db_cursor
+
+def limpiar_medicamento(medicamento_id):
+    """Borrar el medicamento, sus lotes y todo lo que generaron sus movimientos"""
+    with get_db_cursor() as cursor:
+        cursor.execute("SELECT id FROM lotes_medicamentos WHERE medicamento_id = %s", (medicamento_id,))
+        lote_ids = [row[0] for row in cursor.fetchall()]
+        cursor.execute("DELETE FROM transacciones WHERE lote_id = ANY(%s)", (lote_ids,))
+        cursor.execute("DELETE FROM lotes_medicamentos WHERE id = ANY(%s)", (lote_ids,))
+        for cola in ('cola_valoracion', 'cola_eventos_inventario'):
+            cursor.execute(
+                f"""DELETE FROM {cola} c USING movimientos_stock m
+                    WHERE c.movimiento_id = m.id AND m.lote_id = ANY(%s)""",
+                (lote_ids,)
+            )
+        cursor.execute("DELETE FROM movimientos_stock WHERE lote_id = ANY(%s)", (lote_ids,))
+        for tabla in ('capas_fifo', 'valoracion_medicamento', 'costo_ventas_diario', 'movimientos_valorados'):
+            cursor.execute(f"DELETE FROM {tabla} WHERE medicamento_id = %s", (medicamento_id,))
+        cursor.execute("DELETE FROM medicamentos WHERE id = %s", (medicamento_id,))
+
+@pytest.fixture
+def bd():
+    if database.postgres_pool is None:
+        pytest.skip("PostgreSQL no está disponible")
+
+@pytest.fixture
+def usuario_id(bd):
+    with get_db_cursor(commit=False) as cursor:
+        cursor.execute("SELECT id FROM usuarios ORDER BY id LIMIT 1")
+        row = cursor.fetchone()
+    if row is None:
+        pytest.skip("La base de datos no tiene usuarios")
+    return row[0]
+
+@pytest.fixture
+def medicamento_id(bd):
+    from models_inventario import Medicamento
+
+    medicamento_id = Medicamento.crear(
+        nombre=f'Prueba {uuid.uuid4().hex[:12]}', descripcion='Datos temporales de pruebas',
+        principio_activo='Prueba', categoria='Prueba', requiere_receta=False
+    )
+    yield medicamento_id
+    limpiar_medicamento(medicamento_id)
+
+@pytest.fixture
+def crear_lote(medicamento_id):
+    """Crear lotes del medicamento de la prueba: crear_lote(cantidad, precio='1.00')"""
+    from models_inventario import LoteMedicamento
+
+    def crear(cantidad, precio='1.00'):
+        return LoteMedicamento.crear(
+            medicamento_id=medicamento_id, numero_lote=f'PRUEBA-{uuid.uuid4().hex[:12]}',
+            cantidad=cantidad, precio_unitario=Decimal(precio),
+            fecha_fabricacion='2024-01-01', fecha_caducidad='2099-12-31', proveedor='Pruebas'
+        )
+    return crear
@@ -0,0 +1,104 @@
+"""Esperas acotadas por lock_timeout y reintentos ante bloqueos"""
+import time
+from types import SimpleNamespace
+
+import psycopg2
+import pytest
+from psycopg2 import errors
+
+import database
+import metricas
+import models_inventario
+from database import POSTGRES_CONFIG, reintentar_bloqueos
+from models_inventario import OCUPADO, LoteMedicamento, Transaccion
+
+@pytest.fixture
+def esperas(monkeypatch):
+    """Esperas de los reintentos (en segundos), sin dormir de verdad"""
+    registradas = []
+    monkeypatch.setattr(database, 'BLOQUEO_REINTENTOS', 3)
+    monkeypatch.setattr(database, 'BLOQUEO_ESPERA_MS', 50)
+    # Solo el time que ve database: los demás hilos del proceso siguen durmiendo
+    reloj = SimpleNamespace(**{nombre: getattr(time, nombre) for nombre in dir(time) if not nombre.startswith('_')})
+    reloj.sleep = registradas.append
+    monkeypatch.setattr(database, 'time', reloj)
+    return registradas
+
+def _contador(nombre, **etiquetas):
+    return metricas.registro._contadores.get((nombre, tuple(sorted(etiquetas.items()))), 0)
+
+def test_reintenta_hasta_que_la_transaccion_termina(esperas):
+    llamadas = []
+
+    @reintentar_bloqueos(agotado='agotado')
+    def operacion_reintentada(valor):
+        llamadas.append(valor)
+        if len(llamadas) == 1:
+            raise errors.LockNotAvailable()
+        if len(llamadas) == 2:
+            raise errors.DeadlockDetected()
+        return valor * 2
+
+    fallidos = (_contador('pharmaflow_bloqueos_fallidos_total', operacion='operacion_reintentada',
+                          motivo='lock_timeout'),
+                _contador('pharmaflow_bloqueos_fallidos_total', operacion='operacion_reintentada',
+                          motivo='interbloqueo'))
+    assert operacion_reintentada(21) == 42
+    assert llamadas == [21, 21, 21]
+    assert len(esperas) == 2
+    assert operacion_reintentada.__name__ == 'operacion_reintentada'
+    assert _contador('pharmaflow_bloqueos_fallidos_total', operacion='operacion_reintentada',
+                     motivo='lock_timeout') == fallidos[0] + 1
+    assert _contador('pharmaflow_bloqueos_fallidos_total', operacion='operacion_reintentada',
+                     motivo='interbloqueo') == fallidos[1] + 1
+
+def test_retorna_agotado_despues_de_los_reintentos(esperas):
+    llamadas = []
+
+    @reintentar_bloqueos(agotado='agotado')
+    def operacion_ocupada():
+        llamadas.append(1)
+        raise errors.LockNotAvailable()
+
+    agotados = _contador('pharmaflow_bloqueos_agotados_total', operacion='operacion_ocupada')
+    assert operacion_ocupada() == 'agotado'
+    assert len(llamadas) == 4
+    # Espera aleatoria entre 0 y BLOQUEO_ESPERA_MS · 2^intento
+    assert len(esperas) == 3
+    assert all(0 <= espera <= 0.05 * 2 ** intento for intento, espera in enumerate(esperas))
+    assert _contador('pharmaflow_bloqueos_agotados_total', operacion='operacion_ocupada') == agotados + 1
+
+def test_otros_errores_no_se_reintentan(esperas):
+    llamadas = []
+
+    @reintentar_bloqueos(agotado='agotado')
+    def operacion_fallida():
+        llamadas.append(1)
+        raise errors.UniqueViolation()
+
+    with pytest.raises(errors.UniqueViolation):
+        operacion_fallida()
+    assert len(llamadas) == 1
+    assert esperas == []
+
+def test_lote_bloqueado_agota_lock_timeout(crear_lote, usuario_id, monkeypatch):
+    monkeypatch.setattr(models_inventario, 'BLOQUEO_TIMEOUT_MS', 100)
+    monkeypatch.setattr(database, 'BLOQUEO_REINTENTOS', 1)
+    monkeypatch.setattr(database, 'BLOQUEO_ESPERA_MS', 10)
+    lote_id = crear_lote(20)
+
+    otra = psycopg2.connect(**POSTGRES_CONFIG)
+    try:
+        with otra.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM lotes_medicamentos WHERE id = %s FOR UPDATE", (lote_id,))
+        inicio = time.monotonic()
+        assert Transaccion.registrar_venta(lote_id, usuario_id, 1, usar_optimista=False) == OCUPADO
+        assert LoteMedicamento.actualizar_cantidad_pesimista(lote_id, 5) is False
+        # Dos intentos de 100 ms por operación, no una espera indefinida
+        assert time.monotonic() - inicio < 5
+    finally:
+        otra.rollback()
+        otra.close()
+
+    assert Transaccion.registrar_venta(lote_id, usuario_id, 1, usar_optimista=False)[0]
+    assert LoteMedicamento.obtener_por_id(lote_id)['cantidad_actual'] == 19
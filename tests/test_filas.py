@@ -0,0 +1,68 @@
+"""Registros compactos de filas.py"""
+import json
+from collections.abc import Mapping
+from decimal import Decimal
+
+import pytest
+from jinja2 import Template
+
+import filas
+
+FilaPrueba = filas.registro('FilaPrueba', ('id', 'nombre', 'precio'))
+
+def test_acceso_por_atributo_y_por_clave():
+    fila = FilaPrueba(1, 'Ibuprofeno', Decimal('2.50'))
+    assert isinstance(fila, Mapping)
+    assert (fila.id, fila.nombre, fila.precio) == (1, 'Ibuprofeno', Decimal('2.50'))
+    assert fila['nombre'] == 'Ibuprofeno'
+    with pytest.raises(KeyError):
+        fila['otro']
+    with pytest.raises(KeyError):
+        fila['__init__']
+    assert fila.get('otro', 'x') == 'x'
+    assert 'precio' in fila and 'otro' not in fila
+
+def test_se_comporta_como_diccionario_de_solo_lectura():
+    fila = FilaPrueba(1, 'Ibuprofeno', Decimal('2.50'))
+    assert list(fila) == ['id', 'nombre', 'precio']
+    assert len(fila) == 3
+    assert dict(fila) == {'id': 1, 'nombre': 'Ibuprofeno', 'precio': Decimal('2.50')}
+    assert fila == {'id': 1, 'nombre': 'Ibuprofeno', 'precio': Decimal('2.50')}
+    assert list(fila.items())[0] == ('id', 1)
+    assert repr(fila) == "FilaPrueba(id=1, nombre='Ibuprofeno', precio=Decimal('2.50'))"
+    with pytest.raises(TypeError):
+        fila['id'] = 2
+
+def test_sin_diccionario_por_instancia():
+    fila = FilaPrueba(1, 'Ibuprofeno', Decimal('2.50'))
+    assert not hasattr(fila, '__dict__')
+    with pytest.raises(AttributeError):
+        fila.otro = 1
+
+def test_argumentos_posicionales_en_el_orden_de_las_columnas():
+    with pytest.raises(TypeError):
+        FilaPrueba(1, 'Ibuprofeno')
+    assert FilaPrueba(precio=1, nombre='a', id=2).id == 2
+    assert len(filas.registro('FilaVacia', ())()) == 0
+
+@pytest.mark.parametrize('campo', ['class', '_privado', 'con espacio', '1campo'])
+def test_nombres_de_campo_no_validos(campo):
+    with pytest.raises(ValueError):
+        filas.registro('FilaInvalida', ('id', campo))
+
+def test_listar_construye_los_registros_desde_el_cursor():
+    cursor = iter([(1, 'a', Decimal('1.10')), (2, 'b', Decimal('2.20'))])
+    registros = filas.listar(cursor, FilaPrueba)
+    assert [type(r) for r in registros] == [FilaPrueba, FilaPrueba]
+    # Los importes conservan el Decimal exacto
+    assert registros[1].precio == Decimal('2.20')
+
+def test_plantillas_y_json():
+    fila = FilaPrueba(1, 'Ibuprofeno', Decimal('2.50'))
+    plantilla = Template("{{ f.nombre }} {{ f['precio'] }} {{ f.get('otro', '-') }}"
+                         "{% for campo, valor in f.items() %} {{ campo }}{% endfor %}")
+    assert plantilla.render(f=fila) == 'Ibuprofeno 2.50 - id nombre precio'
+
+    from app import app
+    with app.app_context():
+        assert json.loads(app.json.dumps([fila])) == [{'id': 1, 'nombre': 'Ibuprofeno', 'precio': '2.50'}]
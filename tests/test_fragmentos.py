@@ -0,0 +1,211 @@
+"""Lotes fragmentados: ventas de fragmentos, fusión y reparto (migraciones 014 y 017)"""
+import random
+import threading
+import time
+
+import psycopg2
+import pytest
+
+import metricas
+from database import POSTGRES_CONFIG, get_db_cursor
+from models_inventario import FRAGMENTOS_MAX, FRAGMENTOS_MINIMO, LoteMedicamento, Transaccion
+
+def _estado(lote_id):
+    """(cantidad_actual, version) del lote y (disponible, vendido, ventas) de sus fragmentos"""
+    with get_db_cursor(commit=False) as cursor:
+        cursor.execute("SELECT cantidad_actual, version FROM lotes_medicamentos WHERE id = %s", (lote_id,))
+        lote = cursor.fetchone()
+        cursor.execute(
+            """SELECT COALESCE(SUM(disponible), 0), COALESCE(SUM(vendido), 0), COALESCE(SUM(ventas), 0)
+               FROM lotes_fragmentos WHERE lote_id = %s""",
+            (lote_id,)
+        )
+        return lote, cursor.fetchone()
+
+def _vendidas(lote_id):
+    with get_db_cursor(commit=False) as cursor:
+        cursor.execute("SELECT COUNT(*), COALESCE(SUM(cantidad), 0) FROM transacciones WHERE lote_id = %s",
+                       (lote_id,))
+        return cursor.fetchone()
+
+def _interbloqueos():
+    return sum(valor for (nombre, etiquetas), valor in metricas.registro._contadores.items()
+               if nombre == 'pharmaflow_bloqueos_fallidos_total' and ('motivo', 'interbloqueo') in etiquetas)
+
+@pytest.fixture
+def lote_fragmentado(crear_lote):
+    lote_id = crear_lote(100)
+    assert LoteMedicamento.fragmentar(lote_id, 4)
+    return lote_id
+
+def test_fragmentar_reparte_el_stock(crear_lote):
+    lote_id = crear_lote(100)
+    assert LoteMedicamento.fragmentar(lote_id, 4)
+    fragmentos = LoteMedicamento.listar_fragmentos(lote_id)
+    assert [f.fragmento for f in fragmentos] == [0, 1, 2, 3]
+    assert sum(f.disponible for f in fragmentos) == 100
+    assert all(f.disponible >= FRAGMENTOS_MINIMO for f in fragmentos)
+
+    assert LoteMedicamento.fragmentar(lote_id, 0)
+    assert LoteMedicamento.listar_fragmentos(lote_id) == []
+    assert _estado(lote_id)[0][0] == 100
+
+    with pytest.raises(ValueError):
+        LoteMedicamento.fragmentar(lote_id, FRAGMENTOS_MAX + 1)
+    assert LoteMedicamento.fragmentar(-1, 4) is False
+
+def test_venta_de_un_fragmento_no_modifica_el_lote(lote_fragmentado, usuario_id):
+    (_, version), _ = _estado(lote_fragmentado)
+    assert Transaccion.registrar_venta(lote_fragmentado, usuario_id, 2)[0]
+
+    assert _estado(lote_fragmentado) == ((100, version), (98, 2, 1))
+    assert _vendidas(lote_fragmentado) == (1, 2)
+    # El stock disponible ya descuenta la venta pendiente
+    assert LoteMedicamento.obtener_por_id(lote_fragmentado)['cantidad_actual'] == 98
+
+def test_venta_mayor_que_cualquier_fragmento_fusiona_el_lote(lote_fragmentado, usuario_id):
+    assert Transaccion.registrar_venta(lote_fragmentado, usuario_id, 2)[0]
+    assert Transaccion.registrar_venta(lote_fragmentado, usuario_id, 30)[0]
+    (cantidad, _), fragmentos = _estado(lote_fragmentado)
+    assert cantidad == 68
+    assert fragmentos == (68, 0, 0)
+
+    exito, mensaje, _ = Transaccion.registrar_venta(lote_fragmentado, usuario_id, 500)
+    assert not exito
+    assert 'Stock insuficiente' in mensaje
+    assert _estado(lote_fragmentado)[1] == (68, 0, 0)
+    assert _vendidas(lote_fragmentado) == (2, 32)
+
+def test_rebalancear_aplica_las_ventas_pendientes_y_las_compras(lote_fragmentado, usuario_id):
+    for _ in range(3):
+        assert Transaccion.registrar_venta(lote_fragmentado, usuario_id, 2)[0]
+    assert Transaccion.registrar_compra(lote_fragmentado, usuario_id, 10)[0]
+
+    assert LoteMedicamento.rebalancear_fragmentos() >= 1
+    (cantidad, _), fragmentos = _estado(lote_fragmentado)
+    assert cantidad == 104
+    assert fragmentos == (104, 0, 0)
+    # Las tres ventas llegan al libro como un solo movimiento
+    with get_db_cursor(commit=False) as cursor:
+        cursor.execute("SELECT origen, cantidad, saldo FROM movimientos_stock WHERE lote_id = %s ORDER BY id",
+                       (lote_fragmentado,))
+        assert cursor.fetchall() == [('alta', 100, 100), ('compra', 10, 110), ('venta', -6, 104)]
+
+def test_ajuste_optimista_con_ventas_pendientes(lote_fragmentado, usuario_id):
+    assert Transaccion.registrar_venta(lote_fragmentado, usuario_id, 2)[0]
+    version = LoteMedicamento.obtener_por_id(lote_fragmentado)['version']
+
+    # La versión que ve el llamador es la anterior a aplicar las ventas pendientes
+    assert LoteMedicamento.actualizar_cantidad_optimista(lote_fragmentado, 50, version)
+    assert _estado(lote_fragmentado)[0][0] == 50
+    assert _estado(lote_fragmentado)[1] == (50, 0, 0)
+    assert not LoteMedicamento.actualizar_cantidad_optimista(lote_fragmentado, 40, version)
+    assert _estado(lote_fragmentado)[0][0] == 50
+
+def test_venta_multiple_rechazada_deshace_las_lineas_de_fragmentos(lote_fragmentado, crear_lote, usuario_id):
+    sin_stock = crear_lote(1)
+    exito, mensaje, _ = Transaccion.registrar_venta_multiple([(lote_fragmentado, 2), (sin_stock, 5)], usuario_id)
+    assert not exito
+    assert 'Stock insuficiente' in mensaje
+    assert _estado(lote_fragmentado)[1] == (100, 0, 0)
+    assert _vendidas(lote_fragmentado) == (0, 0)
+
+def test_fusion_durante_una_venta_de_fragmento_no_interbloquea(lote_fragmentado, usuario_id):
+    """
+    La venta bloquea su fragmento y después inserta su transacción (la clave
+    foránea toma FOR KEY SHARE del lote); la fusión bloquea el lote y espera
+    al fragmento. Con el lote bloqueado FOR UPDATE esto era un interbloqueo.
+    """
+    venta = psycopg2.connect(**POSTGRES_CONFIG)
+    fusion = psycopg2.connect(**POSTGRES_CONFIG)
+    resultado = {}
+    try:
+        with venta.cursor() as cursor:
+            cursor.execute(
+                """UPDATE lotes_fragmentos
+                   SET disponible = disponible - 1, vendido = vendido + 1, ventas = ventas + 1,
+                       fecha_pendiente = CURRENT_DATE
+                   WHERE lote_id = %s AND fragmento = 0""",
+                (lote_fragmentado,)
+            )
+            cursor.execute("SELECT pg_backend_pid()")
+            pid_venta = cursor.fetchone()[0]
+
+        def fusionar():
+            try:
+                with fusion.cursor() as cursor:
+                    cursor.execute("SELECT fusionar_fragmentos(%s)", (lote_fragmentado,))
+                    resultado['ventas'] = cursor.fetchone()[0]
+                fusion.commit()
+            except psycopg2.Error as e:
+                fusion.rollback()
+                resultado['error'] = e
+
+        hilo = threading.Thread(target=fusionar)
+        hilo.start()
+        # Esperar a que la fusión quede bloqueada por el fragmento de la venta
+        with venta.cursor() as cursor:
+            limite = time.monotonic() + 5
+            while time.monotonic() < limite:
+                cursor.execute(
+                    "SELECT 1 FROM pg_stat_activity WHERE %s = ANY(pg_blocking_pids(pid))", (pid_venta,)
+                )
+                if cursor.fetchone():
+                    break
+                time.sleep(0.02)
+            else:
+                pytest.fail("La fusión no llegó a esperar por el fragmento")
+
+            cursor.execute(
+                """INSERT INTO transacciones (tipo, lote_id, usuario_id, cantidad, precio_total)
+                   VALUES ('venta', %s, %s, 1, 1)""",
+                (lote_fragmentado, usuario_id)
+            )
+        venta.commit()
+        hilo.join(10)
+        assert not hilo.is_alive()
+    finally:
+        venta.close()
+        fusion.close()
+
+    assert 'error' not in resultado, resultado.get('error')
+    assert resultado['ventas'] == 1
+    assert _estado(lote_fragmentado)[0][0] == 99
+
+def test_ventas_y_rebalanceo_concurrentes(crear_lote, usuario_id):
+    lote_id = crear_lote(2000)
+    assert LoteMedicamento.fragmentar(lote_id, 4)
+    interbloqueos = _interbloqueos()
+    parar = threading.Event()
+    errores = []
+
+    def vender():
+        aleatorio = random.Random()
+        while not parar.is_set():
+            cantidad = aleatorio.choice([1] * 20 + [40])
+            exito, mensaje, _ = Transaccion.registrar_venta(lote_id, usuario_id, cantidad,
+                                                            usar_optimista=aleatorio.random() < 0.5)
+            if not exito and 'Stock insuficiente' not in mensaje and 'Conflicto' not in mensaje:
+                errores.append(mensaje)
+
+    def rebalancear():
+        while not parar.is_set():
+            LoteMedicamento._rebalancear_lote(lote_id, FRAGMENTOS_MINIMO)
+            time.sleep(0.01)
+
+    hilos = [threading.Thread(target=vender) for _ in range(6)] + [threading.Thread(target=rebalancear)]
+    for hilo in hilos:
+        hilo.start()
+    time.sleep(2)
+    parar.set()
+    for hilo in hilos:
+        hilo.join()
+
+    assert errores == []
+    assert _interbloqueos() == interbloqueos
+    LoteMedicamento._rebalancear_lote(lote_id, FRAGMENTOS_MINIMO)
+    (cantidad, _), fragmentos = _estado(lote_id)
+    ventas, unidades = _vendidas(lote_id)
+    assert ventas > 0
+    assert cantidad == 2000 - unidades
+    assert fragmentos == (cantidad, 0, 0)
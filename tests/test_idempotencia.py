@@ -0,0 +1,89 @@
+"""Claves de idempotencia de ventas y compras (migración 013)"""
+import threading
+import uuid
+
+import pytest
+
+from database import get_db_cursor
+from models_inventario import LoteMedicamento, Transaccion
+
+@pytest.fixture
+def clave(usuario_id):
+    clave = f'prueba-{uuid.uuid4().hex}'
+    yield clave
+    with get_db_cursor() as cursor:
+        cursor.execute("DELETE FROM claves_idempotencia WHERE usuario_id = %s AND clave = %s", (usuario_id, clave))
+
+def _transacciones(lote_id):
+    with get_db_cursor(commit=False) as cursor:
+        cursor.execute("SELECT tipo, cantidad FROM transacciones WHERE lote_id = %s ORDER BY id", (lote_id,))
+        return cursor.fetchall()
+
+def _stock(lote_id):
+    return LoteMedicamento.obtener_por_id(lote_id)['cantidad_actual']
+
+@pytest.mark.parametrize('usar_optimista', [True, False])
+def test_reintento_de_venta_retorna_el_resultado_original(crear_lote, usuario_id, clave, usar_optimista):
+    lote_id = crear_lote(20)
+    original = Transaccion.registrar_venta(lote_id, usuario_id, 3, usar_optimista, clave=clave)
+    assert original[0]
+    assert Transaccion.registrar_venta(lote_id, usuario_id, 3, usar_optimista, clave=clave) == original
+    assert _stock(lote_id) == 17
+    assert _transacciones(lote_id) == [('venta', 3)]
+
+def test_reintento_de_venta_multiple_y_de_compra(crear_lote, usuario_id, clave):
+    lote_a = crear_lote(20)
+    lote_b = crear_lote(20)
+    items = [(lote_a, 2), (lote_b, 4)]
+    original = Transaccion.registrar_venta_multiple(items, usuario_id, clave=clave)
+    assert original[0]
+    # El orden de las líneas no cambia la huella
+    assert Transaccion.registrar_venta_multiple(list(reversed(items)), usuario_id, clave=clave) == original
+    assert (_stock(lote_a), _stock(lote_b)) == (18, 16)
+
+    clave_compra = clave + '-compra'
+    try:
+        compra = Transaccion.registrar_compra(lote_a, usuario_id, 10, clave=clave_compra)
+        assert compra[0]
+        assert Transaccion.registrar_compra(lote_a, usuario_id, 10, clave=clave_compra) == compra
+        assert _stock(lote_a) == 28
+    finally:
+        with get_db_cursor() as cursor:
+            cursor.execute("DELETE FROM claves_idempotencia WHERE usuario_id = %s AND clave = %s",
+                           (usuario_id, clave_compra))
+
+def test_la_misma_clave_con_otros_datos_se_rechaza(crear_lote, usuario_id, clave):
+    lote_id = crear_lote(20)
+    assert Transaccion.registrar_venta(lote_id, usuario_id, 3, clave=clave)[0]
+    exito, mensaje, _ = Transaccion.registrar_venta(lote_id, usuario_id, 4, clave=clave)
+    assert not exito
+    assert 'otros datos' in mensaje
+    assert _stock(lote_id) == 17
+
+def test_una_operacion_fallida_no_guarda_la_clave(crear_lote, usuario_id, clave):
+    lote_id = crear_lote(2)
+    assert not Transaccion.registrar_venta(lote_id, usuario_id, 5, clave=clave)[0]
+    assert Transaccion.registrar_compra(lote_id, usuario_id, 10)[0]
+    # El reintento con la misma clave se ejecuta de nuevo y ahora hay stock
+    assert Transaccion.registrar_venta(lote_id, usuario_id, 5, clave=clave)[0]
+    assert _stock(lote_id) == 7
+
+def test_reintentos_simultaneos_venden_una_sola_vez(crear_lote, usuario_id, clave):
+    lote_id = crear_lote(20)
+    inicio = threading.Barrier(4)
+    resultados = []
+
+    def vender():
+        inicio.wait()
+        resultados.append(Transaccion.registrar_venta_multiple([(lote_id, 3)], usuario_id, clave=clave))
+
+    hilos = [threading.Thread(target=vender) for _ in range(4)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    assert resultados[0][0]
+    assert all(resultado == resultados[0] for resultado in resultados)
+    assert _stock(lote_id) == 17
+    assert _transacciones(lote_id) == [('venta', 3)]
@@ -0,0 +1,39 @@
+"""Grafo en memoria de interacciones entre medicamentos (migración 007)"""
+from models_interacciones import GrafoInteracciones
+
+def test_conserva_la_interaccion_mas_severa_de_cada_par():
+    grafo = GrafoInteracciones(1, [
+        (1, 2, 'farmacocinética', 'leve', 'primera'),
+        (1, 2, 'farmacodinámica', 'severa', 'segunda'),
+        (1, 2, 'otra', 'moderada', 'tercera'),
+    ])
+    assert grafo.adyacencia[1][2] == ('farmacodinámica', 'severa', 'segunda')
+    # La lista de adyacencia es simétrica
+    assert grafo.adyacencia[2][1] == grafo.adyacencia[1][2]
+
+def test_una_severidad_desconocida_no_reemplaza_a_una_conocida():
+    grafo = GrafoInteracciones(1, [
+        (3, 4, 'a', 'leve', None),
+        (3, 4, 'b', 'desconocida', None),
+    ])
+    assert grafo.adyacencia[3][4][1] == 'leve'
+
+    grafo = GrafoInteracciones(1, [
+        (3, 4, 'b', 'desconocida', None),
+        (3, 4, 'a', 'leve', None),
+    ])
+    assert grafo.adyacencia[4][3][1] == 'leve'
+
+def test_interacciones_del_carrito_de_la_mas_severa_a_la_mas_leve():
+    grafo = GrafoInteracciones(1, [
+        (1, 2, 'a', 'leve', None),
+        (2, 3, 'b', 'severa', None),
+        (1, 3, 'c', 'moderada', None),
+        (3, 9, 'd', 'severa', None),
+    ])
+    encontradas = grafo.interacciones([3, 1, 2, 2])
+    assert [(i['medicamento_id_1'], i['medicamento_id_2'], i['severidad']) for i in encontradas] == [
+        (2, 3, 'severa'), (1, 3, 'moderada'), (1, 2, 'leve')
+    ]
+    assert grafo.interacciones([1, 9]) == []
+    assert grafo.interacciones([5]) == []
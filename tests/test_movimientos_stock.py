@@ -0,0 +1,66 @@
+"""Libro de movimientos de stock y stock en una fecha (migración 005)"""
+from database import get_db_cursor
+from models_inventario import LoteMedicamento, Transaccion
+from models_stock import CorteStock, MovimientoStock
+
+def _movimientos(lote_id):
+    """Movimientos del lote del más antiguo al más reciente"""
+    return list(reversed(MovimientoStock.listar_por_lote(lote_id)))
+
+def _stock(fecha, medicamento_id):
+    return {fila['lote_id']: fila['saldo'] for fila in MovimientoStock.stock_en_fecha(fecha, medicamento_id)}
+
+def test_cada_cambio_de_cantidad_queda_en_el_libro(crear_lote, usuario_id):
+    lote_id = crear_lote(100)
+    assert Transaccion.registrar_venta(lote_id, usuario_id, 30)[0]
+    assert Transaccion.registrar_compra(lote_id, usuario_id, 10)[0]
+    # Edición manual: sin fila en transacciones, pero con su ajuste en el libro
+    lote = LoteMedicamento.obtener_por_id(lote_id)
+    assert LoteMedicamento.actualizar(lote_id, lote['numero_lote'], 75, lote['precio_unitario'],
+                                      lote['fecha_fabricacion'], lote['fecha_caducidad'], lote['proveedor'])
+
+    movimientos = _movimientos(lote_id)
+    assert [(m['origen'], m['cantidad']) for m in movimientos] == [
+        ('alta', 100), ('venta', -30), ('compra', 10), ('ajuste', -5)
+    ]
+    saldo = 0
+    for movimiento in movimientos:
+        saldo += movimiento['cantidad']
+        assert movimiento['saldo'] == saldo
+    assert LoteMedicamento.obtener_por_id(lote_id)['cantidad_actual'] == 75
+
+def test_stock_en_fecha_reproduce_los_saldos_del_libro(medicamento_id, crear_lote, usuario_id):
+    lote_id = crear_lote(50)
+    agotado = crear_lote(20)
+    assert Transaccion.registrar_venta(lote_id, usuario_id, 5)[0]
+    assert Transaccion.registrar_venta(agotado, usuario_id, 20)[0]
+    assert Transaccion.registrar_compra(lote_id, usuario_id, 8)[0]
+
+    for movimiento in _movimientos(lote_id):
+        assert _stock(movimiento['fecha'], medicamento_id)[lote_id] == movimiento['saldo']
+    # Un lote sin stock no aparece
+    ultimo = _movimientos(lote_id)[-1]['fecha']
+    assert _stock(ultimo, medicamento_id) == {lote_id: 53}
+
+def test_stock_en_fecha_parte_del_corte_anterior(medicamento_id, crear_lote, usuario_id):
+    lote_id = crear_lote(50)
+    sin_cambios = crear_lote(12)
+    assert Transaccion.registrar_venta(lote_id, usuario_id, 5)[0]
+    fecha_corte = _movimientos(lote_id)[-1]['fecha']
+    corte_id = CorteStock.crear(fecha_corte)
+    assert corte_id is not None
+    try:
+        assert Transaccion.registrar_compra(lote_id, usuario_id, 8)[0]
+        with get_db_cursor(commit=False) as cursor:
+            cursor.execute(
+                "SELECT lote_id, saldo FROM cortes_stock_detalle WHERE corte_id = %s AND lote_id = ANY(%s)",
+                (corte_id, [lote_id, sin_cambios])
+            )
+            assert dict(cursor.fetchall()) == {lote_id: 45, sin_cambios: 12}
+
+        # El lote sin movimientos posteriores sale del corte; el otro, del corte más sus movimientos
+        ultimo = _movimientos(lote_id)[-1]['fecha']
+        assert _stock(ultimo, medicamento_id) == {lote_id: 53, sin_cambios: 12}
+    finally:
+        with get_db_cursor() as cursor:
+            cursor.execute("DELETE FROM cortes_stock WHERE id = %s", (corte_id,))
@@ -0,0 +1,80 @@
+"""Sentencias preparadas por conexión del pool (database.ejecutar_preparada)"""
+import uuid
+
+import psycopg2
+import pytest
+from psycopg2 import errors
+
+from database import POSTGRES_CONFIG, ejecutar_preparada, get_db_cursor
+
+SUMAR = "SELECT %s::int + 1"
+
+@pytest.fixture
+def nombre(bd):
+    return f'prueba_{uuid.uuid4().hex[:12]}'
+
+def _preparadas(cursor, nombre):
+    cursor.execute("SELECT name FROM pg_prepared_statements WHERE name LIKE %s ORDER BY name", (nombre + '%',))
+    return [row[0] for row in cursor.fetchall()]
+
+def test_se_prepara_una_vez_por_conexion(nombre):
+    with get_db_cursor(commit=False) as cursor:
+        ejecutar_preparada(cursor, nombre, SUMAR, (1,))
+        assert cursor.fetchone() == (2,)
+        ejecutar_preparada(cursor, nombre, SUMAR, (41,))
+        assert cursor.fetchone() == (42,)
+        assert cursor.connection.preparadas[nombre] == _preparadas(cursor, nombre)[0]
+        assert len(_preparadas(cursor, nombre)) == 1
+
+def test_parametros_con_nombre(nombre):
+    with get_db_cursor(commit=False) as cursor:
+        ejecutar_preparada(cursor, nombre, "SELECT %(a)s::int, %(b)s::text, %(a)s::int * 2, '100%%'",
+                           {'a': 4, 'b': 'x'})
+        assert cursor.fetchone() == (4, 'x', 8, '100%')
+
+def test_el_mismo_nombre_con_otro_texto_se_rechaza(nombre):
+    with get_db_cursor(commit=False) as cursor:
+        ejecutar_preparada(cursor, nombre, SUMAR, (1,))
+        with pytest.raises(ValueError):
+            ejecutar_preparada(cursor, nombre, "SELECT %s::int + 2", (1,))
+
+def test_sesion_sin_sus_sentencias_las_vuelve_a_preparar(nombre):
+    with get_db_cursor(commit=False) as cursor:
+        conn = cursor.connection
+        ejecutar_preparada(cursor, nombre, SUMAR, (1,))
+        generacion = conn.generacion
+        # Lo que haría un pooler o un DISCARD ALL con la sesión
+        cursor.execute("DEALLOCATE ALL")
+        with pytest.raises(errors.InvalidSqlStatementName):
+            ejecutar_preparada(cursor, nombre, SUMAR, (1,))
+        assert conn.preparadas == {}
+        assert conn.generacion == generacion + 1
+
+        conn.rollback()
+        ejecutar_preparada(cursor, nombre, SUMAR, (2,))
+        assert cursor.fetchone() == (3,)
+        # Con otro nombre en la sesión: el anterior pudo quedar preparado con otro texto
+        assert conn.preparadas[nombre] == f'{nombre}_{conn.generacion}'
+
+def test_cambio_del_tipo_del_resultado_invalida_las_sentencias(nombre):
+    with get_db_cursor(commit=False) as cursor:
+        conn = cursor.connection
+        cursor.execute(f"CREATE TEMP TABLE {nombre}_tabla (a INTEGER) ON COMMIT DROP")
+        sentencia = f"SELECT * FROM {nombre}_tabla"
+        ejecutar_preparada(cursor, nombre, sentencia)
+        generacion = conn.generacion
+        cursor.execute(f"ALTER TABLE {nombre}_tabla ADD COLUMN b INTEGER")
+        with pytest.raises(errors.FeatureNotSupported):
+            ejecutar_preparada(cursor, nombre, sentencia)
+        assert conn.generacion == generacion + 1
+        assert nombre not in conn.preparadas
+
+def test_conexion_fuera_del_pool_ejecuta_como_texto(nombre):
+    conn = psycopg2.connect(**POSTGRES_CONFIG)
+    try:
+        with conn.cursor() as cursor:
+            ejecutar_preparada(cursor, nombre, SUMAR, (1,))
+            assert cursor.fetchone() == (2,)
+            assert _preparadas(cursor, nombre) == []
+    finally:
+        conn.close()
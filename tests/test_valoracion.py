@@ -0,0 +1,115 @@
+"""
+Valoración de inventario FIFO y costo promedio (migraciones 006 y 016).
+
+Ejemplo calculado a mano, con entradas de 10 u a 2.00 y 10 u a 3.00:
+  - Salida de 15 u. Promedio: 50 · 15/20 = 37.50 (quedan 5 u por 12.50).
+    FIFO: 10 · 2.00 + 5 · 3.00 = 35.00 (quedan 5 u a 3.00 = 15.00).
+  - Entrada de 5 u a 2.00: 10 u; promedio 22.50, FIFO 25.00.
+  - Salida de 6 u. Promedio: 22.50 · 6/10 = 13.50 (quedan 9.00).
+    FIFO: 5 · 3.00 + 1 · 2.00 = 17.00 (quedan 4 u a 2.00 = 8.00).
+Costo de lo vendido: 21 u, promedio 51.00, FIFO 52.00.
+"""
+from datetime import date
+from decimal import Decimal
+
+import psycopg2
+
+from database import POSTGRES_CONFIG, get_db_cursor
+from models_inventario import Transaccion
+from models_valoracion import EstadoValoracion, Valoracion
+
+def _valorar_todo():
+    while Valoracion.procesar_pendientes():
+        pass
+
+def _almacenada(medicamento_id):
+    with get_db_cursor(commit=False) as cursor:
+        cursor.execute(
+            "SELECT unidades, valor_promedio, valor_fifo FROM valoracion_medicamento WHERE medicamento_id = %s",
+            (medicamento_id,)
+        )
+        return cursor.fetchone()
+
+def _diferencias(medicamento_id):
+    return [d for d in Valoracion.verificar() if d['medicamento_id'] == medicamento_id]
+
+def test_estado_valoracion_ejemplo_a_mano():
+    estado = EstadoValoracion(1)
+    assert estado.aplicar(1, 10, Decimal('2.00')) is None
+    assert estado.aplicar(2, 10, Decimal('3.00')) is None
+    assert estado.aplicar(3, -15, None) == (Decimal('37.5000'), Decimal('35.00'))
+    assert (estado.unidades, estado.valor_promedio, estado.valor_fifo) == (5, Decimal('12.50'), Decimal('15.00'))
+
+    estado.aplicar(4, 5, Decimal('2.00'))
+    assert estado.aplicar(5, -6, None) == (Decimal('13.5000'), Decimal('17.00'))
+    assert (estado.unidades, estado.valor_promedio, estado.valor_fifo) == (4, Decimal('9.00'), Decimal('8.00'))
+    # Capa restante: 4 u de la entrada 4 a 2.00
+    assert [capa[1:] for capa in estado.capas] == [[4, 4, Decimal('2.00')]]
+    assert estado.aplicados == 5
+
+def test_estado_valoracion_redondea_el_costo_promedio():
+    estado = EstadoValoracion(1)
+    estado.aplicar(1, 10, Decimal('1.00'))
+    estado.aplicar(2, 20, Decimal('1.50'))
+    costo_promedio, costo_fifo = estado.aplicar(3, -1, None)
+    assert costo_promedio == Decimal('1.3333')
+    assert costo_fifo == Decimal('1.00')
+    assert estado.valor_promedio == Decimal('38.6667')
+
+def test_procesar_pendientes_ejemplo_a_mano(medicamento_id, crear_lote, usuario_id):
+    lote_a = crear_lote(10, '2.00')
+    lote_b = crear_lote(10, '3.00')
+    assert Transaccion.registrar_venta_multiple([(lote_b, 10), (lote_a, 5)], usuario_id)[0]
+    assert Transaccion.registrar_compra(lote_a, usuario_id, 5)[0]
+    assert Transaccion.registrar_venta(lote_a, usuario_id, 6)[0]
+    _valorar_todo()
+
+    assert _almacenada(medicamento_id) == (4, Decimal('9.0000'), Decimal('8.0000'))
+    for metodo, valor in (('fifo', Decimal('8.0000')), ('promedio', Decimal('9.0000'))):
+        fila = next(f for f in Valoracion.listar(metodo) if f['medicamento_id'] == medicamento_id)
+        assert (fila['unidades'], fila['valor']) == (4, valor)
+    for metodo, costo in (('fifo', Decimal('52.00')), ('promedio', Decimal('51.00'))):
+        fila = next(f for f in Valoracion.costo_ventas(date.today(), date.today(), metodo)
+                    if f['medicamento_id'] == medicamento_id)
+        assert (fila['unidades'], fila['costo']) == (21, costo)
+    assert _diferencias(medicamento_id) == []
+
+def test_movimientos_confirmados_fuera_de_orden(medicamento_id, crear_lote):
+    """
+    Una compra con id menor que se confirma después de una venta de otro lote:
+    la venta se valora primero y verificar() reproduce ese mismo orden
+    """
+    lote_a = crear_lote(10, '2.00')
+    lote_b = crear_lote(10, '3.00')
+    _valorar_todo()
+
+    compra = psycopg2.connect(**POSTGRES_CONFIG)
+    venta = psycopg2.connect(**POSTGRES_CONFIG)
+    try:
+        with compra.cursor() as cursor:
+            cursor.execute("SELECT set_config('pharmaflow.origen', 'compra', true)")
+            cursor.execute("UPDATE lotes_medicamentos SET cantidad_actual = cantidad_actual + 10 WHERE id = %s",
+                           (lote_a,))
+        with venta.cursor() as cursor:
+            cursor.execute("SELECT set_config('pharmaflow.origen', 'venta', true)")
+            cursor.execute("UPDATE lotes_medicamentos SET cantidad_actual = cantidad_actual - 5 WHERE id = %s",
+                           (lote_b,))
+        venta.commit()
+        _valorar_todo()
+        compra.commit()
+        _valorar_todo()
+    finally:
+        compra.close()
+        venta.close()
+
+    with get_db_cursor(commit=False) as cursor:
+        cursor.execute(
+            """SELECT m.cantidad FROM movimientos_valorados v
+               JOIN movimientos_stock m ON m.id = v.movimiento_id
+               WHERE v.medicamento_id = %s ORDER BY v.orden""",
+            (medicamento_id,)
+        )
+        assert [row[0] for row in cursor.fetchall()] == [10, 10, -5, 10]
+    # La venta consumió la capa de 2.00: quedan 5 a 2.00, 10 a 3.00 y 10 a 2.00
+    assert _almacenada(medicamento_id) == (25, Decimal('57.5000'), Decimal('60.0000'))
+    assert _diferencias(medicamento_id) == []
@@ -0,0 +1,26 @@
+"""
+Punto de entrada WSGI para producción.
+
+Uso con gunicorn (configuración en gunicorn.conf.py):
+    gunicorn -c gunicorn.conf.py wsgi:application
+"""
+import sys
+
+import database
+from app import app
+
+application = app
+
+# Passenger (cPanel) también hace fork de un proceso precargado: recrear las
+# conexiones en cada worker igual que en el hook post_fork de gunicorn.
+if 'PhusionPassenger' in sys.modules:
+    import PhusionPassenger
+
+    def _al_iniciar_worker(forked):
+        if forked:
+            database.reiniciar_conexiones()
+        import tareas
+        tareas.iniciar_planificador()
+
+    database.cerrar_conexiones()
+    PhusionPassenger.on_event('starting_worker_process', _al_iniciar_worker)